@@ -0,0 +1,116 @@
+"""Microbenchmark: building request bodies and decoding responses, before and after the typed codec.
+
+"before" is what `Request.req` used to do: encode a dict body, parse the
+response with `Response.json()` into dicts, pick the fields out of those,
+and keep the `Response` around on the request. "after" encodes a
+`ChatRequestBody` and decodes straight into the `codec` structs. Both are
+fed the same canned responses, so no network is involved. Reports CPU per
+request and the memory still held once a batch of requests is done.
+
+    uv run bench/codec_bench.py
+"""
+import gc
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import httpx
+import msgspec
+from msgspec import UNSET
+from codec import ChatRequestBody, Usage, decode_completion, encode_body
+from messages import Message
+
+REQUESTS = 20_000
+RETAINED = 2_000 # requests kept alive at once when measuring memory
+RESPONSE_WORDS = [32, 512]
+
+def make_response(words: int, choices: int = 1) -> bytes:
+    # Shaped like a real server's, extra fields and all
+    return msgspec.json.encode({
+        "id": "chatcmpl-0123456789",
+        "object": "chat.completion",
+        "created": 1_700_000_000,
+        "model": "mock",
+        "system_fingerprint": "fp_0123456789",
+        "choices": [
+            {
+                "index": index,
+                "message": {"role": "assistant", "content": " ".join(["token"] * words), "tool_calls": []},
+                "logprobs": None,
+                "finish_reason": "stop",
+            }
+            for index in range(choices)
+        ],
+        "usage": {"prompt_tokens": 24, "completion_tokens": words, "total_tokens": 24 + words},
+    })
+
+MESSAGES = [
+    Message(role="system", content="You are a helpful assistant."),
+    Message(role="user", content="Write a short story about the number 7."),
+]
+
+def before(response: bytes) -> tuple[bytes, Any]:
+    body = msgspec.json.encode({
+        "model": "mock",
+        "messages": MESSAGES,
+        "temperature": 0.7,
+        "top_p": None,
+        "max_tokens": 512,
+    }, order="sorted")
+    res = httpx.Response(200, content=response, request=httpx.Request("POST", "http://mock/chat/completions"))
+    parsed = res.raise_for_status().json()
+    choices = sorted(parsed["choices"], key=lambda choice: choice.get("index", 0))
+    usage = msgspec.convert(parsed.get("usage"), Usage | None)
+    outputs = [(choice["message"]["content"], choice["message"].get("reasoning_content")) for choice in choices]
+    return body, (outputs, usage, res)
+
+def after(response: bytes) -> tuple[bytes, Any]:
+    body = encode_body(ChatRequestBody(
+        max_tokens=512,
+        messages=MESSAGES,
+        model="mock",
+        n=UNSET,
+        temperature=0.7,
+        top_p=None,
+    ))
+    res = httpx.Response(200, content=response, request=httpx.Request("POST", "http://mock/chat/completions"))
+    completion = decode_completion(res.raise_for_status().content)
+    choices = sorted(completion.choices, key=lambda choice: choice.index)
+    outputs = [(choice.message.content or "", choice.message.reasoning_content or choice.message.reasoning) for choice in choices]
+    return body, (outputs, completion.usage)
+
+def cpu_per_request(path: Callable[[bytes], Any], response: bytes) -> float:
+    start = time.process_time()
+    for _ in range(REQUESTS):
+        path(response)
+    return (time.process_time() - start) / REQUESTS
+
+def retained_bytes(path: Callable[[bytes], Any], response: bytes) -> float:
+    gc.collect()
+    tracemalloc.start()
+    results = [path(response) for _ in range(RETAINED)]
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del results
+    return current / RETAINED
+
+def main() -> None:
+    print(f"{REQUESTS} requests for CPU, {RETAINED} held for memory")
+    print(f"{'words':>6}  {'cpu before':>10}  {'cpu after':>10}  {'speedup':>8}  {'mem before':>11}  {'mem after':>10}")
+    for words in RESPONSE_WORDS:
+        response = make_response(words)
+        assert before(response)[1][:2] == after(response)[1]
+        cpu_before, cpu_after = cpu_per_request(before, response), cpu_per_request(after, response)
+        mem_before, mem_after = retained_bytes(before, response), retained_bytes(after, response)
+        print(
+            f"{words:>6}  {cpu_before * 1e6:>8.1f}us  {cpu_after * 1e6:>8.1f}us  {cpu_before / cpu_after:>7.1f}x  "
+            f"{mem_before / 1024:>9.1f}KB  {mem_after / 1024:>8.1f}KB"
+        )
+
+if __name__ == "__main__":
+    main()
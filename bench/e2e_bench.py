@@ -0,0 +1,127 @@
+"""End-to-end benchmark: whole runs of `main` against the bundled mock server.
+
+Starts `src/mock_server.py` on a free port, then for each dataset size and
+`parallel` level runs polymerase in a fresh process (so its peak RSS is its
+own) twice: once without checkpoints and once checkpointing every
+`CHECKPOINT_INTERVAL` responses. Reports requests/sec, client CPU per
+request, peak RSS, and what checkpointing added. Everything stays on
+localhost, so it runs offline.
+
+    uv run bench/e2e_bench.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import msgspec
+
+SIZES = [1_000, 10_000]
+PARALLEL = [16, 64, 256]
+CHECKPOINT_INTERVAL = 500
+# Fast enough that the server isn't the bottleneck, slow enough that concurrency matters
+MOCK_ARGS = ["--latency", "0.02", "--latency-sigma", "0.3", "--tokens-per-second", "2000", "--completion-tokens", "32", "--seed", "0"]
+
+CONFIG = """
+[api]
+base_url = "{base_url}"
+model = "mock"
+api_key = "mock"
+
+[model]
+max_tokens = 32
+
+[data]
+path = "in.jsonl"
+type = "jsonl"
+format = "prompt_column"
+
+[processes]
+parallel = {parallel}
+
+[output]
+path = "out.jsonl"
+type = "jsonl"
+{checkpoint}
+"""
+
+class RunStats(msgspec.Struct):
+    seconds: float
+    cpu_seconds: float
+    peak_rss_mb: float
+    returncode: int
+
+def start_mock_server() -> tuple[subprocess.Popen, str]:
+    server = subprocess.Popen(
+        [sys.executable, str(ROOT / "src" / "mock_server.py"), "--port", "0", *MOCK_ARGS],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    assert server.stdout is not None
+    line = server.stdout.readline()
+    if not line.startswith("Listening on "):
+        server.kill()
+        raise RuntimeError(f"Mock server didn't start: {line!r}")
+    return server, line.removeprefix("Listening on ").strip()
+
+def write_run(directory: Path, base_url: str, size: int, parallel: int, checkpoint: bool) -> Path:
+    with open(directory / "in.jsonl", "wb") as f:
+        for row in range(size):
+            f.write(msgspec.json.encode({"prompt": f"Write a short story about the number {row}."}) + b"\n")
+    checkpoint_line = f"checkpoint_interval = {CHECKPOINT_INTERVAL}" if checkpoint else ""
+    path = directory / "config.toml"
+    path.write_text(CONFIG.format(base_url=base_url, parallel=parallel, checkpoint=checkpoint_line))
+    return path
+
+def run(config_path: Path) -> RunStats:
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, str(ROOT / "src" / "main.py"), "--config", str(config_path)],
+        cwd=config_path.parent,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # wait4 hands back the child's own resource usage, CPU time and peak RSS included
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return RunStats(
+        seconds=time.perf_counter() - start,
+        cpu_seconds=usage.ru_utime + usage.ru_stime,
+        peak_rss_mb=usage.ru_maxrss / 1024,
+        returncode=process.returncode,
+    )
+
+def main() -> None:
+    server, base_url = start_mock_server()
+    print(f"mock server at {base_url}, {' '.join(MOCK_ARGS)}")
+    print(
+        f"{'rows':>7}  {'parallel':>8}  {'req/s':>8}  {'cpu/req':>9}  {'peak rss':>9}  "
+        f"{'ckpt wall':>10}  {'ckpt cpu/req':>12}"
+    )
+    try:
+        for size in SIZES:
+            for parallel in PARALLEL:
+                results: dict[bool, RunStats] = {}
+                for checkpoint in (False, True):
+                    with tempfile.TemporaryDirectory() as directory:
+                        results[checkpoint] = run(write_run(Path(directory), base_url, size, parallel, checkpoint))
+                        if results[checkpoint].returncode != 0:
+                            raise RuntimeError(f"Run with {size} rows at parallel {parallel} failed")
+                plain, checkpointed = results[False], results[True]
+                print(
+                    f"{size:>7}  {parallel:>8}  {size / plain.seconds:>8.0f}  "
+                    f"{plain.cpu_seconds / size * 1000:>7.2f}ms  {plain.peak_rss_mb:>7.0f}MB  "
+                    f"{checkpointed.seconds - plain.seconds:>+9.2f}s  "
+                    f"{(checkpointed.cpu_seconds - plain.cpu_seconds) / size * 1000:>+10.3f}ms"
+                )
+    finally:
+        server.kill()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
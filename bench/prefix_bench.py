@@ -0,0 +1,124 @@
+"""End-to-end benchmark: file-order vs prefix-grouped scheduling against a server with a prefix cache.
+
+Builds a few-shot style dataset where every row starts with one of a handful
+of long shared system prompts, interleaved at random, and runs `main` over
+it once per schedule. Each run gets a fresh `src/mock_server.py` that models
+prompt processing: prompts are prefilled one at a time at
+`PREFILL_TOKENS_PER_SECOND`, and only `CACHED_PREFIXES` system prompts stay
+cached, like vLLM/SGLang's automatic prefix caching under memory pressure.
+Reports wall time, requests/sec and the hit rate the server saw.
+
+    uv run bench/prefix_bench.py
+"""
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import httpx
+import msgspec
+from config import Schedule
+
+ROWS = 4_000
+PREFIXES = 32
+PREFIX_TOKENS = 2_000
+CACHED_PREFIXES = 8 # how many prefixes the server's KV cache can hold at once
+PREFILL_TOKENS_PER_SECOND = 400_000
+PARALLEL = 64
+MOCK_ARGS = [
+    "--latency", "0.02", "--latency-sigma", "0.3", "--tokens-per-second", "2000", "--completion-tokens", "16",
+    "--prefill-tokens-per-second", str(PREFILL_TOKENS_PER_SECOND), "--prefix-cache-size", str(CACHED_PREFIXES),
+    "--seed", "0",
+]
+
+CONFIG = """
+[api]
+base_url = "{base_url}"
+model = "mock"
+api_key = "mock"
+
+[model]
+max_tokens = 16
+
+[data]
+path = "in.jsonl"
+type = "jsonl"
+format = "messages_column"
+schedule = "{schedule}"
+
+[processes]
+parallel = {parallel}
+"""
+
+class Stats(msgspec.Struct):
+    requests: int
+    prefix_hits: int
+    prefix_misses: int
+
+def write_dataset(path: Path) -> None:
+    rng = random.Random(0)
+    systems = [f"system prompt {i} " + "x" * (PREFIX_TOKENS * 4) for i in range(PREFIXES)]
+    with open(path, "wb") as f:
+        for row in range(ROWS):
+            messages = [
+                {"role": "system", "content": systems[rng.randrange(PREFIXES)]},
+                {"role": "user", "content": f"question {row}"},
+            ]
+            f.write(msgspec.json.encode({"messages": messages}) + b"\n")
+
+def start_mock_server() -> tuple[subprocess.Popen, str]:
+    server = subprocess.Popen(
+        [sys.executable, str(ROOT / "src" / "mock_server.py"), "--port", "0", *MOCK_ARGS],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    assert server.stdout is not None
+    line = server.stdout.readline()
+    if not line.startswith("Listening on "):
+        server.kill()
+        raise RuntimeError(f"Mock server didn't start: {line!r}")
+    return server, line.removeprefix("Listening on ").strip()
+
+def run(directory: Path, schedule: Schedule) -> tuple[float, Stats]:
+    # A fresh server each time, so every schedule starts from a cold cache
+    server, base_url = start_mock_server()
+    try:
+        config = directory / f"{schedule.value}.toml"
+        config.write_text(CONFIG.format(base_url=base_url, schedule=schedule.value, parallel=PARALLEL))
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, str(ROOT / "src" / "main.py"), "--config", str(config)],
+            cwd=directory,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        elapsed = time.perf_counter() - start
+        stats = msgspec.json.decode(httpx.get(f"{base_url}/stats").content, type=Stats)
+        return elapsed, stats
+    finally:
+        server.kill()
+        server.wait()
+
+def main() -> None:
+    print(
+        f"{ROWS} rows, {PREFIXES} prefixes of ~{PREFIX_TOKENS} tokens, server caches {CACHED_PREFIXES} "
+        f"and prefills {PREFILL_TOKENS_PER_SECOND:,} tokens/s, parallel {PARALLEL}"
+    )
+    print(f"{'schedule':>10}  {'wall':>8}  {'req/s':>8}  {'hit rate':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        write_dataset(Path(directory) / "in.jsonl")
+        for schedule in (Schedule.FILE, Schedule.PREFIX):
+            elapsed, stats = run(Path(directory), schedule)
+            print(
+                f"{schedule.value:>10}  {elapsed:>7.2f}s  {ROWS / elapsed:>8.0f}  "
+                f"{stats.prefix_hits / max(1, stats.prefix_hits + stats.prefix_misses):>9.1%}"
+            )
+
+if __name__ == "__main__":
+    main()
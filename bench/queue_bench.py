@@ -0,0 +1,49 @@
+"""Microbenchmark: AsyncQueue enqueue/dequeue cost at increasing queue depths.
+
+Fills the queue to a given depth, then times a steady stream of
+enqueue + dequeue pairs. The per-op cost should stay flat as depth grows.
+
+    uv run bench/queue_bench.py
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import trio
+from primitives import AsyncQueue
+
+DEPTHS = [1_000, 10_000, 100_000, 1_000_000]
+OPS = 20_000
+
+async def bench_async_queue(depth: int) -> float:
+    queue = AsyncQueue[int](lock=trio.Lock())
+    for i in range(depth):
+        await queue.enqueue(i)
+
+    start = time.perf_counter()
+    for i in range(OPS):
+        await queue.enqueue(i)
+        await queue.dequeue()
+    return (time.perf_counter() - start) / OPS
+
+def bench_list_pop(depth: int) -> float:
+    # The previous implementation: a list with pop(0)
+    items = list(range(depth))
+    ops = min(OPS, 2_000)
+    start = time.perf_counter()
+    for i in range(ops):
+        items.append(i)
+        items.pop(0)
+    return (time.perf_counter() - start) / ops
+
+async def main() -> None:
+    print(f"{'depth':>10}  {'AsyncQueue (us/pair)':>20}  {'list.pop(0) (us/pair)':>20}")
+    for depth in DEPTHS:
+        queue_cost = await bench_async_queue(depth)
+        list_cost = bench_list_pop(depth)
+        print(f"{depth:>10}  {queue_cost * 1e6:>20.2f}  {list_cost * 1e6:>20.2f}")
+
+if __name__ == "__main__":
+    trio.run(main)
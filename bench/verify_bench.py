@@ -0,0 +1,81 @@
+"""Microbenchmark: per-row verification vs vectorized verification over polars frames.
+
+Builds a batch of finished requests with a mix of good responses, refusals,
+too-short ones and ones that trip a blacklist, then times both paths over
+it in chunks, the way the verification workers see them. Both run on the
+calling thread, so this is the CPU cost per response; the per-row path
+would be spread over processes in a real run. Some prompts are few-shot,
+with an example answer already in them, and both paths have to reach the
+same verdict on every response before anything is timed.
+
+    uv run bench/verify_bench.py
+"""
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+from config import Check, LengthCheck, RefusalCheck, RegexCheck, SubstringCheck
+from messages import Message, Request
+from verification import FrameVerifier, verify_batch
+
+RESPONSES = 200_000
+CHUNK_SIZES = [256, 4_096, 65_536]
+
+CHECKS: list[Check] = [
+    LengthCheck(min_chars=40, max_chars=4_000),
+    RegexCheck(r"(?:https?://|www\.)\S+", must_match=False),
+    RegexCheck(r"as an (?:ai|language model)", must_match=False, ignore_case=True),
+    SubstringCheck(["answer"], ignore_case=True),
+    RefusalCheck(),
+]
+
+def make_requests() -> list[Request]:
+    rng = random.Random(0)
+    words = "the a of model answer data token batch queue verify polars frame check output result".split()
+    requests = []
+    for row in range(RESPONSES):
+        body = " ".join(rng.choice(words) for _ in range(rng.randint(5, 150)))
+        match rng.random():
+            case x if x < 0.05:
+                body = "I'm sorry, but I can't help with that."
+            case x if x < 0.08:
+                body = f"see www.example.com/{row} for the answer"
+            case _:
+                body = f"The answer is: {body}"
+        messages = [Message(role="user", content=f"question {row}"), Message(role="assistant", content=body)]
+        if rng.random() < 0.1:
+            # Only the last message is the response, so the example answer mustn't trip the checks
+            messages = [
+                Message(role="user", content="example question"),
+                Message(role="assistant", content="I'm sorry, see www.example.com"),
+            ] + messages
+        requests.append(Request(messages=messages, row_id=row))
+    return requests
+
+def bench(requests: list[Request], chunk_size: int, verify) -> tuple[float, int]:
+    start = time.perf_counter()
+    failed = 0
+    for offset in range(0, len(requests), chunk_size):
+        failed += sum(failure is not None for failure in verify(requests[offset:offset + chunk_size]))
+    return time.perf_counter() - start, failed
+
+def main() -> None:
+    requests = make_requests()
+    frame = FrameVerifier(CHECKS)
+    sample = requests[:10_000]
+    assert verify_batch(CHECKS, sample) == frame.verify(sample), "per-row and vectorized verification disagree"
+    print(f"{RESPONSES} responses, {len(CHECKS)} checks")
+    print(f"{'chunk':>8}  {'per-row':>10}  {'vectorized':>10}  {'speedup':>8}  {'failed':>14}")
+    for chunk_size in CHUNK_SIZES:
+        row_time, row_failed = bench(requests, chunk_size, lambda chunk: verify_batch(CHECKS, chunk))
+        frame_time, frame_failed = bench(requests, chunk_size, frame.verify)
+        print(
+            f"{chunk_size:>8}  {row_time:>9.2f}s  {frame_time:>9.2f}s  {row_time / frame_time:>7.1f}x  "
+            f"{row_failed:>6}/{frame_failed:<7}"
+        )
+
+if __name__ == "__main__":
+    main()
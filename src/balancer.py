@@ -0,0 +1,147 @@
+import math
+import httpx
+import trio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Any, Self
+from http_client import AsyncHttpClient
+from config import APIConfig, EndpointConfig, Routing
+from result import Result, is_ok
+
+def endpoint_configs(api: APIConfig) -> list[EndpointConfig]:
+    """The endpoints to spread requests over: `[[api.endpoints]]`, or just `base_url`."""
+    if api.endpoints:
+        return api.endpoints
+    if api.base_url is None:
+        raise ValueError("Set either `base_url` or `[[api.endpoints]]` in [api]")
+    return [EndpointConfig(base_url=api.base_url)]
+
+def is_endpoint_failure(error: BaseException) -> bool:
+    """Whether an error says something about the endpoint rather than the request: 5xx, or a connection problem/timeout."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+class Endpoint:
+    """One replica, with its own connection pool and running stats."""
+
+    def __init__(self, config: EndpointConfig, client: AsyncHttpClient):
+        self.url = config.base_url
+        self.weight = config.weight
+        self.max_concurrency = config.max_concurrency
+        self.client = client
+        self.outstanding = 0
+        self.latency: float | None = None # EWMA of successful requests
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.consecutive_failures = 0
+        self.ejected_until = float("-inf")
+        self.probing = False # back from an ejection, but not trusted with more than one request yet
+        self._total_latency = 0.0
+
+    @property
+    def mean_latency(self) -> float | None:
+        successes = self.requests - self.failures
+        return self._total_latency / successes if successes > 0 else None
+
+    def available(self, now: float) -> bool:
+        if self.ejected_until > now:
+            return False
+        if self.probing:
+            return self.outstanding == 0
+        return self.max_concurrency is None or self.outstanding < self.max_concurrency
+
+class Balancer:
+    """Routes each request to one of several endpoints.
+
+    `least_outstanding` picks the endpoint with the fewest requests in flight
+    relative to its weight. `latency` also scales that by the endpoint's EWMA
+    latency, so slow replicas get proportionally less traffic. Endpoints that
+    fail `eject_after` times in a row sit out for `eject_for` seconds, unless
+    that would leave nothing to send to. When they come back they get one
+    request at a time until one succeeds, and go straight back out if it fails.
+    """
+
+    def __init__(
+        self,
+        endpoints: list[Endpoint],
+        routing: Routing = Routing.LEAST_OUTSTANDING,
+        eject_after: int = 3,
+        eject_for: float = 30.0,
+    ):
+        if not endpoints:
+            raise ValueError("Need at least one endpoint")
+        self.endpoints = endpoints
+        self.routing = routing
+        self.eject_after = eject_after
+        self.eject_for = eject_for
+        self._lot = trio.lowlevel.ParkingLot()
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        for endpoint in self.endpoints:
+            await endpoint.client.aclose()
+
+    def _score(self, endpoint: Endpoint) -> tuple[float, float]:
+        load = (endpoint.outstanding + 1) / endpoint.weight
+        if self.routing == Routing.LATENCY:
+            # Endpoints without a sample yet score 0, so each gets tried early on
+            return (endpoint.latency or 0.0) * load, load
+        return load, 0.0
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[Endpoint]:
+        endpoint = await self.acquire()
+        try:
+            yield endpoint
+        finally:
+            self.release(endpoint)
+
+    async def acquire(self) -> Endpoint:
+        await trio.lowlevel.checkpoint_if_cancelled()
+        while True:
+            now = trio.current_time()
+            available = [endpoint for endpoint in self.endpoints if endpoint.available(now)]
+            if available:
+                endpoint = min(available, key=self._score)
+                endpoint.outstanding += 1
+                await trio.lowlevel.cancel_shielded_checkpoint()
+                return endpoint
+
+            # Everything is busy or ejected: wait for a slot, or for an ejection to run out
+            ejected = [endpoint.ejected_until for endpoint in self.endpoints if endpoint.ejected_until > now]
+            with trio.move_on_at(min(ejected) if ejected else math.inf):
+                await self._lot.park()
+
+    def release(self, endpoint: Endpoint) -> None:
+        endpoint.outstanding -= 1
+        self._lot.unpark()
+
+    def record(self, endpoint: Endpoint, result: Result[Any], latency: float) -> None:
+        """Update an endpoint's stats and health from the outcome of one request."""
+        endpoint.requests += 1
+        if is_ok(result):
+            endpoint.consecutive_failures = 0
+            endpoint.probing = False
+            endpoint._total_latency += latency
+            endpoint.latency = latency if endpoint.latency is None else 0.7 * endpoint.latency + 0.3 * latency
+            return
+
+        endpoint.failures += 1
+        if not is_endpoint_failure(result.unwrap_err()):
+            return
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures < self.eject_after and not endpoint.probing:
+            return
+
+        now = trio.current_time()
+        if any(other is not endpoint and other.ejected_until <= now for other in self.endpoints):
+            endpoint.ejected_until = now + self.eject_for
+            endpoint.ejections += 1
+            endpoint.consecutive_failures = 0
+            endpoint.probing = True
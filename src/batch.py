@@ -0,0 +1,517 @@
+import os
+import httpx
+import msgspec
+import trio
+from msgspec import Struct, structs
+from msgspec import json as msgspec_json
+from typing import Awaitable, Callable, Iterator
+from logbar import LogBar
+from logbar.progress import ProgressBar
+from codec import decode_completion
+from config import Config, VerificationConfig
+from datasets import load_dataset
+from http_client import AsyncHttpClient, parse_retry_after
+from messages import Request, JSON_HEADERS
+from output import OutputSink, DeadLetter, DeadLetterWriter, dead_letter_path, batch_manifest_path, load_completed_row_ids
+from result import Result, Ok, Err
+from retry import ErrorClass, RetryPolicy, VerificationFailed, classify_error, describe_error
+from sharding import ShardProgress
+from verification import VerificationPool
+
+# What each line of a batch asks for, which is also the batch's endpoint
+CHAT_COMPLETIONS = "/v1/chat/completions"
+FINISHED = {"completed", "failed", "expired", "cancelled"}
+
+class BatchLine(Struct):
+    custom_id: str
+    method: str
+    url: str
+    body: msgspec.Raw # the request body, encoded once by `Request._body`
+
+class UploadedFile(Struct):
+    id: str
+
+class RequestCounts(Struct):
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+class BatchError(Struct):
+    message: str | None = None
+    code: str | None = None
+    line: int | None = None
+
+class BatchErrors(Struct):
+    data: list[BatchError] = []
+
+class BatchJob(Struct):
+    id: str
+    status: str
+    output_file_id: str | None = None
+    error_file_id: str | None = None
+    request_counts: RequestCounts | None = None
+    errors: BatchErrors | None = None
+
+class LineResponse(Struct):
+    status_code: int
+    body: msgspec.Raw
+
+class ResultLine(Struct):
+    custom_id: str
+    response: LineResponse | None = None
+    error: BatchError | None = None
+
+class Submitted(Struct):
+    id: str
+    custom_ids: list[str]
+    collected: bool = False
+
+class Manifest(Struct):
+    """Batches submitted so far, so a run that stops can pick them back up."""
+    batches: list[Submitted] = []
+
+def custom_id(request: Request) -> str:
+    """Names a request within a batch. A row only appears once per batch, or once per sample."""
+    if request.sample_index is not None:
+        return f"row-{request.row_id}-sample-{request.sample_index}"
+    return f"row-{request.row_id}"
+
+def describe_batch_error(job: BatchJob) -> str:
+    if job.errors is not None and job.errors.data:
+        error = job.errors.data[0]
+        where = f" (line {error.line})" if error.line is not None else ""
+        return f"Batch {job.status}: {error.message or error.code}{where}"
+    return f"Batch {job.status} without answering this request"
+
+class BatchRunner:
+    """Runs requests through the batch API (`/files` and `/batches`) instead of live calls.
+
+    Requests are written into JSONL files of at most `max_requests` lines
+    and `max_bytes` bytes, uploaded, and submitted as batches. Each batch
+    is polled, backing off up to `poll_max`, and once it's finished its
+    results are matched back to their requests by `custom_id`, verified,
+    and written to the output. Anything that failed goes round again in
+    a new batch, within the same limits as retries of live requests. A
+    batch that can't be checked on is never sent again, since it may
+    still finish; it's left for a resumed run to collect.
+
+    Submitted batches are recorded in a manifest next to the output, so
+    resuming picks up the ones that were still running instead of paying
+    for them twice.
+    """
+
+    def __init__(
+        self,
+        config: Config,
+        client: AsyncHttpClient,
+        sink: OutputSink | None,
+        dead_writer: DeadLetterWriter | None,
+        verifier: VerificationPool,
+        verify_batch_size: int,
+        retry_policy: RetryPolicy,
+        log: LogBar,
+        pb: ProgressBar | ShardProgress,
+    ):
+        self.config = config
+        self.client = client
+        self.sink = sink
+        self.dead_writer = dead_writer
+        self.verifier = verifier
+        self.verify_batch_size = verify_batch_size
+        self.retry_policy = retry_policy
+        self.log = log
+        self.pb = pb
+        self.manifest_path = batch_manifest_path(config.output.path) if config.output is not None else None
+        self.manifest = Manifest()
+        self.part_rows = (
+            config.output.checkpoint_interval or config.output.part_rows
+            if config.output is not None
+            else None
+        )
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.unreachable = 0
+        self._oversized: list[Request] = []
+        self._write_lock = trio.Lock()
+        self._encoder = msgspec_json.Encoder()
+
+    async def run(self, requests: list[Request], resume: bool = False) -> None:
+        by_id = {custom_id(request): request for request in requests}
+
+        # Batches an earlier run submitted but didn't get the results of
+        attached: list[tuple[str, list[Request]]] = []
+        if resume and self.manifest_path is not None and os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "rb") as f:
+                previous = msgspec_json.decode(f.read(), type=Manifest)
+            # Anything still to do from a collected batch failed there, and is sent again below
+            for submitted in previous.batches:
+                if submitted.collected:
+                    continue
+                batch = [by_id.pop(id) for id in submitted.custom_ids if id in by_id]
+                if batch:
+                    attached.append((submitted.id, batch))
+                    self.manifest.batches.append(submitted)
+            if attached:
+                self.log.info(f"Picking up {len(attached)} batch(es) submitted by an earlier run")
+        await self._save_manifest()
+
+        pending = list(by_id.values())
+        while pending or attached:
+            retry: list[Request] = []
+            async with trio.open_nursery() as nursery:
+                for batch_id, batch in attached:
+                    nursery.start_soon(self._collect, batch_id, batch, retry)
+                # Only one file's worth of lines is encoded at a time
+                chunks = self._chunks(pending)
+                while (chunk := await trio.to_thread.run_sync(next, chunks, None)) is not None:
+                    data, batch = chunk
+                    try:
+                        batch_id = await self._submit(data, batch)
+                    except Exception as e:
+                        for request in batch:
+                            await self._fail(request, e, retry)
+                        continue
+                    nursery.start_soon(self._collect, batch_id, batch, retry)
+                for request in self._oversized:
+                    await self._dead_letter(request, ValueError(f"Request is bigger than a batch file can be ({self.config.batch.max_bytes} bytes)"))
+                self._oversized = []
+            attached, pending = [], retry
+            if pending:
+                self.log.info(f"Sending {len(pending)} failed request(s) again in a new batch")
+
+        if self.unreachable == 0 and self.manifest_path is not None and os.path.isfile(self.manifest_path):
+            os.remove(self.manifest_path)
+
+    def _chunks(self, requests: list[Request]) -> Iterator[tuple[bytes, list[Request]]]:
+        """Split requests into batch input files within the line and size limits."""
+        limits = self.config.batch
+        lines: list[bytes] = []
+        batch: list[Request] = []
+        size = 0
+        for request in requests:
+            line = self._encoder.encode(BatchLine(
+                custom_id=custom_id(request),
+                method="POST",
+                url=CHAT_COMPLETIONS,
+                body=msgspec.Raw(request._body(self.config.api.model)),
+            )) + b"\n"
+            if len(line) > limits.max_bytes:
+                self._oversized.append(request)
+                continue
+            if batch and (len(batch) >= limits.max_requests or size + len(line) > limits.max_bytes):
+                yield b"".join(lines), batch
+                lines, batch, size = [], [], 0
+            lines.append(line)
+            batch.append(request)
+            size += len(line)
+        if batch:
+            yield b"".join(lines), batch
+
+    async def _api(self, what: str, call: Callable[[], Awaitable[Result[httpx.Response]]]) -> httpx.Response:
+        """Make one call to the files/batches API, retrying it like a live request would be."""
+        attempts = 0
+        while True:
+            result = await call()
+            error = result._error
+            if error is None:
+                try:
+                    return result.unwrap().raise_for_status()
+                except httpx.HTTPStatusError as e:
+                    error = e
+            attempts += 1
+            if classify_error(error) == ErrorClass.TERMINAL or attempts >= self.config.retry.max_attempts:
+                raise error
+            delay = self.retry_policy.backoff(attempts)
+            if isinstance(error, httpx.HTTPStatusError):
+                retry_after = parse_retry_after(error.response)
+                if retry_after is not None:
+                    delay = max(delay, retry_after)
+            self.log.error(f"Failed {what}, retrying in {delay:.1f}s: {describe_error(error)}")
+            await trio.sleep(delay)
+
+    async def _submit(self, data: bytes, batch: list[Request]) -> str:
+        timeout = self.config.batch.upload_timeout
+        upload = await self._api("uploading a batch file", lambda: self.client.post(
+            "/files",
+            data={"purpose": "batch"},
+            files={"file": ("batch.jsonl", data, "application/jsonl")},
+            timeout=timeout,
+        ))
+        file = msgspec_json.decode(upload.content, type=UploadedFile)
+        body = self._encoder.encode({
+            "input_file_id": file.id,
+            "endpoint": CHAT_COMPLETIONS,
+            "completion_window": self.config.batch.completion_window,
+        })
+        created = await self._api("creating a batch", lambda: self.client.post("/batches", content=body, headers=JSON_HEADERS))
+        job = msgspec_json.decode(created.content, type=BatchJob)
+
+        self.manifest.batches.append(Submitted(job.id, [custom_id(request) for request in batch]))
+        await self._save_manifest()
+        self.submitted += 1
+        self.log.info(f"Submitted batch {job.id} with {len(batch)} requests ({len(data) / 1024 / 1024:.1f}MB)")
+        return job.id
+
+    async def _poll(self, batch_id: str) -> BatchJob:
+        """Check on a batch until it's finished, waiting longer between each check."""
+        delay = self.config.batch.poll_interval
+        status = None
+        while True:
+            response = await self._api(f"checking on batch {batch_id}", lambda: self.client.get(f"/batches/{batch_id}"))
+            job = msgspec_json.decode(response.content, type=BatchJob)
+            if job.status != status:
+                status = job.status
+                counts = job.request_counts
+                progress = f" ({counts.completed + counts.failed}/{counts.total} done)" if counts is not None and counts.total > 0 else ""
+                self.log.info(f"Batch {batch_id} is {status}{progress}")
+            if job.status in FINISHED:
+                return job
+            await trio.sleep(delay)
+            delay = min(delay * 2, self.config.batch.poll_max)
+
+    async def _download(self, file_id: str) -> list[ResultLine]:
+        response = await self._api(
+            f"downloading {file_id}",
+            lambda: self.client.get(f"/files/{file_id}/content", timeout=self.config.batch.upload_timeout),
+        )
+        decoder = msgspec_json.Decoder(ResultLine)
+        return [decoder.decode(line) for line in response.content.splitlines() if line.strip()]
+
+    def _answer(self, request: Request, line: ResultLine) -> list[Request] | BaseException:
+        """The samples a result line answers `request` with, or why it didn't."""
+        if line.error is not None:
+            return RuntimeError(line.error.message or line.error.code or "Batch request failed")
+        if line.response is None:
+            return RuntimeError("Batch result has no response")
+        # Rebuilt as the response a live call would have got, so errors are classified the same way
+        response = httpx.Response(
+            line.response.status_code,
+            content=bytes(line.response.body),
+            request=httpx.Request("POST", CHAT_COMPLETIONS),
+        )
+        try:
+            return request.with_completion(decode_completion(response.raise_for_status().content))
+        except Exception as e:
+            return e
+
+    async def _results(self, batch_id: str) -> tuple[BatchJob, list[ResultLine]] | None:
+        """Wait for a batch to finish and download its results, or None if it can't be reached.
+
+        A batch that can't be checked on may still be running, and sending
+        its requests again would pay for them twice, so it's polled again
+        after `poll_max` until it gives an answer or the attempts run out.
+        Only a batch the API says doesn't exist is given up on straight
+        away, and that raises.
+        """
+        failures = 0
+        while True:
+            try:
+                job = await self._poll(batch_id)
+                lines: list[ResultLine] = []
+                for file_id in (job.output_file_id, job.error_file_id):
+                    if file_id is not None:
+                        lines += await self._download(file_id)
+                return job, lines
+            except Exception as e:
+                failures += 1
+                if classify_error(e) == ErrorClass.TERMINAL:
+                    raise
+                if failures >= self.config.retry.max_attempts:
+                    self.log.error(f"Lost track of batch {batch_id}, resume the run to pick it back up: {describe_error(e)}")
+                    return None
+                self.log.error(f"Can't reach batch {batch_id}, checking again in {self.config.batch.poll_max:.1f}s: {describe_error(e)}")
+                await trio.sleep(self.config.batch.poll_max)
+
+    async def _collect(self, batch_id: str, batch: list[Request], retry: list[Request]) -> None:
+        """Wait for a batch, then route each of its requests to the output, another round, or the dead letters."""
+        by_id = {custom_id(request): request for request in batch}
+        samples: list[Request] = []
+        try:
+            results = await self._results(batch_id)
+        except Exception as e:
+            # The batch is gone, so nothing in it was tried and all of it can go in the next one
+            self.log.error(f"Batch {batch_id} is gone, sending its {len(batch)} request(s) again: {describe_error(e)}")
+            retry += batch
+            await self._mark_collected(batch_id)
+            return
+        if results is None:
+            # Left uncollected in the manifest, so it's neither sent again nor given up on
+            self.unreachable += 1
+            return
+        job, lines = results
+        for line in lines:
+            request = by_id.pop(line.custom_id, None)
+            if request is None:
+                continue
+            answer = self._answer(request, line)
+            if isinstance(answer, BaseException):
+                await self._fail(request, answer, retry)
+                continue
+            samples += answer
+            # The backend ignored `n`, so ask for the rest of the samples one at a time
+            for index in range(len(answer), request.sample_count()):
+                retry.append(structs.replace(request, n=None, sample_index=index))
+        leftover = RuntimeError(describe_batch_error(job))
+        for request in by_id.values():
+            await self._fail(request, leftover, retry)
+
+        completed: list[Request] = []
+        for start in range(0, len(samples), self.verify_batch_size):
+            chunk = samples[start:start + self.verify_batch_size]
+            for sample, failure in zip(chunk, await self.verifier.verify(chunk)):
+                if failure is None:
+                    completed.append(sample)
+                else:
+                    await self._fail(sample.discard_response(), VerificationFailed(failure), retry)
+        await self._write(completed)
+        await self._mark_collected(batch_id)
+
+    async def _mark_collected(self, batch_id: str) -> None:
+        for submitted in self.manifest.batches:
+            if submitted.id == batch_id:
+                submitted.collected = True
+        await self._save_manifest()
+
+    async def _fail(self, request: Request, error: BaseException, retry: list[Request]) -> None:
+        if isinstance(error, VerificationFailed):
+            request = structs.replace(request, regenerations=request.regenerations + 1)
+        else:
+            request = structs.replace(request, attempts=request.attempts + 1)
+        # Rounds are slow enough that there's no point waiting out the backoff as well
+        if self.retry_policy.next_delay(request, error) is None:
+            await self._dead_letter(request, error)
+        else:
+            retry.append(request)
+
+    async def _dead_letter(self, request: Request, error: BaseException) -> None:
+        self.log.error(
+            f"Giving up on request after {request.attempts} failed attempt(s) and "
+            f"{request.regenerations} rejected response(s): {describe_error(error)}"
+        )
+        self.failed += request.sample_count()
+        if self.dead_writer is not None:
+            # The last rejected response counts as a regeneration that never happened
+            regenerations = request.regenerations - 1 if isinstance(error, VerificationFailed) else request.regenerations
+            letter = DeadLetter(
+                row_id=request.row_id,
+                messages=request.messages,
+                error=describe_error(error),
+                attempts=request.attempts,
+                sample_index=request.sample_index,
+                regenerations=regenerations,
+            )
+            async with self._write_lock:
+                result = await trio.to_thread.run_sync(self.dead_writer.append, [letter])
+            if result._error is not None:
+                self.log.error(f"Failed to save dead letter: {result.unwrap_err()}")
+        self._advance(request.sample_count())
+
+    async def _write(self, completed: list[Request]) -> None:
+        if self.sink is not None and self.part_rows is not None:
+            for start in range(0, len(completed), self.part_rows):
+                async with self._write_lock:
+                    result = await trio.to_thread.run_sync(self.sink.write, completed[start:start + self.part_rows])
+                if result._error is None:
+                    self.log.info(f"Checkpoint saved ({self.sink.rows_written} responses) to {self.sink.directory}")
+                else:
+                    self.log.error(f"Failed to save checkpoint: {result.unwrap_err()}")
+        self.completed += len(completed)
+        self._advance(len(completed))
+
+    def _advance(self, samples: int) -> None:
+        for _ in range(samples):
+            self.pb.next()
+        self.pb.draw()
+
+    async def _save_manifest(self) -> None:
+        if self.manifest_path is None:
+            return
+        path = self.manifest_path
+        data = self._encoder.encode(self.manifest)
+
+        def write() -> None:
+            temporary = f"{path}.tmp"
+            with open(temporary, "wb") as f:
+                f.write(data)
+            os.replace(temporary, path)
+
+        await trio.to_thread.run_sync(write)
+
+async def run_batch(
+    config: Config,
+    client: AsyncHttpClient,
+    rows: tuple[int, int] | None = None,
+    progress: ShardProgress | None = None,
+) -> Result[None]:
+    """Run the whole dataset through the batch API, in place of the live pipeline."""
+    if config.conversation is not None:
+        # Each turn would be a whole round of batches, which is just running it a turn at a time
+        return Err(ValueError("Multi-turn conversations only work with `mode = \"live\"`"))
+    log = LogBar(name="main")
+    output = config.output
+
+    completed = None
+    if output is not None and output.resume:
+        completed = load_completed_row_ids(config, config.model.samples_per_prompt).unwrap()
+        log.info(f"Resuming, skipping {len(completed)} rows that are already done")
+    requests = load_dataset(config, completed, rows).unwrap()
+    size = sum(request.sample_count() for request in requests)
+    log.info(f"Queued {size} requests for the batch API")
+
+    sink = None
+    dead_writer = None
+    if output is not None:
+        sink = OutputSink(
+            output.path,
+            output.type,
+            output.format if output.format is not None else config.data.format,
+            output.compression,
+            resume=output.resume,
+            samples=config.model.samples_per_prompt > 1,
+        )
+        dead_writer = DeadLetterWriter(dead_letter_path(output.path), resume=output.resume)
+    verification = config.verification if config.verification is not None else VerificationConfig()
+    verifier = VerificationPool(verification.checks, verification.processes, verification.vectorized)
+
+    if progress is not None:
+        progress.start(size)
+    pb = progress if progress is not None else log.pb(range(size)).subtitle("Waiting on batches")
+    if size > 0:
+        pb.draw()
+
+    runner = BatchRunner(
+        config,
+        client,
+        sink,
+        dead_writer,
+        verifier,
+        verification.batch_size,
+        RetryPolicy(config.retry, size, verification.max_regenerations),
+        log,
+        pb,
+    )
+    try:
+        await runner.run(requests, resume=output is not None and output.resume)
+    finally:
+        verifier.close()
+
+    if sink is not None:
+        if output is not None and not output.merge:
+            log.info(f"Saved {sink.rows_written} responses as parts in {sink.directory}")
+        else:
+            log.info("Merging output data...")
+            merged = await trio.to_thread.run_sync(sink.merge)
+            if merged._error is None:
+                log.info(f"Successfully saved {sink.rows_written} responses to {merged.unwrap()}")
+            else:
+                log.error(f"Failed to merge output, the parts are still in {sink.directory}: {merged.unwrap_err()}")
+
+    if runner.unreachable > 0:
+        log.error(f"{runner.unreachable} batch(es) couldn't be checked on, run again with `resume = true` to collect them")
+    if runner.failed > 0 and output is not None:
+        log.error(f"{runner.failed} request(s) failed for good, see {dead_letter_path(output.path)}")
+    log.info(f"All requests completed! {runner.completed} through {runner.submitted} batch(es)")
+    if verification.checks:
+        log.info(f"Verification: {verifier.passed} passed, {verifier.failed} failed")
+    return Ok(None)
@@ -0,0 +1,109 @@
+import hashlib
+import msgspec
+import sqlite3
+import threading
+import time
+import trio
+from msgspec import Struct
+from msgspec import json as msgspec_json
+from messages import Request, Usage
+
+class CachedResponse(Struct):
+    content: str
+    reasoning: str | None = None
+    usage: Usage | None = None
+
+class ResponseCache:
+    """On-disk cache of responses, keyed by a hash of the exact request body.
+
+    Backed by SQLite so it survives between runs. Once the stored responses
+    grow past `max_bytes`, the least recently used ones are evicted until
+    they're back under `evict_to` of the limit.
+    """
+
+    def __init__(self, path: str, model: str, max_bytes: int | None = None, evict_to: float = 0.9):
+        self.path = path
+        self.model = model
+        self.max_bytes = max_bytes
+        self.evict_to = evict_to
+        self.hits = 0
+        self.misses = 0
+        self._encoder = msgspec_json.Encoder()
+        self._decoder = msgspec_json.Decoder(list[CachedResponse])
+        # Lookups and stores run on worker threads, so share one connection behind a lock.
+        # Shards in other processes use the same file, so wait on their writes rather than failing.
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key BLOB PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.size_bytes: int = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def key(self, request: Request) -> bytes:
+        body = request._body(self.model)
+        # Fanned-out samples of a row send identical bodies, but each needs its own answer
+        if request.sample_index is not None:
+            body += f"#{request.sample_index}".encode()
+        return hashlib.sha256(body).digest()
+
+    def get(self, request: Request) -> list[Request] | None:
+        """The cached responses to `request` (one per choice), if there are any."""
+        key = self.key(request)
+        # Lookups run on worker threads, so the counters are only safe to bump under the lock
+        with self._lock:
+            row = self._db.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            try:
+                cached = self._decoder.decode(row[0]) if row is not None else None
+            except msgspec.DecodeError:
+                cached = None
+            if not cached:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return request._with_choices([(choice.content, choice.reasoning) for choice in cached], cached[0].usage)
+
+    def put(self, request: Request, responses: list[Request]) -> None:
+        """Store the responses to `request`, keyed by the body it was sent with."""
+        key = self.key(request)
+        value = self._encoder.encode([
+            CachedResponse(response.messages[-1].content, response.messages[-1].reasoning, response.usage)
+            for response in responses
+        ])
+        with self._lock:
+            previous = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            self.size_bytes += len(value) - (previous[0] if previous is not None else 0)
+            if self.max_bytes is not None and self.size_bytes > self.max_bytes:
+                self._evict(int(self.max_bytes * self.evict_to))
+
+    def _evict(self, target: int) -> None:
+        # Other processes may have stored or evicted responses since we last looked
+        self.size_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        evicted: list[tuple[bytes]] = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if self.size_bytes <= target:
+                break
+            evicted.append((key,))
+            self.size_bytes -= size
+        self._db.execute("BEGIN")
+        self._db.executemany("DELETE FROM responses WHERE key = ?", evicted)
+        self._db.execute("COMMIT")
+
+    async def lookup(self, request: Request) -> list[Request] | None:
+        return await trio.to_thread.run_sync(self.get, request)
+
+    async def store(self, request: Request, responses: list[Request]) -> None:
+        await trio.to_thread.run_sync(self.put, request, responses)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,71 @@
+from msgspec import Struct, UNSET, UnsetType
+from msgspec import json as msgspec_json
+
+# Wire formats for /chat/completions. Only the fields we use are declared,
+# so everything else in a response is skipped over while decoding instead
+# of being built into dicts.
+
+class Usage(Struct):
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+
+class Message(Struct, omit_defaults=True):
+    role: str
+    content: str
+    reasoning: str | None = None
+
+class StreamOptions(Struct):
+    include_usage: bool = True
+
+class ChatRequestBody(Struct):
+    """Fields are in alphabetical order, so the bytes match a key-sorted encoding of the same request."""
+    max_tokens: int | None
+    messages: list[Message]
+    model: str
+    n: int | UnsetType = UNSET
+    stream: bool | UnsetType = UNSET
+    stream_options: StreamOptions | UnsetType = UNSET
+    temperature: float | None = None
+    top_p: float | None = None
+
+class ResponseMessage(Struct):
+    content: str | None = None
+    reasoning_content: str | None = None
+    reasoning: str | None = None # what some servers call `reasoning_content`
+
+class Choice(Struct):
+    message: ResponseMessage
+    index: int = 0
+
+class ChatCompletion(Struct):
+    choices: list[Choice]
+    usage: Usage | None = None
+
+class Delta(Struct):
+    content: str | None = None
+    reasoning_content: str | None = None
+    reasoning: str | None = None
+
+class ChunkChoice(Struct):
+    index: int = 0
+    delta: Delta | None = None
+    finish_reason: str | None = None
+
+class ChatCompletionChunk(Struct):
+    choices: list[ChunkChoice] = []
+    usage: Usage | None = None
+
+# `order="sorted"` also sorts the fields of the `Message`s inside, keeping request bodies byte-for-byte stable
+_encoder = msgspec_json.Encoder(order="sorted")
+_completion_decoder = msgspec_json.Decoder(ChatCompletion)
+_chunk_decoder = msgspec_json.Decoder(ChatCompletionChunk)
+
+def encode_body(body: ChatRequestBody) -> bytes:
+    return _encoder.encode(body)
+
+def decode_completion(data: bytes) -> ChatCompletion:
+    return _completion_decoder.decode(data)
+
+def decode_chunk(data: bytes | str) -> ChatCompletionChunk:
+    return _chunk_decoder.decode(data)
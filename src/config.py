@@ -1,5 +1,5 @@
 import msgspec
-from msgspec import Struct
+from msgspec import Struct, field
 from typing import Self
 from result import Result
 from enum import Enum
@@ -13,31 +13,181 @@ class DataFormat(Enum):
     MESSAGES_COLUMN = "messages_column"
     PROMPT_COLUMN = "prompt_column"
 
-class APIConfig(Struct):
+class Compression(Enum):
+    ZSTD = "zstd"
+    GZIP = "gzip"
+    NONE = "none"
+
+class MetricsFormat(Enum):
+    PROMETHEUS = "prometheus"
+    JSON = "json"
+
+class Mode(Enum):
+    LIVE = "live"
+    BATCH = "batch"
+
+class FollowUp(Enum):
+    TEMPLATE = "template"
+    COLUMN = "column"
+    MODEL = "model"
+
+class Routing(Enum):
+    LEAST_OUTSTANDING = "least_outstanding"
+    LATENCY = "latency"
+
+class EndpointConfig(Struct):
     base_url: str
+    weight: float = 1.0 # share of traffic relative to the other endpoints
+    max_concurrency: int | None = None # requests in flight to this endpoint, None for no cap
+
+class Schedule(Enum):
+    FILE = "file"
+    PREFIX = "prefix"
+    LONGEST_FIRST = "longest_first"
+    SHORTEST_FIRST = "shortest_first"
+
+class APIConfig(Struct):
     model: str
     api_key: str
+    mode: Mode = Mode.LIVE # or submit everything through the batch API, see [batch]
+    base_url: str | None = None # or list several replicas in [[api.endpoints]]
+    endpoints: list[EndpointConfig] = []
+    routing: Routing = Routing.LEAST_OUTSTANDING
+    eject_after: int = 3 # consecutive failures before an endpoint is taken out of rotation...
+    eject_for: float = 30.0 # ...for this many seconds
+    timeout: float = 30.0
+    http2: bool = False
+    max_connections: int | None = None # defaults to processes.parallel
+    max_keepalive_connections: int | None = None # defaults to max_connections
+    keepalive_expiry: float = 5.0
+    stream: bool = False # consume responses as server-sent events, recording TTFT and tokens/sec
+    idle_timeout: float = 60.0 # seconds between streamed chunks before giving up
+    use_n: bool = True # ask for all of a row's samples in one call, falling back to one call each if that's ignored
+    requests_per_minute: int | None = None
+    tokens_per_minute: int | None = None
 
 class ModelConfig(Struct):
     system_prompt: str | None = None
     temperature: float | None = None
     top_p: float | None = None
+    max_tokens: int | None = None
+    samples_per_prompt: int = 1
 
 class DataConfig(Struct):
     path: str
     type: DataType
     format: DataFormat
     limit: int | None = None
+    streaming: bool = False # read the dataset lazily instead of loading it all up front
+    batch_size: int = 1024 # rows read per batch when streaming
+    schedule: Schedule = Schedule.FILE # order requests are sent in: "prefix" groups ones that share a prompt prefix, "longest_first"/"shortest_first" go by prompt length
+    prefix_chars: int = 1024 # with prompt_column, how much of the prompt counts as its prefix
 
 class ProcessesConfig(Struct):
     parallel: int
     verify_parallel: int | None = None
+    queue_size: int | None = None # bound on the verify/output queues, defaults to 2 * parallel
+    adaptive: bool = False # treat `parallel` as a ceiling and find the best concurrency below it
+    initial_parallel: int | None = None # where adaptive concurrency starts, defaults to min_parallel
+    min_parallel: int = 1
+    latency_tolerance: float | None = 3.0 # back off when latency exceeds this multiple of normal, None to disable
 
 class OutputConfig(Struct):
     path: str
     type: DataType
     format: DataFormat | None = None
-    checkpoint_interval: int | None = None
+    part_rows: int = 10_000 # completed rows per part file written while the run goes
+    checkpoint_interval: int | None = None # older name for `part_rows`, used instead of it if set
+    compression: Compression | None = None # zstd for parquet, none for jsonl (which can only do gzip)
+    merge: bool = True # merge the part files into `path` at the end, otherwise leave them as the output
+    resume: bool = False # skip rows already in the output/checkpoint from an earlier run
+
+class RetryConfig(Struct):
+    max_attempts: int = 5 # per request, including the first try
+    backoff_base: float = 0.5 # seconds
+    backoff_max: float = 60.0 # seconds
+    budget_ratio: float = 0.2 # retries allowed across the run, as a fraction of total requests...
+    budget_min: int = 100 # ...plus this many
+
+class CacheConfig(Struct):
+    path: str # SQLite database, created if it doesn't exist
+    max_size_mb: float | None = None # evict least recently used responses past this, None for unbounded
+    bypass: bool = False # always send requests, still storing the fresh responses
+
+class HedgeConfig(Struct):
+    percentile: float = 0.95 # hedge requests that have been out longer than this percentile of recent latencies
+    max_ratio: float = 0.1 # hedges allowed, as a fraction of requests sent
+    min_samples: int = 50 # latencies to collect before hedging on them
+    when_idle: bool = True # also hedge whatever's in flight once the input runs dry
+
+class LengthCheck(Struct, tag="length"):
+    min_chars: int | None = None
+    max_chars: int | None = None
+
+class RegexCheck(Struct, tag="regex"):
+    pattern: str
+    must_match: bool = True # false to reject responses the pattern is found in instead
+    ignore_case: bool = False
+
+class SubstringCheck(Struct, tag="contains"):
+    substrings: list[str] # every one of these has to be in the response
+    ignore_case: bool = False
+
+class DuplicateCheck(Struct, tag="duplicate"):
+    normalize: bool = True # ignore case, punctuation and whitespace, so near-identical responses count too
+
+class JsonCheck(Struct, tag="json"):
+    strip_fences: bool = True # accept JSON wrapped in a ```json code block
+
+class RefusalCheck(Struct, tag="refusal"):
+    phrases: list[str] | None = None # defaults to a list of common refusals
+    within_chars: int = 200 # only look this far into the response
+
+class CustomCheck(Struct, tag="custom"):
+    function: str # "module:function", called with each finished `Request` and returning None or why it failed
+
+# One entry under `[[verification.checks]]`, picked by its `type`
+Check = LengthCheck | RegexCheck | SubstringCheck | DuplicateCheck | JsonCheck | RefusalCheck | CustomCheck
+
+class VerificationConfig(Struct):
+    checks: list[Check] = field(default_factory=list)
+    processes: int | None = None # worker processes to run checks in, defaults to the CPU count. 0 runs them on a thread instead
+    batch_size: int = 256 # most responses sent to a process at once
+    max_regenerations: int = 3 # times a row is regenerated after failing verification, separate from retries
+    vectorized: bool = False # check whole batches at once as polars expressions, on a thread instead of the pool
+
+class MetricsConfig(Struct):
+    path: str # rewritten every `interval` seconds with the latest numbers
+    format: MetricsFormat = MetricsFormat.PROMETHEUS
+    interval: float = 10.0 # seconds
+
+class BatchConfig(Struct):
+    max_requests: int = 50_000 # lines per batch input file
+    max_bytes: int = 200 * 1024 * 1024 # size of each batch input file
+    completion_window: str = "24h"
+    poll_interval: float = 10.0 # seconds before checking on a batch the first time...
+    poll_max: float = 300.0 # ...doubling each time up to this
+    upload_timeout: float = 600.0 # seconds for uploading or downloading a whole file
+
+DEFAULT_USER_PROMPT = (
+    "You are the user in this conversation, talking to an AI assistant. "
+    "Write your next message to it, and nothing else."
+)
+
+class ConversationConfig(Struct):
+    turns: int = 2 # responses per conversation, the first one included
+    follow_up: FollowUp = FollowUp.TEMPLATE # where the user's next message comes from
+    template: str = "Tell me more." # with "template", formatted with {response} (the last reply) and {turn} (the user turn it is, from 2)
+    column: str = "follow_ups" # with "column", a dataset column holding a list of the user's later messages per row
+    model: str | None = None # with "model", the model playing the user, defaults to api.model...
+    base_url: str | None = None # ...served from here, defaults to the first endpoint
+    system_prompt: str = DEFAULT_USER_PROMPT # tells the model playing the user what it's doing
+    temperature: float | None = None
+    max_tokens: int | None = None
+
+class TraceConfig(Struct):
+    path: str # Chrome trace-event JSON, for ui.perfetto.dev or chrome://tracing
+    interval: float = 5.0 # seconds between writing buffered spans out
 
 class Config(Struct):
     api: APIConfig
@@ -45,6 +195,14 @@ class Config(Struct):
     data: DataConfig
     processes: ProcessesConfig
     output: OutputConfig | None = None
+    retry: RetryConfig = field(default_factory=RetryConfig)
+    cache: CacheConfig | None = None
+    hedge: HedgeConfig | None = None
+    verification: VerificationConfig | None = None
+    metrics: MetricsConfig | None = None
+    trace: TraceConfig | None = None
+    batch: BatchConfig = field(default_factory=BatchConfig)
+    conversation: ConversationConfig | None = None # generate multi-turn conversations instead of single replies
 
     @Result.resultify
     @staticmethod
@@ -0,0 +1,88 @@
+import trio
+from msgspec import structs
+from config import Config, ConversationConfig, DataFormat, FollowUp
+from http_client import AsyncHttpClient
+from messages import Message, Request
+from result import is_ok
+from retry import RetryPolicy
+
+class FollowUps:
+    """Writes the user's side of multi-turn conversations, one message at a time.
+
+    Once a response has been verified, `next_message` comes up with what
+    the user says to it: a `template` filled in with the response, the
+    next entry of the row's follow-up `column`, or a reply from a second
+    `model` playing the user. `continue_with` appends it, and the
+    conversation goes back on the input queue with the rest, so later
+    turns of some conversations overlap with earlier turns of others.
+    """
+
+    def __init__(self, config: Config, client: AsyncHttpClient | None, retry_policy: RetryPolicy):
+        conversation = config.conversation if config.conversation is not None else ConversationConfig()
+        self.config = conversation
+        self.client = client
+        self.model = conversation.model if conversation.model is not None else config.api.model
+        self.retry_policy = retry_policy
+        if conversation.turns < 1:
+            raise ValueError("`turns` in [conversation] has to be at least 1")
+        if conversation.follow_up == FollowUp.MODEL and client is None:
+            raise ValueError("Follow-ups from a model need a client to reach it with")
+        output_format = config.output.format if config.output is not None and config.output.format is not None else config.data.format
+        if config.output is not None and output_format != DataFormat.MESSAGES_COLUMN:
+            # `prompt_column` only has room for the first prompt and response
+            raise ValueError('Multi-turn conversations need `format = "messages_column"` in [output]')
+        # A typo in the template should stop the run now, not fail every conversation later
+        if conversation.follow_up == FollowUp.TEMPLATE:
+            conversation.template.format(response="", turn=2)
+
+    def wants_more(self, request: Request) -> bool:
+        """Whether the conversation this response ends has turns left to go."""
+        return request.turn + 1 < self.config.turns
+
+    async def next_message(self, request: Request) -> str | None:
+        """What the user says next, or None if the conversation ends here. Raises if the model playing the user can't be reached."""
+        match self.config.follow_up:
+            case FollowUp.TEMPLATE:
+                return self.config.template.format(response=request.messages[-1].content, turn=request.turn + 2)
+            case FollowUp.COLUMN:
+                follow_ups = request.follow_ups or []
+                return follow_ups[request.turn] if request.turn < len(follow_ups) else None
+            case FollowUp.MODEL:
+                return await self._ask_model(request)
+            case _:
+                raise ValueError(f"Invalid follow-up: {self.config.follow_up}")
+
+    async def _ask_model(self, request: Request) -> str:
+        assert self.client is not None
+        # Seen from the other side, so the model playing the user answers the assistant's last reply
+        messages = [Message(role="system", content=self.config.system_prompt)] + [
+            Message(role="assistant" if message.role == "user" else "user", content=message.content)
+            for message in request.messages
+            if message.role in ("user", "assistant")
+        ]
+        simulated = Request(messages=messages, temperature=self.config.temperature, max_tokens=self.config.max_tokens)
+        while True:
+            response = await simulated.req(self.client, self.model)
+            if is_ok(response):
+                return response.unwrap()[0].messages[-1].content
+            error = response.unwrap_err()
+            simulated = structs.replace(simulated, attempts=simulated.attempts + 1)
+            delay = self.retry_policy.next_delay(simulated, error)
+            if delay is None:
+                raise error
+            await trio.sleep(delay)
+
+    @staticmethod
+    def continue_with(request: Request, content: str) -> Request:
+        """The conversation with the user's next message on the end, as a fresh request for the reply to it."""
+        return structs.replace(
+            request,
+            messages=request.messages + [Message(role="user", content=content)],
+            turn=request.turn + 1,
+            usage=None,
+            timings=None,
+            attempts=0,
+            regenerations=0,
+            # The prompt's grown, so the estimate from loading the dataset no longer holds
+            estimated_tokens=None,
+        )
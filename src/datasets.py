@@ -1,12 +1,19 @@
+import io
 import polars as pl
+import msgspec
+from msgspec import structs
+from itertools import islice
+from typing import Iterator
 from result import Result, Err, Ok, is_err
-from config import DataType, DataFormat, Config
-from messages import Request, Message
+from config import DataType, DataFormat, DataConfig, Config, FollowUp, Schedule
+from messages import Request, Message, ROW_ID_COLUMN
+
+def hf_parquet_path(path: str) -> str:
+    return f"hf://datasets/{path}@refs%2Fconvert%2Fparquet/**/*.parquet"
 
 @Result.resultify
 def load_hf_dataset(path: str) -> pl.DataFrame:
-    path_string = f"hf://datasets/{path}@refs%2Fconvert%2Fparquet/**/*.parquet"
-    return pl.read_parquet(path_string)
+    return pl.read_parquet(hf_parquet_path(path))
 
 @Result.resultify
 def load_jsonl_dataset(path: str) -> pl.DataFrame:
@@ -16,28 +23,99 @@ def load_jsonl_dataset(path: str) -> pl.DataFrame:
 def load_parquet_dataset(path: str) -> pl.DataFrame:
     return pl.read_parquet(path)
 
+def estimated_tokens(config: Config) -> pl.Expr:
+    """Vectorized version of `Request.estimate_prompt_tokens`, so it costs nothing per request."""
+    match config.data.format:
+        case DataFormat.MESSAGES_COLUMN:
+            content = pl.element().struct.field("content").str.len_chars()
+            estimate = pl.col("messages").list.eval(content // 4 + 4).list.sum()
+        case DataFormat.PROMPT_COLUMN:
+            estimate = pl.col("prompt").str.len_chars() // 4 + 4
+        case _:
+            raise ValueError(f"Invalid dataset format: {config.data.format}")
+    if config.model.system_prompt is not None:
+        estimate = estimate + len(config.model.system_prompt) // 4 + 4
+    return estimate.fill_null(0).cast(pl.Int64)
+
 @Result.resultify
 def convert_to_request(df: pl.DataFrame, config: Config) -> list[Request]:
     format = config.data.format
     system_prompt = config.model.system_prompt
+    row_ids = df[ROW_ID_COLUMN].to_list()
+    estimates = df.select(estimated_tokens(config)).to_series().to_list()
     
     match format:
         case DataFormat.MESSAGES_COLUMN:
-            # FIXME: won't work, we need to convert the list of dicts a proper Message[]
+            conversations = msgspec.convert(df["messages"].to_list(), list[list[Message]])
             if system_prompt is not None:
-                return [Request(messages=([Message(role="system", content=system_prompt)] + messages), temperature=config.model.temperature, top_p=config.model.top_p) for messages in df["messages"].to_list()]
+                requests = [Request(messages=([Message(role="system", content=system_prompt)] + messages), row_id=row_id, temperature=config.model.temperature, top_p=config.model.top_p, max_tokens=config.model.max_tokens, estimated_tokens=estimate) for row_id, messages, estimate in zip(row_ids, conversations, estimates)]
             else:
-                return [Request(messages=messages, temperature=config.model.temperature, top_p=config.model.top_p) for messages in df["messages"].to_list()]
+                requests = [Request(messages=messages, row_id=row_id, temperature=config.model.temperature, top_p=config.model.top_p, max_tokens=config.model.max_tokens, estimated_tokens=estimate) for row_id, messages, estimate in zip(row_ids, conversations, estimates)]
         case DataFormat.PROMPT_COLUMN:
             if system_prompt is not None:
-                return [Request(messages=[Message(role="system", content=system_prompt), Message(role="user", content=prompt)], temperature=config.model.temperature, top_p=config.model.top_p) for prompt in df["prompt"].to_list()]
+                requests = [Request(messages=[Message(role="system", content=system_prompt), Message(role="user", content=prompt)], row_id=row_id, temperature=config.model.temperature, top_p=config.model.top_p, max_tokens=config.model.max_tokens, estimated_tokens=estimate) for row_id, prompt, estimate in zip(row_ids, df["prompt"].to_list(), estimates)]
             else:
                 # FIXME: we should support a `system_prompt` column
-                return [Request(messages=[Message(role="user", content=prompt)], temperature=config.model.temperature, top_p=config.model.top_p) for prompt in df["prompt"].to_list()]
+                requests = [Request(messages=[Message(role="user", content=prompt)], row_id=row_id, temperature=config.model.temperature, top_p=config.model.top_p, max_tokens=config.model.max_tokens, estimated_tokens=estimate) for row_id, prompt, estimate in zip(row_ids, df["prompt"].to_list(), estimates)]
         case _:
             raise ValueError(f"Invalid dataset format: {format}")
 
-def load_dataset(config: Config) -> Result[list[Request]]:
+    conversation = config.conversation
+    if conversation is not None and conversation.follow_up == FollowUp.COLUMN:
+        follow_ups = msgspec.convert(df[conversation.column].to_list(), list[list[str | None] | None])
+        requests = [structs.replace(request, follow_ups=messages) for request, messages in zip(requests, follow_ups)]
+    return requests
+
+def expand_samples(requests: list[Request], config: Config) -> list[Request]:
+    """Turn each row's request into the ones needed for `samples_per_prompt` samples of it."""
+    samples = config.model.samples_per_prompt
+    if samples <= 1:
+        return requests
+    if config.api.use_n:
+        return [structs.replace(request, n=samples) for request in requests]
+    return [structs.replace(request, sample_index=index) for request in requests for index in range(samples)]
+
+def prefix_keys(data: DataConfig) -> list[pl.Expr]:
+    """Hashes of each row's prompt prefix, coarsest first, so sorting on them keeps shared prefixes together.
+
+    For conversations the prefix is every message but the last, keyed first on
+    the opening message (usually the system prompt) and then on the whole
+    prefix. For bare prompts it's the first `prefix_chars` characters.
+    """
+    match data.format:
+        case DataFormat.MESSAGES_COLUMN:
+            messages = pl.col("messages")
+            # Hashing each message and then the list of hashes avoids building the joined prefix strings
+            prefix = messages.list.head(messages.list.len() - 1).list.eval(pl.element().hash())
+            return [
+                messages.list.first().hash().alias("_first_message_hash"),
+                prefix.hash().alias("_prefix_hash"),
+            ]
+        case DataFormat.PROMPT_COLUMN:
+            return [pl.col("prompt").str.slice(0, data.prefix_chars).hash().alias("_prefix_hash")]
+        case _:
+            raise ValueError(f"Invalid dataset format: {data.format}")
+
+def schedule_dataframe(df: pl.DataFrame, data: DataConfig) -> pl.DataFrame:
+    """Reorder rows into the order their requests should be sent in."""
+    match data.schedule:
+        case Schedule.FILE | Schedule.LONGEST_FIRST | Schedule.SHORTEST_FIRST:
+            # Length-based schedules are applied by the input queue, so they also cover retries
+            return df
+        case Schedule.PREFIX:
+            # The sort is stable, so rows sharing a prefix keep their file order
+            keys = prefix_keys(data)
+            return df.with_columns(keys).sort([key.meta.output_name() for key in keys], maintain_order=True).select(df.columns)
+        case _:
+            raise ValueError(f"Invalid schedule: {data.schedule}")
+
+def drop_completed(df: pl.DataFrame, completed: pl.Series | None) -> pl.DataFrame:
+    """Remove rows whose row ID is already in the `completed` index."""
+    if completed is None or len(completed) == 0:
+        return df
+    return df.filter(~pl.col(ROW_ID_COLUMN).is_in(completed.implode()))
+
+def load_dataset(config: Config, completed: pl.Series | None = None, rows: tuple[int, int] | None = None) -> Result[list[Request]]:
     path = config.data.path
     type = config.data.type
     
@@ -54,87 +132,103 @@ def load_dataset(config: Config) -> Result[list[Request]]:
     if is_err(ds):
         return Err(ds.unwrap_err())
         
-    df = ds.unwrap()
+    df = ds.unwrap().with_row_index(ROW_ID_COLUMN)
 
     if config.data.limit is not None and config.data.limit > 0:
         limit = min(config.data.limit, len(df))
         df = df.slice(0, limit)
 
-    return convert_to_request(df, config)
+    # Row IDs are assigned first, so they stay global when only a range is processed
+    if rows is not None:
+        df = df.slice(rows[0], rows[1] - rows[0])
 
-@Result.resultify
-def convert_requests_to_dataframe(requests: list[Request], format: DataFormat) -> pl.DataFrame:
-    """Convert a list of Request objects back to DataFrame format"""
-    match format:
-        case DataFormat.MESSAGES_COLUMN:
-            # Convert messages to list of dicts for each request
-            data: list[dict] = []
-            for request in requests:
-                messages_dict = [
-                    {
-                        "role": msg.role,
-                        "content": msg.content,
-                        "reasoning": msg.reasoning
-                    }
-                    for msg in request.messages if msg.content != None
-                ]
-                data.append({"messages": messages_dict})
-            print(data[0])
-            return pl.DataFrame(data)
-        case DataFormat.PROMPT_COLUMN:
-            # Extract prompts and responses
-            data: list[dict] = []
-            for request in requests:
-                # Find the user prompt (skip system message if present)
-                prompt: str | None = None
-                response: str | None = None
-                reasoning: str | None = None
-                
-                for msg in request.messages:
-                    if msg.role == "user" and prompt is None:
-                        prompt = msg.content
-                    elif msg.role == "assistant":
-                        response = msg.content
-                        reasoning = msg.reasoning
-                        break
-                
-                row = {"prompt": prompt, "response": response, "reasoning": reasoning}
-                data.append(row)
-            return pl.DataFrame(data)
+    requests = convert_to_request(schedule_dataframe(drop_completed(df, completed), config.data), config)
+    if requests._error is not None:
+        return requests
+    return Ok(expand_samples(requests.unwrap(), config))
+
+def scan_dataset(config: Config) -> pl.LazyFrame:
+    path = config.data.path
+
+    match config.data.type:
+        case DataType.HF:
+            return pl.scan_parquet(hf_parquet_path(path))
+        case DataType.JSONL:
+            return pl.scan_ndjson(path)
+        case DataType.PARQUET:
+            return pl.scan_parquet(path)
         case _:
-            raise ValueError(f"Invalid output format: {format}")
+            raise ValueError(f"Invalid dataset type: {config.data.type}")
 
 @Result.resultify
-def save_dataframe(df: pl.DataFrame, path: str, type: DataType) -> None:
-    """Save a DataFrame to the specified path and format"""
-    match type:
+def dataset_size(config: Config) -> int:
+    """Count the dataset's rows (up to `limit`) without loading it."""
+    count = scan_dataset(config).select(pl.len()).collect().item()
+    if config.data.limit is not None and config.data.limit > 0:
+        count = min(config.data.limit, count)
+    return count
+
+@Result.resultify
+def count_dataset_rows(config: Config, completed: pl.Series | None = None, rows: tuple[int, int] | None = None) -> int:
+    """Count the rows that will be processed without loading the dataset."""
+    start, end = rows if rows is not None else (0, dataset_size(config).unwrap())
+    count = end - start
+    if completed is not None:
+        count -= completed.filter((completed >= start) & (completed < end)).n_unique()
+    return count
+
+def iter_jsonl_batches(path: str, batch_size: int, skip: int = 0) -> Iterator[pl.DataFrame]:
+    # Slicing a `scan_ndjson` re-parses the file from the start every time,
+    # so read the lines ourselves to keep each batch O(batch_size)
+    with open(path, "rb") as f:
+        # Skipped lines only need splitting, not parsing
+        while skip > 0 and (line := f.readline()):
+            if line.strip():
+                skip -= 1
+        while True:
+            lines = [line for line in islice(f, batch_size) if line.strip()]
+            if not lines:
+                return
+            yield pl.read_ndjson(io.BytesIO(b"".join(lines)))
+
+def iter_parquet_batches(lf: pl.LazyFrame, batch_size: int, skip: int = 0) -> Iterator[pl.DataFrame]:
+    # Slices are pushed down into the parquet reader, which skips whole row groups
+    offset = skip
+    while True:
+        df = lf.slice(offset, batch_size).collect()
+        if len(df) == 0:
+            return
+        yield df
+        offset += len(df)
+
+def iter_dataset(
+    config: Config,
+    batch_size: int,
+    completed: pl.Series | None = None,
+    rows: tuple[int, int] | None = None,
+) -> Iterator[list[Request]]:
+    """Lazily read the dataset, yielding `Request`s `batch_size` rows at a time."""
+    path = config.data.path
+    offset = rows[0] if rows is not None else 0
+
+    match config.data.type:
+        case DataType.HF | DataType.PARQUET:
+            batches = iter_parquet_batches(scan_dataset(config), batch_size, skip=offset)
         case DataType.JSONL:
-            df.write_ndjson(path)
-        case DataType.PARQUET:
-            df.write_parquet(path)
-        case DataType.HF:
-            # For HF, we'll save as parquet locally
-            # TODO: Could implement actual HF dataset push later
-            parquet_path = path.replace('.hf', '.parquet') if path.endswith('.hf') else f"{path}.parquet"
-            df.write_parquet(parquet_path)
+            batches = iter_jsonl_batches(path, batch_size, skip=offset)
         case _:
-            raise ValueError(f"Invalid output type: {type}")
+            raise ValueError(f"Invalid dataset type: {config.data.type}")
 
-def save_requests(requests: list[Request], config: Config) -> Result[None]:
-    """Convert requests to DataFrame and save to file"""
-    if config.output is None:
-        return Err(ValueError("No output configuration provided"))
-    
-    # Use output format if specified, otherwise fall back to input format
-    output_format = config.output.format if config.output.format is not None else config.data.format
-    
-    df_result = convert_requests_to_dataframe(requests, output_format)
-    if is_err(df_result):
-        return Err(df_result.unwrap_err())
-    
-    df = df_result.unwrap()
-    save_result = save_dataframe(df, config.output.path, config.output.type)
-    if is_err(save_result):
-        return Err(save_result.unwrap_err())
-    
-    return Ok(None)
+    end = rows[1] if rows is not None else config.data.limit if config.data.limit is not None and config.data.limit > 0 else None
+    remaining = end - offset if end is not None else None
+    for df in batches:
+        if remaining is not None:
+            df = df.slice(0, remaining)
+            remaining -= len(df)
+        df = df.with_row_index(ROW_ID_COLUMN, offset=offset)
+        offset += len(df)
+        # Only rows within the same batch can be reordered
+        requests = convert_to_request(schedule_dataframe(drop_completed(df, completed), config.data), config).unwrap()
+        yield expand_samples(requests, config)
+        if remaining is not None and remaining <= 0:
+            return
@@ -0,0 +1,131 @@
+import trio
+from msgspec import structs
+from balancer import Balancer
+from limiter import AdaptiveLimiter, RateLimiter
+from cache import ResponseCache
+from hedging import Hedger
+from metrics import Metrics
+from tracing import Tracer
+from messages import Request
+from config import Config
+from result import Result, Ok, is_ok
+
+class Dispatcher:
+    """Sends requests to the API through whatever flow control is configured."""
+
+    def __init__(
+        self,
+        balancer: Balancer,
+        config: Config,
+        limiter: AdaptiveLimiter | None = None,
+        rate_limiter: RateLimiter | None = None,
+        cache: ResponseCache | None = None,
+        hedger: Hedger | None = None,
+        metrics: Metrics | None = None,
+        tracer: Tracer | None = None,
+    ):
+        self.balancer = balancer
+        self.config = config
+        self.limiter = limiter
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.hedger = hedger
+        self.metrics = metrics
+        self.tracer = tracer
+        self.n_supported = True # until the backend answers a request for `n` choices with fewer
+
+    async def send(self, request: Request) -> Result[list[Request]]:
+        """Send a request, getting back one response per sample.
+
+        Fewer responses than `request.n` means the backend doesn't support `n`,
+        and it's up to the caller to fan the missing samples out.
+        """
+        if request.n is not None and not self.n_supported:
+            request = structs.replace(request, n=None, sample_index=0)
+        start = trio.current_time()
+        response = await self._cached_send(request)
+        if self.metrics is not None:
+            self.metrics.send.record(trio.current_time() - start)
+        if is_ok(response) and request.n is not None and len(response.unwrap()) < request.n:
+            self.n_supported = False
+        return response
+
+    async def _cached_send(self, request: Request) -> Result[list[Request]]:
+        if self.cache is None:
+            return await self._hedged_send(request)
+
+        # A retry or regeneration means the last response was no good (possibly
+        # a cached one that failed verification), so those always go to the API
+        use_cached = request.attempts == 0 and request.regenerations == 0 and not (self.config.cache is not None and self.config.cache.bypass)
+        if use_cached and (cached := await self.cache.lookup(request)) is not None:
+            return Ok(cached)
+
+        response = await self._hedged_send(request)
+        if is_ok(response):
+            await self.cache.store(request, response.unwrap())
+        return response
+
+    async def _hedged_send(self, request: Request) -> Result[list[Request]]:
+        if self.hedger is None:
+            return await self._limited_send(request)
+        # Hedges go through the same limits as everything else, so they can't blow through a quota
+        return await self.hedger.run(lambda: self._limited_send(request))
+
+    async def _limited_send(self, request: Request) -> Result[list[Request]]:
+        if self.rate_limiter is None:
+            return await self._send(request)
+
+        charged = request.estimate_prompt_tokens() + (request.max_tokens or 0) * request.sample_count()
+        start = trio.current_time()
+        await self.rate_limiter.acquire(charged)
+        if self.tracer is not None:
+            self.tracer.wait("rate_limit", start, trio.current_time())
+        # A hedge that loses is cancelled partway through the call, by which
+        # point the server has most likely read the prompt and little else
+        actual = request.estimate_prompt_tokens()
+        try:
+            response = await self._send(request)
+            # Failed calls generally aren't billed, so hand their tokens back. If
+            # the server doesn't report usage, the estimate is the best we have.
+            actual = 0
+            if is_ok(response):
+                usages = [sample.usage for sample in response.unwrap() if sample.usage is not None]
+                actual = sum(usage.total_tokens for usage in usages) if usages else charged
+        finally:
+            self.rate_limiter.reconcile(charged, actual)
+        return response
+
+    async def _call(self, request: Request) -> Result[list[Request]]:
+        api = self.config.api
+        waited = trio.current_time()
+        async with self.balancer.slot() as endpoint:
+            start = trio.current_time()
+            if api.stream:
+                response = await request.req_stream(endpoint.client, api.model, api.timeout, api.idle_timeout)
+            else:
+                response = await request.req(endpoint.client, api.model)
+            elapsed = trio.current_time() - start
+            self.balancer.record(endpoint, response, elapsed)
+        if self.tracer is not None:
+            self.tracer.wait("endpoint_slot", waited, start)
+            # Includes waiting on the endpoint's connection pool
+            self.tracer.wait("http", start, start + elapsed, {"endpoint": endpoint.url, "ok": is_ok(response)})
+        if self.metrics is not None:
+            self.metrics.http.record(elapsed)
+            self.metrics.count("http_requests")
+            if not is_ok(response):
+                self.metrics.count("http_errors")
+        return response
+
+    async def _send(self, request: Request) -> Result[list[Request]]:
+        if self.limiter is None:
+            return await self._call(request)
+
+        waited = trio.current_time()
+        async with self.limiter.slot():
+            start = trio.current_time()
+            if self.tracer is not None:
+                self.tracer.wait("concurrency_limit", waited, start)
+            response = await self._call(request)
+            self.limiter.record(response, trio.current_time() - start)
+        return response
@@ -0,0 +1,102 @@
+import math
+import trio
+from collections import deque
+from typing import Any, Awaitable, Callable
+from result import Result, is_ok
+
+class Hedger:
+    """Sends a duplicate of slow requests and takes whichever answer comes back first.
+
+    A request is hedged once it has been out longer than the `percentile`
+    latency of recent successes, or once the input has run dry (so there are
+    idle workers to spare). Hedges are capped at `max_ratio` of requests, and
+    the slower copy is cancelled as soon as the other one succeeds.
+    """
+
+    def __init__(
+        self,
+        input_empty: Callable[[], bool],
+        percentile: float = 0.95,
+        max_ratio: float = 0.1,
+        min_samples: int = 50,
+        when_idle: bool = True,
+        window: int = 1000,
+    ):
+        self.input_empty = input_empty
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.when_idle = when_idle
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies: deque[float] = deque(maxlen=window)
+        self._threshold: float | None = None
+        self._idle = trio.Event()
+
+    def threshold(self) -> float:
+        """How long a request can be out before it gets hedged."""
+        if len(self._latencies) < self.min_samples:
+            return math.inf
+        if self._threshold is None:
+            ordered = sorted(self._latencies)
+            self._threshold = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+        return self._threshold
+
+    def _record(self, latency: float) -> None:
+        self._latencies.append(latency)
+        self._threshold = None
+
+    def _can_hedge(self) -> bool:
+        return self.hedges + 1 <= self.max_ratio * self.requests
+
+    async def _wait_idle(self) -> None:
+        if self.when_idle:
+            await self._idle.wait()
+        else:
+            await trio.sleep_forever()
+
+    async def run(self, call: Callable[[], Awaitable[Result[Any]]]) -> Result[Any]:
+        self.requests += 1
+        if self._idle.is_set() and not self.input_empty():
+            # More work turned up (e.g. retries), so workers aren't idle any more
+            self._idle = trio.Event()
+
+        start = trio.current_time()
+        results: list[tuple[bool, Result[Any]]] = []
+        running = 0
+
+        async with trio.open_nursery() as nursery:
+            async def attempt(hedge: bool) -> None:
+                nonlocal running
+                attempt_start = trio.current_time()
+                result = await call()
+                running -= 1
+                results.append((hedge, result))
+                if is_ok(result):
+                    self._record(trio.current_time() - attempt_start)
+                # An error only settles things if there's nothing else left to wait for
+                if is_ok(result) or running == 0:
+                    nursery.cancel_scope.cancel()
+
+            running += 1
+            nursery.start_soon(attempt, False)
+
+            with trio.move_on_at(start + self.threshold()):
+                await self._wait_idle()
+            # Out of budget for now, but if the input runs dry there may be some to spare
+            while not self._can_hedge() and self.when_idle and not self._idle.is_set():
+                await self._wait_idle()
+            if self._can_hedge():
+                self.hedges += 1
+                running += 1
+                nursery.start_soon(attempt, True)
+            await trio.sleep_forever()
+
+        if self.input_empty():
+            self._idle.set()
+
+        hedge, result = next(((hedge, result) for hedge, result in results if is_ok(result)), results[-1])
+        if hedge and is_ok(result):
+            self.hedge_wins += 1
+        return result
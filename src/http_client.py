@@ -1,5 +1,8 @@
-from typing import Optional, Dict, Any, Union
+from typing import Optional, Dict, Any, Union, Self, AsyncIterator
+from contextlib import asynccontextmanager
 from result import Result
+from datetime import datetime
+from email.utils import parsedate_to_datetime
 import httpx
 
 class HttpClient:
@@ -102,10 +105,16 @@ class AsyncHttpClient:
         trust_env: bool = True,
         http1: bool = True,
         http2: bool = False,
-        proxy: Optional[Union[str, httpx.Proxy]] = None
+        proxy: Optional[Union[str, httpx.Proxy]] = None,
+        limits: Optional[httpx.Limits] = None
     ):
-        """Initialize the async HTTP client with optional base URL and configuration."""
+        """Initialize the async HTTP client with optional base URL and configuration.
+
+        A single `httpx.AsyncClient` (and its connection pool) is created lazily on
+        first use and shared by every request until `aclose` is called.
+        """
         self._client_kwargs: Dict[str, Any] = {}
+        self._client: Optional[httpx.AsyncClient] = None
         
         if base_url is not None:
             self._client_kwargs['base_url'] = base_url
@@ -131,16 +140,41 @@ class AsyncHttpClient:
             self._client_kwargs['http2'] = http2
         if proxy is not None:
             self._client_kwargs['proxy'] = proxy
+        if limits is not None:
+            self._client_kwargs['limits'] = limits
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the shared pooled client, creating it on first use."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(**self._client_kwargs)
+        return self._client
+
+    async def aclose(self) -> None:
+        """Close the shared client and release every pooled connection."""
+        if self._client is not None:
+            client, self._client = self._client, None
+            await client.aclose()
     
     async def _make_request(self, method: str, url: str, **kwargs) -> Result[httpx.Response]:
         """Internal method to make async HTTP requests and wrap them in Result."""
         try:
-            async with httpx.AsyncClient(**self._client_kwargs) as client:
-                response = await client.request(method, url, **kwargs)
-                return Result(response, None)
+            response = await self._get_client().request(method, url, **kwargs)
+            return Result(response, None)
         except Exception as e:
             return Result(None, e)  # type: ignore
     
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        """Open a streamed request on the shared client. Unlike the other methods this raises on error."""
+        async with self._get_client().stream(method, url, **kwargs) as response:
+            yield response
+
     async def get(self, url: str, params: Optional[Dict[str, Any]] = None, **kwargs) -> Result[httpx.Response]:
         """Make an async GET request."""
         return await self._make_request('GET', url, params=params, **kwargs)
@@ -170,6 +204,22 @@ class AsyncHttpClient:
         return await self._make_request('OPTIONS', url, **kwargs)
 
 
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """Seconds the server asked us to wait in its `Retry-After` header, if any."""
+    value = response.headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+        return max(0.0, (when - datetime.now(when.tzinfo)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
 # Convenience functions for quick HTTP operations
 def get(url: str, **kwargs) -> Result[httpx.Response]:
     """Quick GET request using a temporary client."""
@@ -0,0 +1,161 @@
+import httpx
+import trio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Any
+from http_client import parse_retry_after
+from result import Result, is_ok
+
+def is_overload_error(error: BaseException) -> bool:
+    """Whether an error means the server is overloaded: 429, any 5xx, or a timeout."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, httpx.TimeoutException)
+
+class AdaptiveLimiter:
+    """AIMD (additive-increase, multiplicative-decrease) limit on requests in flight.
+
+    Every healthy response grows the limit by roughly one request per round
+    trip. A 429/5xx, a timeout or a latency spike multiplies it by `backoff`,
+    at most once per round trip so one burst of errors only counts once. A
+    `Retry-After` header pauses new requests until it has passed.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        minimum: int,
+        maximum: int,
+        latency_tolerance: float | None = 3.0,
+        backoff: float = 0.5,
+    ):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.in_flight = 0
+        self._lot = trio.lowlevel.ParkingLot()
+        self._paused_until = 0.0
+        self._last_decrease = float("-inf")
+        self._baseline_latency: float | None = None
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self) -> None:
+        await trio.lowlevel.checkpoint_if_cancelled()
+        while True:
+            if trio.current_time() < self._paused_until:
+                await trio.sleep_until(self._paused_until)
+            elif self.in_flight < int(self.limit):
+                self.in_flight += 1
+                await trio.lowlevel.cancel_shielded_checkpoint()
+                return
+            else:
+                await self._lot.park()
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self) -> None:
+        free = int(self.limit) - self.in_flight
+        if free > 0:
+            self._lot.unpark(count=free)
+
+    def _increase(self) -> None:
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        self._wake()
+
+    def _decrease(self) -> None:
+        now = trio.current_time()
+        window = self._baseline_latency if self._baseline_latency is not None else 1.0
+        if now - self._last_decrease < window:
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.backoff)
+
+    def record(self, result: Result[Any], latency: float) -> None:
+        """Adjust the limit from the outcome of one request."""
+        if is_ok(result):
+            baseline = self._baseline_latency
+            if (
+                baseline is not None
+                and self.latency_tolerance is not None
+                and latency > baseline * self.latency_tolerance
+            ):
+                self._decrease()
+            else:
+                # Only healthy samples move the baseline, so a spike can't hide itself
+                self._baseline_latency = latency if baseline is None else 0.9 * baseline + 0.1 * latency
+                self._increase()
+            return
+
+        error = result.unwrap_err()
+        if is_overload_error(error):
+            self._decrease()
+            if isinstance(error, httpx.HTTPStatusError):
+                retry_after = parse_retry_after(error.response)
+                if retry_after is not None:
+                    self._paused_until = max(self._paused_until, trio.current_time() + retry_after)
+
+class TokenBucket:
+    """Token bucket that refills continuously at `per_minute` tokens a minute.
+
+    Waiters are served in FIFO order, so a large charge can't be starved by a
+    stream of small ones. `adjust` can push the balance negative, which just
+    makes the next callers wait for it to pay back.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self._updated = trio.current_time()
+        self._lock = trio.Lock()
+
+    def _refill(self) -> None:
+        now = trio.current_time()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, amount: float) -> None:
+        # A single charge bigger than the whole bucket would never fit
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await trio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def adjust(self, amount: float) -> None:
+        """Charge (or refund, if negative) `amount` tokens without waiting."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute quotas.
+
+    Each request is charged its estimated prompt tokens plus `max_tokens` up
+    front, then `reconcile` settles the difference once the real usage is known.
+    """
+
+    def __init__(self, requests_per_minute: int | None, tokens_per_minute: int | None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute is not None else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute is not None else None
+
+    async def acquire(self, tokens: int) -> None:
+        if self.requests is not None:
+            await self.requests.acquire(1)
+        if self.tokens is not None:
+            await self.tokens.acquire(tokens)
+
+    def reconcile(self, charged: int, actual: int) -> None:
+        if self.tokens is not None:
+            self.tokens.adjust(actual - charged)
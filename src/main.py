@@ -1,198 +1,800 @@
 from result import Result, Ok, is_ok
 from http_client import AsyncHttpClient
+from dispatch import Dispatcher
+from balancer import Balancer, Endpoint, endpoint_configs
+from cache import ResponseCache
+from hedging import Hedger
+from limiter import AdaptiveLimiter, RateLimiter
+from metrics import Histogram, Metrics, write_metrics
+from tracing import Tracer
+from batch import run_batch
+from conversation import FollowUps
+import argparse
+import sys
 import trio
-from primitives import AsyncKVStore, AsyncQueue
+import httpx
+import polars as pl
+from msgspec import structs
+from primitives import AsyncKVStore, AsyncQueue, PriorityQueue
 from messages import Request
-from config import Config
-from verification import verify_request
+from config import Config, EndpointConfig, FollowUp, MetricsConfig, Mode, Schedule, TraceConfig, VerificationConfig
+from verification import VerificationPool
 from logbar import LogBar
 from logbar.progress import ProgressBar
-from datasets import load_dataset
-from output import save_requests, convert_requests_to_dataframe, save_dataframe
+from datasets import load_dataset, dataset_size, count_dataset_rows, iter_dataset
+from sharding import Shard, ShardProgress, shard_config, run_shards, merge_shards
+from output import (
+    load_completed_row_ids,
+    dead_letter_path,
+    OutputSink,
+    DeadLetter,
+    DeadLetterWriter,
+)
+from retry import RetryPolicy, VerificationFailed, describe_error
+
+async def producer(
+    config: Config,
+    input_queue: AsyncQueue[Request],
+    completed: pl.Series | None,
+    rows: tuple[int, int] | None,
+    produced: trio.Event,
+) -> None:
+    """Stream the dataset into the input queue, blocking whenever it is full, then set `produced`.
+
+    Reading and converting each batch happens off the event loop. Errors are
+    deliberately not resultified: a dataset that can't be read should fail the run.
+    """
+    batches = iter_dataset(config, config.data.batch_size, completed, rows)
+    while (batch := await trio.to_thread.run_sync(next, batches, None)) is not None:
+        for request in batch:
+            await input_queue.enqueue(request)
+    produced.set()
+
+async def finish_request(
+    kv_store: AsyncKVStore[str, int],
+    input_queue: AsyncQueue[Request],
+    pb: ProgressBar | ShardProgress,
+    total_requests: int,
+    outcome: str,
+    samples: int = 1,
+) -> None:
+    """Count a request's samples as done, whether they completed or were dead-lettered."""
+    await kv_store.update(outcome, lambda count: count + samples)
+    finished = (await kv_store.update("requests_finished", lambda count: count + samples)).unwrap()
+    for _ in range(samples):
+        pb.next()
+    pb.draw()
+    # Nothing can be re-added once every request is done, so let the workers drain out
+    if finished >= total_requests:
+        await input_queue.close()
+
+async def requeue_after(input_queue: AsyncQueue[Request], request: Request, delay: float) -> None:
+    await trio.sleep(delay)
+    await input_queue.requeue(request)
+
+async def dead_letter(
+    request: Request,
+    error: BaseException,
+    input_queue: AsyncQueue[Request],
+    dead_queue: AsyncQueue[DeadLetter],
+    kv_store: AsyncKVStore[str, int],
+    pb: ProgressBar | ShardProgress,
+    total_requests: int,
+    metrics: Metrics,
+) -> None:
+    """Give up on a request for good, writing it to the dead letters."""
+    metrics.count("dead_letters", request.sample_count())
+    # The last rejected response counts as a regeneration that never happened
+    regenerations = request.regenerations - 1 if isinstance(error, VerificationFailed) else request.regenerations
+    await dead_queue.enqueue(
+        DeadLetter(
+            row_id=request.row_id,
+            messages=request.messages,
+            error=describe_error(error),
+            attempts=request.attempts,
+            sample_index=request.sample_index,
+            regenerations=regenerations,
+        )
+    )
+    await finish_request(kv_store, input_queue, pb, total_requests, "requests_failed", request.sample_count())
+
+async def retry_or_dead_letter(
+    request: Request,
+    error: BaseException,
+    retry_policy: RetryPolicy,
+    nursery: trio.Nursery,
+    input_queue: AsyncQueue[Request],
+    dead_queue: AsyncQueue[DeadLetter],
+    kv_store: AsyncKVStore[str, int],
+    pb: ProgressBar | ShardProgress,
+    total_requests: int,
+    log: LogBar,
+    metrics: Metrics,
+) -> None:
+    """Schedule another attempt at a failed request, or give up on it for good."""
+    if isinstance(error, VerificationFailed):
+        request = structs.replace(request, regenerations=request.regenerations + 1)
+    else:
+        request = structs.replace(request, attempts=request.attempts + 1)
+    delay = retry_policy.next_delay(request, error)
+    if delay is None:
+        log.error(
+            f"Giving up on request after {request.attempts} failed attempt(s) and "
+            f"{request.regenerations} rejected response(s): {describe_error(error)}"
+        )
+        await dead_letter(request, error, input_queue, dead_queue, kv_store, pb, total_requests, metrics)
+    elif isinstance(error, VerificationFailed):
+        metrics.count("regenerations")
+        log.error(f"Response failed verification, regenerating: {describe_error(error)}")
+        await input_queue.requeue(request)
+    elif delay > 0:
+        metrics.count("retries")
+        log.error(f"Request failed, retrying in {delay:.1f}s: {describe_error(error)}")
+        # Wait in the background so the worker can pick up something else meanwhile
+        nursery.start_soon(requeue_after, input_queue, request, delay)
+    else:
+        metrics.count("retries")
+        log.error(f"Request failed, retrying: {describe_error(error)}")
+        await input_queue.requeue(request)
+
+async def continue_conversation(
+    request: Request,
+    follow_ups: FollowUps,
+    input_queue: AsyncQueue[Request],
+    output_queue: AsyncQueue[Request],
+    dead_queue: AsyncQueue[DeadLetter],
+    kv_store: AsyncKVStore[str, int],
+    pb: ProgressBar | ShardProgress,
+    total_requests: int,
+    log: LogBar,
+    metrics: Metrics,
+    tracer: Tracer | None,
+) -> None:
+    """Put a conversation back on the input queue with the user's next message, or write it out if it's over."""
+    start = trio.current_time()
+    try:
+        content = await follow_ups.next_message(request)
+    except Exception as e:
+        log.error(f"Failed to write the next user message, giving up on the conversation: {describe_error(e)}")
+        await dead_letter(request, e, input_queue, dead_queue, kv_store, pb, total_requests, metrics)
+        return
+    if tracer is not None:
+        tracer.wait("follow_up", start, trio.current_time(), {"row_id": request.row_id, "turn": request.turn + 1})
+    if content is None:
+        metrics.count("completed")
+        await output_queue.enqueue(request)
+        await finish_request(kv_store, input_queue, pb, total_requests, "requests_completed")
+        return
+    metrics.count("turns")
+    await input_queue.requeue(follow_ups.continue_with(request, content))
+
+def record_response(metrics: Metrics, samples: list[Request]) -> None:
+    # Usage and timings cover the whole call, so only the first sample has them
+    first = samples[0] if samples else None
+    if first is not None and first.timings is not None:
+        if first.timings.ttft is not None:
+            metrics.ttft.record(first.timings.ttft)
+        if first.timings.inter_token_latency is not None:
+            metrics.inter_token_latency.record(first.timings.inter_token_latency)
+        if first.timings.tokens_per_second is not None:
+            metrics.generation_rate.record(first.timings.tokens_per_second)
+    if first is not None and first.usage is not None:
+        metrics.prompt_tokens.record(first.usage.prompt_tokens)
+        metrics.completion_tokens.record(first.usage.completion_tokens)
+        metrics.count("prompt_tokens", first.usage.prompt_tokens)
+        metrics.count("completion_tokens", first.usage.completion_tokens)
 
 @Result.resultify_async
 async def worker(
-    http_client: AsyncHttpClient,
+    dispatcher: Dispatcher,
+    retry_policy: RetryPolicy,
+    nursery: trio.Nursery,
+    kv_store: AsyncKVStore[str, int],
     input_queue: AsyncQueue[Request],
     verify_queue: AsyncQueue[Request],
+    dead_queue: AsyncQueue[DeadLetter],
     log: LogBar,
-    config: Config,
+    pb: ProgressBar | ShardProgress,
+    total_requests: int,
+    metrics: Metrics,
+    tracer: Tracer | None,
 ) -> None:
     """Process requests and send results to the verification queue."""
-    while True:
-        request = await input_queue.dequeue()
-        response = await request.unwrap().req(http_client, config.api.model)
+    lane = tracer.lane("worker") if tracer is not None else 0
+    async for request in input_queue:
+        start = trio.current_time()
+        if request.queued_at is not None:
+            metrics.input_wait.record(start - request.queued_at)
+            if tracer is not None:
+                tracer.wait("input_queue", request.queued_at, start)
+        response = await dispatcher.send(request)
+        if tracer is not None:
+            sent = trio.current_time()
+            tracer.span("send", lane, start, sent, {"row_id": request.row_id, "attempt": request.attempts, "ok": is_ok(response)})
         if is_ok(response):
-            await verify_queue.enqueue(response.unwrap())
+            samples = response.unwrap()
+            record_response(metrics, samples)
+            for sample in samples:
+                await verify_queue.enqueue(sample)
+            if tracer is not None:
+                # Time spent blocked on a full verify queue, i.e. verification not keeping up
+                tracer.span("verify_queue.put", lane, sent, trio.current_time())
+            # The backend ignored `n`, so ask for the rest of the samples one at a time
+            for index in range(len(samples), request.sample_count()):
+                await input_queue.requeue(structs.replace(request, n=None, sample_index=index))
         else:
-            log.error(
-                f"Failed to process request, readding to input queue: {response.unwrap_err()}"
+            await retry_or_dead_letter(
+                request,
+                response.unwrap_err(),
+                retry_policy,
+                nursery,
+                input_queue,
+                dead_queue,
+                kv_store,
+                pb,
+                total_requests,
+                log,
+                metrics,
             )
-            await input_queue.enqueue(request.unwrap())
 
 @Result.resultify_async
 async def output_worker(
     output_queue: AsyncQueue[Request],
-    kv_store: AsyncKVStore[str, int],
-    config: Config,
-    log: LogBar,
-    total_requests: int,
-    completed_requests: list[Request],
+    part_queue: AsyncQueue[list[Request]],
+    part_rows: int | None,
+    tracer: Tracer | None,
 ) -> None:
-    """Collect completed requests from the output queue."""
+    """Batch completed requests from the output queue into parts until it is closed and drained.
 
-    while True:
-        while (await output_queue.size()).unwrap() > 0:
-            request = await output_queue.dequeue()
-            completed_requests.append(request.unwrap())
+    Only the part being filled is held here, so memory stays flat however
+    big the dataset is. Without an output, requests are just dropped.
+    """
 
-        completed_count = (await kv_store.get("requests_completed")).unwrap()
-        if completed_count >= total_requests and len(completed_requests) >= total_requests:
-            break
+    lane = tracer.lane("output") if tracer is not None else 0
+    pending: list[Request] = []
 
-        await trio.sleep(0.1)
+    async for request in output_queue:
+        if tracer is not None and request.queued_at is not None:
+            tracer.wait("output_queue", request.queued_at, trio.current_time())
+        if part_rows is None:
+            continue
+        pending.append(request)
+        if len(pending) >= part_rows:
+            start = trio.current_time()
+            await part_queue.enqueue(pending)
+            if tracer is not None:
+                tracer.span("part_queue.put", lane, start, trio.current_time(), {"rows": len(pending)})
+            pending = []
 
-    if config.output is not None:
-        log.info("Saving output data...")
-        save_result = save_requests(completed_requests, config)
-        if save_result._error is None:
-            log.info(
-                f"Successfully saved {len(completed_requests)} requests to {config.output.path}"
-            )
-        else:
-            log.error(f"Failed to save output: {save_result.unwrap_err()}")
+    if pending:
+        await part_queue.enqueue(pending)
+    await part_queue.close()
 
 
 @Result.resultify_async
 async def verification_worker(
+    verifier: VerificationPool,
+    batch_size: int,
+    retry_policy: RetryPolicy,
+    nursery: trio.Nursery,
     kv_store: AsyncKVStore[str, int],
     input_queue: AsyncQueue[Request],
     verify_queue: AsyncQueue[Request],
     output_queue: AsyncQueue[Request],
+    dead_queue: AsyncQueue[DeadLetter],
     log: LogBar,
-    pb: ProgressBar,
+    pb: ProgressBar | ShardProgress,
+    total_requests: int,
+    metrics: Metrics,
+    tracer: Tracer | None,
+    follow_ups: FollowUps | None,
 ) -> None:
-    """Verify requests and route them to the appropriate queue."""
-
-    while True:
-        request_res = await verify_queue.dequeue()
-        request = request_res.unwrap()
-
-        verified = verify_request(request)
-        if is_ok(verified) and verified.unwrap():
-            await output_queue.enqueue(request)
-            await kv_store.set(
-                "requests_completed",
-                (await kv_store.get("requests_completed")).unwrap() + 1,
-            )
-            pb.next()
-            pb.draw()
-        else:
-            log.error("Request failed verification, returning to input queue")
-            await input_queue.enqueue(request)
+    """Verify requests in batches and route them to the appropriate queue.
+
+    Conversations with turns left go back to the input queue instead of
+    the output, once the user's next message has been written in the
+    background.
+    """
+
+    lane = tracer.lane("verifier") if tracer is not None else 0
+    async for batch in verify_queue.batches(batch_size):
+        start = trio.current_time()
+        failures = await verifier.verify(batch)
+        now = trio.current_time()
+        if tracer is not None:
+            tracer.span("verify", lane, start, now, {"requests": len(batch)})
+        for request, failure in zip(batch, failures):
+            if request.queued_at is not None:
+                metrics.verify_wait.record(now - request.queued_at)
+                if tracer is not None:
+                    tracer.wait("verify_queue", request.queued_at, start)
+            if failure is None and follow_ups is not None and follow_ups.wants_more(request):
+                nursery.start_soon(
+                    continue_conversation,
+                    request,
+                    follow_ups,
+                    input_queue,
+                    output_queue,
+                    dead_queue,
+                    kv_store,
+                    pb,
+                    total_requests,
+                    log,
+                    metrics,
+                    tracer,
+                )
+            elif failure is None:
+                metrics.count("completed")
+                await output_queue.enqueue(request)
+                await finish_request(kv_store, input_queue, pb, total_requests, "requests_completed")
+            else:
+                await retry_or_dead_letter(
+                    request.discard_response(),
+                    VerificationFailed(failure),
+                    retry_policy,
+                    nursery,
+                    input_queue,
+                    dead_queue,
+                    kv_store,
+                    pb,
+                    total_requests,
+                    log,
+                    metrics,
+                )
+        if tracer is not None:
+            # Includes waiting on a full output queue, i.e. the writer not keeping up
+            tracer.span("route", lane, now, trio.current_time(), {"requests": len(batch)})
 
 
 @Result.resultify_async
-async def checkpoint_worker(
-    kv_store: AsyncKVStore[str, int],
-    config: Config,
+async def dead_letter_worker(
+    dead_queue: AsyncQueue[DeadLetter],
+    writer: DeadLetterWriter | None,
     log: LogBar,
-    total_requests: int,
-    completed_requests: list[Request],
 ) -> None:
-    """Periodically save a checkpoint of completed requests."""
+    """Write requests we gave up on next to the output, so nothing is silently lost."""
+
+    async for letter in dead_queue:
+        if writer is None:
+            continue
+        save_result = await trio.to_thread.run_sync(writer.append, [letter])
+        if save_result._error is not None:
+            log.error(f"Failed to save dead letter: {save_result.unwrap_err()}")
+
+
+@Result.resultify_async
+async def sink_worker(
+    part_queue: AsyncQueue[list[Request]],
+    sink: OutputSink,
+    merge: bool,
+    log: LogBar,
+    metrics: Metrics,
+    tracer: Tracer | None,
+) -> None:
+    """Write each batch of completions as a part file from a worker thread, then merge them once the run is done."""
 
-    if config.output is None or config.output.checkpoint_interval is None:
-        return None
+    lane = tracer.lane("sink") if tracer is not None else 0
+    async for batch in part_queue:
+        start = trio.current_time()
+        save_result = await trio.to_thread.run_sync(sink.write, batch)
+        end = trio.current_time()
+        metrics.checkpoint_write.record(end - start)
+        if tracer is not None:
+            tracer.span("write_part", lane, start, end, {"rows": len(batch)})
+        if save_result._error is None:
+            log.info(f"Checkpoint saved ({sink.rows_written} responses) to {sink.directory}")
+        else:
+            log.error(f"Failed to save checkpoint: {save_result.unwrap_err()}")
+
+    if not merge:
+        log.info(f"Saved {sink.rows_written} responses as parts in {sink.directory}")
+        return
+    log.info("Merging output data...")
+    start = trio.current_time()
+    merge_result = await trio.to_thread.run_sync(sink.merge)
+    if tracer is not None:
+        tracer.span("merge", lane, start, trio.current_time())
+    if merge_result._error is None:
+        log.info(f"Successfully saved {sink.rows_written} responses to {merge_result.unwrap()}")
+    else:
+        log.error(f"Failed to merge output, the parts are still in {sink.directory}: {merge_result.unwrap_err()}")
+
+def log_stream_summary(metrics: Metrics, log: LogBar) -> None:
+    """Log the median and p90 of the latencies collected while streaming."""
 
-    interval = config.output.checkpoint_interval
-    last_saved = 0
-    checkpoint_path = f"{config.output.path}.checkpoint"
+    def describe(histogram: Histogram, unit: str, scale: float = 1.0) -> str:
+        if histogram.count == 0:
+            return "n/a"
+        p50 = histogram.percentile(0.5) * scale
+        p90 = histogram.percentile(0.9) * scale
+        return f"p50 {p50:.1f}{unit}, p90 {p90:.1f}{unit}"
 
-    while True:
-        completed_count = (await kv_store.get("requests_completed")).unwrap()
+    log.info(f"Time to first token: {describe(metrics.ttft, 'ms', 1000)}")
+    log.info(f"Inter-token latency: {describe(metrics.inter_token_latency, 'ms', 1000)}")
+    log.info(f"Generation throughput: {describe(metrics.generation_rate, ' tok/s')}")
 
-        if completed_count - last_saved >= interval and len(completed_requests) > 0:
-            output_format = (
-                config.output.format if config.output.format is not None else config.data.format
+def stamp_queued(request: Request) -> None:
+    request.queued_at = trio.current_time()
+
+def make_input_queue(config: Config, lock: trio.Lock, maxsize: int | None = None) -> AsyncQueue[Request]:
+    match config.data.schedule:
+        case Schedule.LONGEST_FIRST:
+            # Starting the big ones early keeps them from being the stragglers at the end
+            return PriorityQueue[Request](
+                lock, key=lambda request: -request.estimate_prompt_tokens(), maxsize=maxsize, on_put=stamp_queued
             )
-            df_result = convert_requests_to_dataframe(completed_requests, output_format)
-            if df_result._error is None:
-                df = df_result.unwrap()
-                save_result = save_dataframe(df, checkpoint_path, config.output.type)
-                if save_result._error is None:
-                    last_saved = completed_count
-                    log.info(
-                        f"Checkpoint saved ({completed_count} responses) to {checkpoint_path}"
-                    )
-                else:
-                    log.error(f"Failed to save checkpoint: {save_result.unwrap_err()}")
-            else:
-                log.error(f"Failed to convert checkpoint dataframe: {df_result.unwrap_err()}")
+        case Schedule.SHORTEST_FIRST:
+            return PriorityQueue[Request](
+                lock, key=lambda request: request.estimate_prompt_tokens(), maxsize=maxsize, on_put=stamp_queued
+            )
+        case _:
+            return AsyncQueue[Request](lock=lock, maxsize=maxsize, on_put=stamp_queued)
+
+async def metrics_exporter(metrics: Metrics, config: MetricsConfig, done: trio.Event, log: LogBar) -> None:
+    """Write the metrics out every `interval` seconds until the run is done."""
+    while not done.is_set():
+        with trio.move_on_after(config.interval):
+            await done.wait()
+        data = metrics.render(config.format)
+        try:
+            await trio.to_thread.run_sync(write_metrics, config.path, data)
+        except OSError as e:
+            log.error(f"Failed to write metrics: {e}")
+
+async def trace_exporter(tracer: Tracer, config: TraceConfig, done: trio.Event, log: LogBar) -> None:
+    """Write buffered spans out every `interval` seconds until the run is done."""
+    while not done.is_set():
+        with trio.move_on_after(config.interval):
+            await done.wait()
+        events = tracer.take()
+        try:
+            await trio.to_thread.run_sync(tracer.flush, events)
+        except OSError as e:
+            log.error(f"Failed to write trace: {e}")
 
-        if completed_count >= total_requests:
-            break
+def make_http_client(config: Config, endpoint: EndpointConfig) -> AsyncHttpClient:
+    """A pooled client for one endpoint, sized to the requests that can be in flight to it."""
+    max_connections = (
+        endpoint.max_concurrency
+        if endpoint.max_concurrency is not None
+        else config.api.max_connections
+        if config.api.max_connections is not None
+        else config.processes.parallel
+    )
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=(
+            min(config.api.max_keepalive_connections, max_connections)
+            if config.api.max_keepalive_connections is not None
+            else max_connections
+        ),
+        keepalive_expiry=config.api.keepalive_expiry,
+    )
+    return AsyncHttpClient(
+        base_url=endpoint.base_url,
+        timeout=config.api.timeout,
+        headers={"Authorization": f"Bearer {config.api.api_key}"},
+        http2=config.api.http2,
+        limits=limits,
+    )
 
-        await trio.sleep(0.1)
+def log_endpoint_summary(balancer: Balancer, log: LogBar) -> None:
+    for endpoint in balancer.endpoints:
+        latency = endpoint.mean_latency
+        log.info(
+            f"{endpoint.url}: {endpoint.requests} requests, {endpoint.failures} failed, "
+            f"ejected {endpoint.ejections} time(s), "
+            f"mean latency {f'{latency * 1000:.0f}ms' if latency is not None else 'n/a'}"
+        )
 
-async def main() -> Result[None]:
-    config = Config.from_toml("./config.toml").unwrap()
-    http_client = AsyncHttpClient(base_url=config.api.base_url, headers={"Authorization": f"Bearer {config.api.api_key}"})
+async def main(
+    config_path: str = "./config.toml",
+    shard: Shard | None = None,
+    progress: ShardProgress | None = None,
+) -> Result[None]:
+    config = Config.from_toml(config_path).unwrap()
+    # A shard only works through its own slice of the rows, writing to its own output
+    rows: tuple[int, int] | None = None
+    if shard is not None:
+        config = shard_config(config, shard)
+        rows = shard.bounds(dataset_size(config).unwrap())
+    if config.api.mode == Mode.BATCH:
+        async with make_http_client(config, endpoint_configs(config.api)[0]) as client:
+            return await run_batch(config, client, rows, progress)
+    balancer = Balancer(
+        [Endpoint(endpoint, make_http_client(config, endpoint)) for endpoint in endpoint_configs(config.api)],
+        routing=config.api.routing,
+        eject_after=config.api.eject_after,
+        eject_for=config.api.eject_for,
+    )
+    limiter = None
+    if config.processes.adaptive:
+        limiter = AdaptiveLimiter(
+            initial=(
+                config.processes.initial_parallel
+                if config.processes.initial_parallel is not None
+                else config.processes.min_parallel
+            ),
+            minimum=config.processes.min_parallel,
+            maximum=config.processes.parallel,
+            latency_tolerance=config.processes.latency_tolerance,
+        )
+    rate_limiter = None
+    if config.api.requests_per_minute is not None or config.api.tokens_per_minute is not None:
+        rate_limiter = RateLimiter(config.api.requests_per_minute, config.api.tokens_per_minute)
+    cache = None
+    if config.cache is not None:
+        cache = ResponseCache(
+            config.cache.path,
+            config.api.model,
+            max_bytes=int(config.cache.max_size_mb * 1024 * 1024) if config.cache.max_size_mb is not None else None,
+        )
     kv_lock = trio.Lock()
     queue_lock = trio.Lock()
     verify_lock = trio.Lock()
     output_lock = trio.Lock()
+    part_lock = trio.Lock()
+    dead_lock = trio.Lock()
+    queue_size = (
+        config.processes.queue_size
+        if config.processes.queue_size is not None
+        else 2 * config.processes.parallel
+    )
     kv_store = AsyncKVStore[str, int](default_value=0, lock=kv_lock)
-    input_queue = AsyncQueue[Request](lock=queue_lock)
-    verify_queue = AsyncQueue[Request](lock=verify_lock)
-    output_queue = AsyncQueue[Request](lock=output_lock)
+    verify_queue = AsyncQueue[Request](lock=verify_lock, maxsize=queue_size, on_put=stamp_queued)
+    output_queue = AsyncQueue[Request](lock=output_lock, maxsize=queue_size, on_put=stamp_queued)
+    # A couple of parts of slack so the output worker never waits on a slow disk
+    part_queue = AsyncQueue[list[Request]](lock=part_lock, maxsize=2)
+    dead_queue = AsyncQueue[DeadLetter](lock=dead_lock)
     log = LogBar(name="main")
 
-    ds = load_dataset(config).unwrap()
-    for request in ds:
-        await input_queue.enqueue(request)
-    
-    size = (await input_queue.size()).unwrap()
-    log.info(f"Queued {size} requests")
-    pb = log.pb(range(size)).subtitle("Processing requests")
-    pb.draw()
+    # Completions are streamed to disk a part at a time, rather than held until the end
+    sink = None
+    part_rows = None
+    merge = True
+    if config.output is not None:
+        sink = OutputSink(
+            config.output.path,
+            config.output.type,
+            config.output.format if config.output.format is not None else config.data.format,
+            config.output.compression,
+            resume=config.output.resume,
+            samples=config.model.samples_per_prompt > 1,
+        )
+        part_rows = (
+            config.output.checkpoint_interval
+            if config.output.checkpoint_interval is not None
+            else config.output.part_rows
+        )
+        merge = config.output.merge
 
-    completed_requests: list[Request] = []
+    completed: pl.Series | None = None
+    if config.output is not None and config.output.resume:
+        completed = load_completed_row_ids(config, config.model.samples_per_prompt).unwrap()
+        log.info(f"Resuming, skipping {len(completed)} rows that are already done")
 
-    async with trio.open_nursery() as nursery:
-        # Start worker processes
-        for _ in range(config.processes.parallel):
-            nursery.start_soon(worker, http_client, input_queue, verify_queue, log, config)
+    # Set once every request from the dataset has been put on the input queue
+    produced = trio.Event()
+    # Progress and completion are counted in samples, which is rows unless
+    # there's more than one sample per prompt
+    if config.data.streaming:
+        # Requests are produced in batches while the workers run, so only
+        # the in-flight ones are ever held in memory
+        input_queue = make_input_queue(config, queue_lock, maxsize=queue_size)
+        size = count_dataset_rows(config, completed, rows).unwrap() * config.model.samples_per_prompt
+        log.info(f"Streaming {size} requests")
+    else:
+        input_queue = make_input_queue(config, queue_lock)
+        ds = load_dataset(config, completed, rows).unwrap()
+        for request in ds:
+            await input_queue.enqueue(request)
+        produced.set()
+
+        size = sum(request.sample_count() for request in ds)
+        log.info(f"Queued {size} requests")
+    if progress is not None:
+        progress.start(size)
+    pb = progress if progress is not None else log.pb(range(size)).subtitle("Processing requests")
+    if size == 0:
+        await input_queue.close()
+    else:
+        pb.draw()
 
-        # Start verification worker(s)
-        verify_parallel = (
-            config.processes.verify_parallel
-            if config.processes.verify_parallel is not None
-            else config.processes.parallel
+    hedger = None
+    if config.hedge is not None:
+        hedger = Hedger(
+            # Between two streamed batches the queue is empty without the input having run dry
+            input_empty=lambda: produced.is_set() and len(input_queue) == 0,
+            percentile=config.hedge.percentile,
+            max_ratio=config.hedge.max_ratio,
+            min_samples=config.hedge.min_samples,
+            when_idle=config.hedge.when_idle,
         )
-        for _ in range(verify_parallel):
-            nursery.start_soon(
-                verification_worker,
-                kv_store,
-                input_queue,
-                verify_queue,
-                output_queue,
-                log,
-                pb,
+    metrics = Metrics()
+    metrics.gauges = {
+        "input_queue_depth": lambda: len(input_queue),
+        "verify_queue_depth": lambda: len(verify_queue),
+        "output_queue_depth": lambda: len(output_queue),
+        "in_flight": lambda: sum(endpoint.outstanding for endpoint in balancer.endpoints),
+    }
+    if limiter is not None:
+        metrics.gauges["concurrency_limit"] = lambda: limiter.limit
+    metrics_done = trio.Event()
+    tracer = None
+    if config.trace is not None:
+        tracer = Tracer(
+            config.trace.path,
+            pid=shard.index if shard is not None else 0,
+            process_name=f"polymerase shard {shard.index} of {shard.count}" if shard is not None else "polymerase",
+        )
+    dispatcher = Dispatcher(balancer, config, limiter, rate_limiter, cache, hedger, metrics, tracer)
+    verification = config.verification if config.verification is not None else VerificationConfig()
+    verifier = VerificationPool(verification.checks, verification.processes, verification.vectorized)
+    # Every turn of a conversation is a request of its own, as far as the retry budget goes
+    turns = config.conversation.turns if config.conversation is not None else 1
+    retry_policy = RetryPolicy(config.retry, size * turns, verification.max_regenerations)
+    follow_ups = None
+    follow_up_client = None
+    if config.conversation is not None:
+        if config.conversation.follow_up == FollowUp.MODEL:
+            base_url = (
+                config.conversation.base_url
+                if config.conversation.base_url is not None
+                else endpoint_configs(config.api)[0].base_url
             )
+            follow_up_client = make_http_client(config, EndpointConfig(base_url))
+        follow_ups = FollowUps(config, follow_up_client, retry_policy)
+
+    # Each stage is closed once the stage feeding it has finished, so the
+    # pipeline drains front to back: input -> verify -> output. The pooled
+    # clients are closed once everything has joined.
+    async with balancer, trio.open_nursery() as nursery:
+        if config.metrics is not None:
+            nursery.start_soon(metrics_exporter, metrics, config.metrics, metrics_done, log)
+        if tracer is not None and config.trace is not None:
+            nursery.start_soon(trace_exporter, tracer, config.trace, metrics_done, log)
+        if config.data.streaming:
+            nursery.start_soon(producer, config, input_queue, completed, rows, produced)
 
         # Start workers that handle output
-        if config.output is not None:
-            nursery.start_soon(output_worker, output_queue, kv_store, config, log, size, completed_requests)
+        if sink is not None:
+            nursery.start_soon(sink_worker, part_queue, sink, merge, log, metrics, tracer)
 
-            if config.output.checkpoint_interval is not None:
-                nursery.start_soon(checkpoint_worker, kv_store, config, log, size, completed_requests)
+        nursery.start_soon(output_worker, output_queue, part_queue, part_rows, tracer)
+
+        dead_writer = (
+            DeadLetterWriter(dead_letter_path(config.output.path), resume=config.output.resume)
+            if config.output is not None
+            else None
+        )
+        nursery.start_soon(dead_letter_worker, dead_queue, dead_writer, log)
+
+        # Start verification worker(s). Checks run in a pool, so there's no
+        # point having many more batches out than it can work on at once.
+        if config.processes.verify_parallel is not None:
+            verify_parallel = config.processes.verify_parallel
+        elif verification.checks:
+            verify_parallel = verifier.concurrency
+        else:
+            verify_parallel = config.processes.parallel
+        async with trio.open_nursery() as verify_nursery:
+            # Start worker processes. Delayed retries are scheduled into this
+            # nursery too, so it only joins once every request is finished.
+            async with trio.open_nursery() as worker_nursery:
+                for _ in range(verify_parallel):
+                    verify_nursery.start_soon(
+                        verification_worker,
+                        verifier,
+                        verification.batch_size,
+                        retry_policy,
+                        worker_nursery,
+                        kv_store,
+                        input_queue,
+                        verify_queue,
+                        output_queue,
+                        dead_queue,
+                        log,
+                        pb,
+                        size,
+                        metrics,
+                        tracer,
+                        follow_ups,
+                    )
+
+                for _ in range(config.processes.parallel):
+                    worker_nursery.start_soon(
+                        worker,
+                        dispatcher,
+                        retry_policy,
+                        worker_nursery,
+                        kv_store,
+                        input_queue,
+                        verify_queue,
+                        dead_queue,
+                        log,
+                        pb,
+                        size,
+                        metrics,
+                        tracer,
+                    )
+
+            await verify_queue.close()
+
+        await output_queue.close()
+        await dead_queue.close()
+        metrics_done.set()
+        verifier.close()
+        if follow_up_client is not None:
+            await follow_up_client.aclose()
 
     # Cursor, trio automatically joins the nursery. We don't need to do anything here.
 
+    failed = (await kv_store.get("requests_failed")).unwrap()
+    if failed > 0 and config.output is not None:
+        log.error(f"{failed} request(s) failed for good, see {dead_letter_path(config.output.path)}")
     log.info("All requests completed!")
+    if config.metrics is not None:
+        # One last time, so the file has the final numbers
+        write_metrics(config.metrics.path, metrics.render(config.metrics.format))
+    if tracer is not None:
+        # Whatever came in since the last flush (the final merge included), and close the array
+        tracer.flush(tracer.take(), close=True)
+        log.info(f"Trace written to {tracer.path}")
+    for line in metrics.summary():
+        log.info(line)
+    if config.api.stream:
+        log_stream_summary(metrics, log)
+    if limiter is not None:
+        log.info(f"Adaptive concurrency finished at {int(limiter.limit)} requests in flight")
+    if len(balancer.endpoints) > 1:
+        log_endpoint_summary(balancer, log)
+    if hedger is not None and hedger.requests > 0:
+        log.info(
+            f"Hedged {hedger.hedges} of {hedger.requests} requests ({hedger.hedges / hedger.requests:.1%}), "
+            f"the hedge answered first {hedger.hedge_wins} time(s)"
+        )
+    if verification.checks:
+        log.info(f"Verification: {verifier.passed} passed, {verifier.failed} failed")
+    if cache is not None:
+        lookups = cache.hits + cache.misses
+        if lookups > 0:
+            log.info(f"Response cache: {cache.hits} hits, {cache.misses} misses ({cache.hits / lookups:.0%} hit rate)")
+        cache.close()
 
     return Ok(None)
 
+def cli() -> None:
+    parser = argparse.ArgumentParser(description="Run a dataset through an OpenAI-compatible API.")
+    parser.add_argument("--config", default="./config.toml", help="path to the config file")
+    parser.add_argument("--shards", type=int, help="split the run across this many local processes, then merge their outputs")
+    parser.add_argument("--shard-index", type=int, help="only run this shard, e.g. to spread a job across machines")
+    parser.add_argument("--shard-count", type=int, help="how many shards the job is split into")
+    parser.add_argument("--merge", action="store_true", help="merge the outputs of --shard-count finished shards and exit")
+    args = parser.parse_args()
+
+    if args.shards is not None:
+        if args.shards < 1:
+            parser.error("--shards must be at least 1")
+        config = Config.from_toml(args.config).unwrap()
+        result = run_shards(main, args.config, config, args.shards)
+    elif args.merge:
+        if args.shard_count is None:
+            parser.error("--merge needs --shard-count")
+        config = Config.from_toml(args.config).unwrap()
+        result = merge_shards(config, args.shard_count, LogBar(name="main"))
+    elif args.shard_index is not None or args.shard_count is not None:
+        if args.shard_index is None or args.shard_count is None:
+            parser.error("--shard-index and --shard-count go together")
+        if not 0 <= args.shard_index < args.shard_count:
+            parser.error("--shard-index must be between 0 and --shard-count - 1")
+        shard = Shard(args.shard_index, args.shard_count)
+        result = trio.run(main, args.config, shard, restrict_keyboard_interrupt_to_checkpoints=True) # type: ignore
+    else:
+        result = trio.run(main, args.config, restrict_keyboard_interrupt_to_checkpoints=True) # type: ignore // what the fuck?
+
+    if result._error is not None:
+        LogBar(name="main").error(f"{result.unwrap_err()}")
+        sys.exit(1)
+
 if __name__ == "__main__":
-    trio.run(main, restrict_keyboard_interrupt_to_checkpoints=True) # type: ignore // what the fuck?
+    cli()
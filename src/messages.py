@@ -1,43 +1,192 @@
-from msgspec import Struct
-from msgspec import json as msgspec_json
+from msgspec import Struct, structs, UNSET
 from result import Result, Ok, Err, is_ok
 from http_client import AsyncHttpClient
+from codec import ChatCompletion, ChatRequestBody, Message, StreamOptions, Usage, encode_body, decode_completion, decode_chunk
 from typing import Self
-from httpx import Response
+import time
+import httpx
 
-class Message(Struct, omit_defaults=True):
-    role: str
-    content: str
-    reasoning: str | None = None
+class Timings(Struct):
+    """Per-request latency numbers, only collected when streaming."""
+    ttft: float | None = None # seconds until the first generated token
+    inter_token_latency: float | None = None # mean seconds between generated chunks
+    tokens_per_second: float | None = None # generation throughput after the first token
+    duration: float = 0.0 # seconds from sending the request to the end of the stream
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Column holding each row's position in the source dataset, carried through to the output
+ROW_ID_COLUMN = "row_id"
+# Which of a row's samples an output row is, when asking for more than one per prompt
+SAMPLE_INDEX_COLUMN = "sample_index"
 
 class Request(Struct):
     messages: list[Message]
+    row_id: int | None = None
     temperature: float | None = None
     top_p: float | None = None
+    max_tokens: int | None = None
+    usage: Usage | None = None
+    timings: Timings | None = None
+    attempts: int = 0
+    estimated_tokens: int | None = None # prompt size worked out when the dataset was loaded
+    n: int | None = None # completions to ask for in one call
+    sample_index: int | None = None # which of the row's samples this is, if there's more than one
+    regenerations: int = 0 # times a response was thrown away for failing verification
+    queued_at: float | None = None # trio clock time it was last put on a queue, for metrics
+    turn: int = 0 # user messages added to the conversation since it was loaded
+    follow_ups: list[str | None] | None = None # the user's later messages, for conversations with them in a column
+
+    def discard_response(self) -> Self:
+        """The request as it was before `req` appended the assistant's reply."""
+        return structs.replace(self, messages=self.messages[:-1], usage=None)
 
-    _raw_response: Result[Response] | None = None
+    def sample_count(self) -> int:
+        """How many output rows this request turns into."""
+        return self.n if self.n is not None else 1
+
+    def estimate_prompt_tokens(self) -> int:
+        """Rough prompt size: ~4 characters per token plus a few tokens of framing per message."""
+        if self.estimated_tokens is not None:
+            return self.estimated_tokens
+        return sum(len(message.content) // 4 + 4 for message in self.messages)
     
-    async def req(self, http_client: AsyncHttpClient, model: str) -> Result[Self]:
+    def _body(self, model: str, stream: bool = False) -> bytes:
+        """The JSON request body. Keys are sorted so identical requests always encode to the same bytes."""
+        return encode_body(ChatRequestBody(
+            max_tokens=self.max_tokens,
+            messages=self.messages,
+            model=model,
+            n=self.n if self.n is not None else UNSET,
+            stream=True if stream else UNSET,
+            stream_options=StreamOptions(include_usage=True) if stream else UNSET,
+            temperature=self.temperature,
+            top_p=self.top_p,
+        ))
+
+    def _with_response(self, content: str, reasoning: str | None, usage: Usage | None, timings: Timings | None = None) -> Self:
+        messages = self.messages + [Message(role="assistant", content=content, reasoning=reasoning)]
+        return structs.replace(self, messages=messages, usage=usage, timings=timings)
+
+    def _with_choices(self, choices: list[tuple[str, str | None]], usage: Usage | None, timings: Timings | None = None) -> list[Self]:
+        """One request per returned choice, each answering a single sample of this row.
+
+        Usage covers the whole call, so only the first sample carries it.
+        """
+        return [
+            structs.replace(
+                self._with_response(content, reasoning, usage if index == 0 else None, timings),
+                n=None,
+                sample_index=self.sample_index if self.sample_index is not None else index if self.n is not None else None,
+            )
+            for index, (content, reasoning) in enumerate(choices)
+        ]
+    
+    def with_completion(self, completion: ChatCompletion) -> list[Self]:
+        """One request per choice in a decoded chat completion, answering this one."""
+        choices = sorted(completion.choices, key=lambda choice: choice.index)
+        return self._with_choices(
+            [
+                (choice.message.content or "", choice.message.reasoning_content or choice.message.reasoning)
+                for choice in choices
+            ],
+            completion.usage,
+        )
+
+    async def req(self, http_client: AsyncHttpClient, model: str) -> Result[list[Self]]:
         res = await http_client.post(
             url="/chat/completions",
-            json={
-                "model": model,
-                "messages": msgspec_json.decode(msgspec_json.encode(self.messages).decode()), # TODO: what the fuck
-                "temperature": self.temperature,
-                "top_p": self.top_p
-            },
+            content=self._body(model),
+            headers=JSON_HEADERS,
         )
-        self._raw_response = res
-        res = res.map_ok(lambda res: res.json())
         if is_ok(res):
-            res = res.unwrap()
-            messages = self.messages + [
-                Message(
-                    role="assistant",
-                    content=res["choices"][0]["message"]["content"],
-                    reasoning=res["choices"][0]["message"].get("reasoning_content"),
-                )
-            ]
-            return Ok(Request(messages=messages))
+            try:
+                # Only the decoded fields are kept, so the response body can be freed straight away
+                return Ok(self.with_completion(decode_completion(res.unwrap().raise_for_status().content)))
+            except Exception as e:
+                return Err(e)
         else:
             return Err(res.unwrap_err())
+
+    async def req_stream(self, http_client: AsyncHttpClient, model: str, timeout: float, idle_timeout: float) -> Result[list[Self]]:
+        """Like `req`, but consumes the server-sent event stream as it's generated.
+
+        `idle_timeout` bounds the gap between chunks rather than the whole
+        response, so long generations don't time out as long as tokens keep coming.
+        """
+        body = self._body(model, stream=True)
+        # Keyed by choice index, since with `n` the choices' chunks arrive interleaved
+        content: dict[int, list[str]] = {}
+        reasoning: dict[int, list[str]] = {}
+        usage: Usage | None = None
+        # A body can end cleanly partway through, so a response only counts once the stream says it's over
+        done = False
+        finished: set[int] = set()
+        start = time.perf_counter()
+        first_token: float | None = None
+        last_token: float | None = None
+        chunks = 0
+
+        try:
+            async with http_client.stream(
+                "POST",
+                "/chat/completions",
+                content=body,
+                headers=JSON_HEADERS,
+                timeout=httpx.Timeout(timeout, read=idle_timeout),
+            ) as response:
+                if response.is_error:
+                    await response.aread()
+                    response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        done = True
+                        break
+
+                    chunk = decode_chunk(data)
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+
+                    for choice in chunk.choices:
+                        index = choice.index
+                        delta = choice.delta
+                        text = delta.content if delta is not None else None
+                        thought = (delta.reasoning_content or delta.reasoning) if delta is not None else None
+                        content.setdefault(index, [])
+                        if choice.finish_reason is not None:
+                            finished.add(index)
+                        if text:
+                            content[index].append(text)
+                        if thought:
+                            reasoning.setdefault(index, []).append(thought)
+                        if text or thought:
+                            last_token = time.perf_counter()
+                            if first_token is None:
+                                first_token = last_token
+                            chunks += 1
+        except Exception as e:
+            return Err(e)
+        if not content:
+            return Err(httpx.RemoteProtocolError("Stream ended without any choices"))
+        if not done and not finished.issuperset(content):
+            return Err(httpx.RemoteProtocolError("Stream ended before the response was finished"))
+
+        end = time.perf_counter()
+        timings = Timings(duration=end - start)
+        if first_token is not None and last_token is not None:
+            timings.ttft = first_token - start
+            generated = usage.completion_tokens if usage is not None and usage.completion_tokens > 0 else chunks
+            if chunks > 1:
+                timings.inter_token_latency = (last_token - first_token) / (chunks - 1)
+            if last_token > first_token:
+                timings.tokens_per_second = (generated - 1) / (last_token - first_token)
+
+        choices = [
+            ("".join(content[index]), "".join(reasoning.get(index, [])) or None)
+            for index in sorted(content)
+        ]
+        return Ok(self._with_choices(choices, usage, timings))
@@ -0,0 +1,199 @@
+import math
+import os
+import time
+import msgspec
+from typing import Any, Callable
+from config import MetricsFormat
+
+class Histogram:
+    """Log-bucketed histogram in the spirit of HdrHistogram.
+
+    Every value lands in a bucket no wider than `precision` of itself, so
+    percentiles come out within that relative error while memory only grows
+    with the range of values seen, not how many there were.
+    """
+
+    def __init__(self, name: str, help: str, unit: str = "seconds", precision: float = 0.01):
+        self.name = name
+        self.help = help
+        self.unit = unit
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._scale = 1 / math.log1p(precision)
+        self._zeros = 0
+        self._buckets: dict[int, int] = {}
+
+    def record(self, value: float) -> None:
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+        if value <= 0:
+            self._zeros += 1
+            return
+        bucket = math.floor(math.log(value) * self._scale)
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def percentile(self, q: float) -> float:
+        if self.count == 0:
+            return math.nan
+        rank = max(1, math.ceil(q * self.count))
+        if rank <= self._zeros:
+            return min(self.min, 0.0)
+        seen = self._zeros
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                # The bucket's upper edge, but never past what was actually seen
+                return min(math.exp((bucket + 1) / self._scale), self.max)
+        return self.max
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count > 0 else math.nan
+
+QUANTILES = [0.5, 0.9, 0.99, 0.999]
+
+class Metrics:
+    """Per-request latency histograms and throughput counters for one run.
+
+    Stages record into it as requests go by. `snapshot` (and the Prometheus
+    or JSON renderings of it) can be taken at any point; gauges are read
+    from their callbacks at that moment, e.g. for queue depths.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.input_wait = Histogram("input_wait_seconds", "Time requests spent in the input queue before a worker picked them up")
+        self.send = Histogram("send_seconds", "Time to get a response, including waiting on limits, hedges and the cache")
+        self.http = Histogram("http_seconds", "Duration of each HTTP call to the API")
+        self.ttft = Histogram("ttft_seconds", "Time to the first streamed token")
+        self.inter_token_latency = Histogram("inter_token_latency_seconds", "Mean time between streamed chunks, per request")
+        self.generation_rate = Histogram("generation_tokens_per_second", "Generation throughput after the first token, per streamed request", unit="tokens/s")
+        self.verify_wait = Histogram("verify_seconds", "Time from a response arriving to it being verified, queueing included")
+        self.checkpoint_write = Histogram("checkpoint_write_seconds", "Time to append a batch to the checkpoint")
+        self.prompt_tokens = Histogram("prompt_tokens", "Prompt tokens per request, from usage", unit="tokens")
+        self.completion_tokens = Histogram("completion_tokens", "Completion tokens per request, from usage", unit="tokens")
+        self.counters: dict[str, int] = {
+            "http_requests": 0,
+            "http_errors": 0,
+            "retries": 0,
+            "regenerations": 0,
+            "turns": 0,
+            "dead_letters": 0,
+            "completed": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+        self.gauges: dict[str, Callable[[], float]] = {}
+        self._last_snapshot: tuple[float, dict[str, int]] | None = None
+
+    @property
+    def histograms(self) -> list[Histogram]:
+        return [
+            self.input_wait,
+            self.send,
+            self.http,
+            self.ttft,
+            self.inter_token_latency,
+            self.generation_rate,
+            self.verify_wait,
+            self.checkpoint_write,
+            self.prompt_tokens,
+            self.completion_tokens,
+        ]
+
+    def count(self, name: str, amount: int = 1) -> None:
+        self.counters[name] += amount
+
+    def snapshot(self) -> dict[str, Any]:
+        """Everything recorded so far, plus throughput over the whole run and since the last snapshot."""
+        now = time.monotonic()
+        elapsed = now - self.start
+        previous_time, previous = self._last_snapshot if self._last_snapshot is not None else (self.start, {})
+        interval = now - previous_time
+        self._last_snapshot = (now, dict(self.counters))
+        return {
+            "elapsed_seconds": elapsed,
+            "counters": dict(self.counters),
+            "rates": {
+                f"{name}_per_second": value / elapsed if elapsed > 0 else 0.0
+                for name, value in self.counters.items()
+            },
+            "recent_rates": {
+                f"{name}_per_second": (value - previous.get(name, 0)) / interval if interval > 0 else 0.0
+                for name, value in self.counters.items()
+            },
+            "gauges": {name: gauge() for name, gauge in self.gauges.items()},
+            "histograms": {
+                histogram.name: {
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "mean": histogram.mean if histogram.count > 0 else None,
+                    "min": histogram.min if histogram.count > 0 else None,
+                    "max": histogram.max if histogram.count > 0 else None,
+                    **{
+                        f"p{q * 100:g}": histogram.percentile(q) if histogram.count > 0 else None
+                        for q in QUANTILES
+                    },
+                }
+                for histogram in self.histograms
+            },
+        }
+
+    def prometheus(self) -> str:
+        """The current numbers in Prometheus' text exposition format, histograms as summaries."""
+        snapshot = self.snapshot()
+        lines: list[str] = []
+        for name, value in snapshot["counters"].items():
+            lines += [f"# TYPE polymerase_{name}_total counter", f"polymerase_{name}_total {value}"]
+        for name, value in snapshot["gauges"].items():
+            lines += [f"# TYPE polymerase_{name} gauge", f"polymerase_{name} {value}"]
+        lines += ["# TYPE polymerase_elapsed_seconds gauge", f"polymerase_elapsed_seconds {snapshot['elapsed_seconds']:.3f}"]
+        for histogram in self.histograms:
+            name = f"polymerase_{histogram.name}"
+            lines += [f"# HELP {name} {histogram.help}", f"# TYPE {name} summary"]
+            if histogram.count > 0:
+                lines += [f'{name}{{quantile="{q:g}"}} {histogram.percentile(q):.6g}' for q in QUANTILES]
+            lines += [f"{name}_sum {histogram.sum:.6g}", f"{name}_count {histogram.count}"]
+        return "\n".join(lines) + "\n"
+
+    def render(self, format: MetricsFormat) -> bytes:
+        match format:
+            case MetricsFormat.PROMETHEUS:
+                return self.prometheus().encode()
+            case MetricsFormat.JSON:
+                return msgspec.json.format(msgspec.json.encode(self.snapshot())) + b"\n"
+            case _:
+                raise ValueError(f"Invalid metrics format: {format}")
+
+    def summary(self) -> list[str]:
+        """One line per histogram with anything in it, plus overall throughput."""
+        def describe(histogram: Histogram, value: float) -> str:
+            if histogram.unit == "seconds":
+                return f"{value * 1000:.1f}ms"
+            return f"{value:.0f}"
+
+        lines = []
+        for histogram in self.histograms:
+            if histogram.count == 0:
+                continue
+            percentiles = ", ".join(f"p{q * 100:g} {describe(histogram, histogram.percentile(q))}" for q in QUANTILES[:3])
+            lines.append(f"{histogram.name}: {percentiles}, max {describe(histogram, histogram.max)} ({histogram.count} samples)")
+        elapsed = time.monotonic() - self.start
+        if elapsed > 0:
+            lines.append(
+                f"throughput: {self.counters['completed'] / elapsed:.1f} requests/s, "
+                f"{self.counters['completion_tokens'] / elapsed:.0f} completion tokens/s, "
+                f"{self.counters['retries']} retries, {self.counters['regenerations']} regenerations"
+            )
+        return lines
+
+def write_metrics(path: str, data: bytes) -> None:
+    """Replace `path` with `data`, through a temporary file so readers never see half of it."""
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as f:
+        f.write(data)
+    os.replace(temporary, path)
@@ -0,0 +1,389 @@
+"""A stand-in OpenAI-compatible `/chat/completions` server, for benchmarks and offline testing.
+
+Responses are made up, but how long they take isn't: each request waits a
+lognormally distributed time to first token, then generates at a fixed
+tokens/sec, optionally streaming it as server-sent events. A share of
+requests can be failed with 500s or 429s to exercise retries.
+
+Prompt processing can be modelled too, with `prefill_tokens_per_second`:
+prompts are prefilled one at a time, like on a GPU, and the server keeps
+the last `prefix_cache_size` prompt prefixes (every message but the last)
+around, so a request that shares one only pays for its last message.
+`GET /stats` reports the cache's hits and misses.
+
+It also speaks enough of the batch API (`/files` and `/batches`) for batch
+mode: a batch sits in progress for `batch_latency` seconds, then every line
+in it is answered at once, with `error_rate` of them failing.
+
+    uv run src/mock_server.py --port 8000 --latency 0.2 --tokens-per-second 100
+"""
+import argparse
+import email.parser
+import email.policy
+import math
+import random
+import re
+from collections import OrderedDict
+import h11 # comes with httpx
+import msgspec
+import trio
+from msgspec import Struct
+from msgspec import json as msgspec_json
+from typing import Any
+
+WORDS = "the of and to in is that for it as with was on be by this are or from at which an have not".split()
+
+class MockConfig(Struct):
+    latency: float = 0.05 # median seconds until the first token
+    latency_sigma: float = 0.5 # spread of the lognormal time to first token, 0 for a fixed latency
+    tokens_per_second: float = 200.0 # generation speed after the first token, per request
+    completion_tokens: int = 64 # tokens generated, unless the request's max_tokens is lower
+    chunk_tokens: int = 4 # tokens per streamed chunk
+    error_rate: float = 0.0 # fraction of requests answered with a 500
+    rate_limit_rate: float = 0.0 # fraction of requests answered with a 429
+    retry_after: float = 1.0 # seconds, sent with each 429
+    batch_latency: float = 2.0 # seconds a batch spends in progress before it completes
+    prefill_tokens_per_second: float = 0.0 # prompt processing speed, shared by every request. 0 makes prefill free
+    prefix_cache_size: int = 0 # prompt prefixes kept prefilled, least recently used dropped first
+
+class ChatMessage(Struct):
+    content: str | None = None
+
+class ChatRequest(Struct):
+    messages: list[ChatMessage] = []
+    max_tokens: int | None = None
+    n: int | None = None
+    stream: bool = False
+
+class BatchInputLine(Struct):
+    custom_id: str
+    body: ChatRequest
+
+class CreateBatch(Struct):
+    input_file_id: str
+    endpoint: str = "/v1/chat/completions"
+    completion_window: str = "24h"
+
+class Batch:
+    def __init__(self, id: str, input_file_id: str, endpoint: str, completion_window: str, created: float):
+        self.id = id
+        self.input_file_id = input_file_id
+        self.endpoint = endpoint
+        self.completion_window = completion_window
+        self.created = created
+        self.status = "validating"
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.output_file_id: str | None = None
+        self.error_file_id: str | None = None
+        self.errors: list[dict[str, Any]] = [] # why the batch as a whole failed, if it did
+
+    def describe(self) -> dict[str, Any]:
+        return {
+            "id": self.id,
+            "object": "batch",
+            "endpoint": self.endpoint,
+            "completion_window": self.completion_window,
+            "status": self.status,
+            "input_file_id": self.input_file_id,
+            "output_file_id": self.output_file_id,
+            "error_file_id": self.error_file_id,
+            "request_counts": {"total": self.total, "completed": self.completed, "failed": self.failed},
+            "errors": {"object": "list", "data": self.errors} if self.errors else None,
+        }
+
+FILE_CONTENT = re.compile(rb".*/files/([^/]+)/content$")
+BATCH = re.compile(rb".*/batches/([^/]+)$")
+
+class MockServer:
+    """Answers chat completion and batch requests over HTTP/1.1 with keep-alive, one trio task per connection."""
+
+    def __init__(self, config: MockConfig, seed: int | None = None):
+        self.config = config
+        self.requests = 0
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, Batch] = {}
+        self.prefix_hits = 0
+        self.prefix_misses = 0
+        self._prefixes: OrderedDict[tuple[str, ...], None] = OrderedDict()
+        self._prefill_lock = trio.Lock()
+        self._random = random.Random(seed)
+        self._decoder = msgspec_json.Decoder(ChatRequest)
+        self._line_decoder = msgspec_json.Decoder(BatchInputLine)
+        self._encoder = msgspec_json.Encoder()
+
+    def ttft(self) -> float:
+        if self.config.latency_sigma <= 0:
+            return self.config.latency
+        return self.config.latency * math.exp(self._random.gauss(0.0, self.config.latency_sigma))
+
+    async def prefill(self, chat: ChatRequest) -> None:
+        """Wait while the prompt is processed, less any prefix of it that's still cached."""
+        if self.config.prefill_tokens_per_second <= 0:
+            return
+        tokens = [len(message.content or "") // 4 + 4 for message in chat.messages]
+        prefix = tuple(message.content or "" for message in chat.messages[:-1])
+        # One prompt at a time, so every miss holds up everyone queued behind it
+        async with self._prefill_lock:
+            if prefix and prefix in self._prefixes:
+                self._prefixes.move_to_end(prefix)
+                self.prefix_hits += 1
+                uncached = sum(tokens[len(prefix):])
+            else:
+                self.prefix_misses += 1
+                uncached = sum(tokens)
+                if prefix and self.config.prefix_cache_size > 0:
+                    self._prefixes[prefix] = None
+                    if len(self._prefixes) > self.config.prefix_cache_size:
+                        self._prefixes.popitem(last=False)
+            await trio.sleep(uncached / self.config.prefill_tokens_per_second)
+
+    def completion(self, tokens: int) -> list[str]:
+        return [" " + self._random.choice(WORDS) for _ in range(tokens)]
+
+    async def handle(self, stream: trio.SocketStream) -> None:
+        connection = h11.Connection(h11.SERVER)
+        try:
+            while True:
+                request = await self._next_event(stream, connection)
+                if not isinstance(request, h11.Request):
+                    return
+                body = b""
+                while isinstance(event := await self._next_event(stream, connection), h11.Data):
+                    body += event.data
+                await self._respond(stream, connection, request, body)
+                if connection.our_state is not h11.DONE or connection.their_state is not h11.DONE:
+                    return
+                connection.start_next_cycle()
+        except (trio.BrokenResourceError, trio.ClosedResourceError, h11.RemoteProtocolError):
+            pass
+        finally:
+            await stream.aclose()
+
+    async def _next_event(self, stream: trio.SocketStream, connection: h11.Connection) -> Any:
+        while (event := connection.next_event()) is h11.NEED_DATA:
+            connection.receive_data(await stream.receive_some(65536))
+        return event
+
+    async def _send(self, stream: trio.SocketStream, connection: h11.Connection, event: Any) -> None:
+        data = connection.send(event)
+        if data:
+            await stream.send_all(data)
+
+    async def _send_json(self, stream: trio.SocketStream, connection: h11.Connection, status: int, body: Any, headers: list[tuple[str, str]] = []) -> None:
+        data = self._encoder.encode(body)
+        await self._send(stream, connection, h11.Response(status_code=status, headers=[
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(data))),
+            *headers,
+        ]))
+        await self._send(stream, connection, h11.Data(data=data))
+        await self._send(stream, connection, h11.EndOfMessage())
+
+    def _completion(self, chat: ChatRequest) -> tuple[list[list[str]], dict[str, int]]:
+        """The made-up choices for a request, and the usage to report for them."""
+        tokens = self.config.completion_tokens
+        if chat.max_tokens is not None:
+            tokens = min(tokens, chat.max_tokens)
+        choices = [self.completion(tokens) for _ in range(chat.n or 1)]
+        usage = {
+            "prompt_tokens": sum(len(message.content or "") // 4 + 4 for message in chat.messages),
+            "completion_tokens": tokens * len(choices),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        return choices, usage
+
+    def _completion_body(self, choices: list[list[str]], usage: dict[str, int]) -> dict[str, Any]:
+        return {
+            "object": "chat.completion",
+            "choices": [
+                {"index": index, "message": {"role": "assistant", "content": "".join(choice)}, "finish_reason": "length"}
+                for index, choice in enumerate(choices)
+            ],
+            "usage": usage,
+        }
+
+    async def _respond(self, stream: trio.SocketStream, connection: h11.Connection, request: h11.Request, body: bytes) -> None:
+        self.requests += 1
+        path = request.target.split(b"?")[0].rstrip(b"/")
+        if request.method == b"POST" and path.endswith(b"/chat/completions"):
+            await self._chat(stream, connection, body)
+        elif request.method == b"POST" and path.endswith(b"/files"):
+            await self._upload(stream, connection, request, body)
+        elif request.method == b"GET" and (match := FILE_CONTENT.match(path)):
+            await self._download(stream, connection, match.group(1).decode())
+        elif request.method == b"POST" and path.endswith(b"/batches"):
+            await self._create_batch(stream, connection, body)
+        elif request.method == b"GET" and (match := BATCH.match(path)):
+            await self._get_batch(stream, connection, match.group(1).decode())
+        elif request.method == b"GET" and path.endswith(b"/stats"):
+            stats = {"requests": self.requests, "prefix_hits": self.prefix_hits, "prefix_misses": self.prefix_misses}
+            await self._send_json(stream, connection, 200, stats)
+        else:
+            await self._send_json(stream, connection, 404, {"error": {"message": "Not found"}})
+
+    async def _upload(self, stream: trio.SocketStream, connection: h11.Connection, request: h11.Request, body: bytes) -> None:
+        content_type = dict(request.headers).get(b"content-type", b"")
+        # The email parser already knows multipart, it just needs the header in front
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(b"Content-Type: " + content_type + b"\r\n\r\n" + body)
+        data = None
+        if message.is_multipart():
+            for part in message.iter_parts():
+                if part.get_param("name", header="content-disposition") == "file":
+                    data = part.get_payload(decode=True)
+        if not isinstance(data, bytes):
+            await self._send_json(stream, connection, 400, {"error": {"message": "Expected a multipart upload with a `file`"}})
+            return
+        id = f"file-{len(self.files)}"
+        self.files[id] = data
+        await self._send_json(stream, connection, 200, {"id": id, "object": "file", "bytes": len(data), "purpose": "batch"})
+
+    async def _download(self, stream: trio.SocketStream, connection: h11.Connection, id: str) -> None:
+        data = self.files.get(id)
+        if data is None:
+            await self._send_json(stream, connection, 404, {"error": {"message": f"No such file: {id}"}})
+            return
+        await self._send(stream, connection, h11.Response(status_code=200, headers=[
+            ("Content-Type", "application/octet-stream"),
+            ("Content-Length", str(len(data))),
+        ]))
+        await self._send(stream, connection, h11.Data(data=data))
+        await self._send(stream, connection, h11.EndOfMessage())
+
+    async def _create_batch(self, stream: trio.SocketStream, connection: h11.Connection, body: bytes) -> None:
+        try:
+            create = msgspec_json.decode(body, type=CreateBatch)
+        except msgspec.DecodeError as e:
+            await self._send_json(stream, connection, 400, {"error": {"message": str(e)}})
+            return
+        if create.input_file_id not in self.files:
+            await self._send_json(stream, connection, 404, {"error": {"message": f"No such file: {create.input_file_id}"}})
+            return
+        batch = Batch(f"batch-{len(self.batches)}", create.input_file_id, create.endpoint, create.completion_window, trio.current_time())
+        self.batches[batch.id] = batch
+        await self._send_json(stream, connection, 200, batch.describe())
+
+    async def _get_batch(self, stream: trio.SocketStream, connection: h11.Connection, id: str) -> None:
+        batch = self.batches.get(id)
+        if batch is None:
+            await self._send_json(stream, connection, 404, {"error": {"message": f"No such batch: {id}"}})
+            return
+        if batch.status in ("validating", "in_progress"):
+            if trio.current_time() - batch.created >= self.config.batch_latency:
+                self._run_batch(batch)
+            else:
+                batch.status = "in_progress"
+        await self._send_json(stream, connection, 200, batch.describe())
+
+    def _run_batch(self, batch: Batch) -> None:
+        """Answer every line of the batch at once, splitting the answers into output and error files."""
+        outputs: list[bytes] = []
+        errors: list[bytes] = []
+        for number, line in enumerate(self.files[batch.input_file_id].splitlines()):
+            if not line.strip():
+                continue
+            batch.total += 1
+            try:
+                request = self._line_decoder.decode(line)
+            except msgspec.DecodeError as e:
+                # Real servers refuse the whole batch over a bad line
+                batch.status = "failed"
+                batch.errors.append({"code": "invalid_json_line", "line": number + 1, "message": str(e)})
+                return
+            if self._random.random() < self.config.error_rate:
+                batch.failed += 1
+                response = {"status_code": 500, "body": {"error": {"message": "Mock server error"}}}
+                errors.append(self._encoder.encode({"custom_id": request.custom_id, "response": response, "error": None}))
+                continue
+            batch.completed += 1
+            response = {"status_code": 200, "body": self._completion_body(*self._completion(request.body))}
+            outputs.append(self._encoder.encode({"custom_id": request.custom_id, "response": response, "error": None}))
+
+        batch.status = "completed"
+        if outputs:
+            batch.output_file_id = f"{batch.id}-output"
+            self.files[batch.output_file_id] = b"\n".join(outputs) + b"\n"
+        if errors:
+            batch.error_file_id = f"{batch.id}-errors"
+            self.files[batch.error_file_id] = b"\n".join(errors) + b"\n"
+
+    async def _chat(self, stream: trio.SocketStream, connection: h11.Connection, body: bytes) -> None:
+        try:
+            chat = self._decoder.decode(body)
+        except msgspec.DecodeError as e:
+            await self._send_json(stream, connection, 400, {"error": {"message": str(e)}})
+            return
+
+        roll = self._random.random()
+        if roll < self.config.error_rate:
+            await trio.sleep(self.ttft())
+            await self._send_json(stream, connection, 500, {"error": {"message": "Mock server error"}})
+            return
+        if roll < self.config.error_rate + self.config.rate_limit_rate:
+            await self._send_json(
+                stream, connection, 429, {"error": {"message": "Mock rate limit"}},
+                headers=[("Retry-After", str(self.config.retry_after))],
+            )
+            return
+
+        choices, usage = self._completion(chat)
+        await self.prefill(chat)
+        await trio.sleep(self.ttft())
+        if chat.stream:
+            await self._stream(stream, connection, choices, usage)
+            return
+        await trio.sleep(len(choices[0]) / self.config.tokens_per_second)
+        await self._send_json(stream, connection, 200, self._completion_body(choices, usage))
+
+    async def _stream(self, stream: trio.SocketStream, connection: h11.Connection, choices: list[list[str]], usage: dict[str, int]) -> None:
+        # No Content-Length, so h11 sends the body chunked
+        await self._send(stream, connection, h11.Response(status_code=200, headers=[("Content-Type", "text/event-stream")]))
+
+        async def event(data: Any) -> None:
+            encoded = data if isinstance(data, bytes) else self._encoder.encode(data)
+            await self._send(stream, connection, h11.Data(data=b"data: " + encoded + b"\n\n"))
+
+        step = max(1, self.config.chunk_tokens)
+        for start in range(0, len(choices[0]), step):
+            if start > 0:
+                await trio.sleep(step / self.config.tokens_per_second)
+            await event({
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {"index": index, "delta": {"content": "".join(choice[start:start + step])}}
+                    for index, choice in enumerate(choices)
+                ],
+            })
+        await event({"object": "chat.completion.chunk", "choices": [], "usage": usage})
+        await event(b"[DONE]")
+        await self._send(stream, connection, h11.EndOfMessage())
+
+async def serve(server: MockServer, host: str, port: int, task_status: Any = trio.TASK_STATUS_IGNORED) -> None:
+    """Serve until cancelled. Started with `nursery.start`, reports the port it ended up on (for `port = 0`)."""
+    listeners = await trio.open_tcp_listeners(port, host=host)
+    task_status.started(listeners[0].socket.getsockname()[1])
+    await trio.serve_listeners(server.handle, listeners)
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(description="Run a mock OpenAI-compatible chat completions server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000, help="0 to pick a free port")
+    parser.add_argument("--seed", type=int, help="seed for latencies, errors and generated text")
+    defaults = MockConfig()
+    for name, value in msgspec.structs.asdict(defaults).items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+
+    config = MockConfig(**{name: getattr(args, name) for name in MockConfig.__struct_fields__})
+    server = MockServer(config, args.seed)
+
+    async def run() -> None:
+        async with trio.open_nursery() as nursery:
+            port = await nursery.start(serve, server, args.host, args.port)
+            print(f"Listening on http://{args.host}:{port}", flush=True)
+
+    trio.run(run)
+
+if __name__ == "__main__":
+    cli()
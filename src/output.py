@@ -1,12 +1,43 @@
+import gzip
+import os
+import shutil
 import polars as pl
 from result import Result, Err, Ok
-from config import DataType, DataFormat, Config
-from messages import Request
+from config import Compression, DataType, DataFormat, Config
+from messages import Request, Message, ROW_ID_COLUMN, SAMPLE_INDEX_COLUMN
 from typing import Any
+import msgspec
+from msgspec import Struct
 
-def convert_requests_to_dataframe(requests: list[Request], format: DataFormat) -> Result[pl.DataFrame]:
-    """Convert a list of Request objects back to DataFrame format"""
+MESSAGE_DTYPE = pl.Struct({"role": pl.String, "content": pl.String, "reasoning": pl.String})
+
+def output_schema(format: DataFormat, samples: bool = False) -> pl.Schema:
+    """The columns every part of an output has, whatever's in it.
+
+    Parts are merged (and resumed from) as one dataset, so a column that
+    only turned up in the parts whose responses happened to have it, like
+    `reasoning`, would break the merge or go missing from it.
+    """
+    match format:
+        case DataFormat.MESSAGES_COLUMN:
+            columns: dict[str, pl.DataType] = {ROW_ID_COLUMN: pl.Int64(), "messages": pl.List(MESSAGE_DTYPE)}
+        case DataFormat.PROMPT_COLUMN:
+            columns = {ROW_ID_COLUMN: pl.Int64(), "prompt": pl.String(), "response": pl.String(), "reasoning": pl.String()}
+        case _:
+            raise ValueError(f"Invalid output format: {format}")
+    if samples:
+        columns[SAMPLE_INDEX_COLUMN] = pl.Int64()
+    return pl.Schema(columns)
+
+def configured_schema(config: Config) -> pl.Schema:
+    """`output_schema` for the output `config` writes."""
+    format = config.output.format if config.output is not None and config.output.format is not None else config.data.format
+    return output_schema(format, config.model.samples_per_prompt > 1)
+
+def convert_requests_to_dataframe(requests: list[Request], format: DataFormat, samples: bool = False) -> Result[pl.DataFrame]:
+    """Convert a list of Request objects back to DataFrame format, with the columns from `output_schema`"""
     try:
+        schema = output_schema(format, samples)
         if format == DataFormat.MESSAGES_COLUMN:
             # Convert messages to list of dicts for each request
             data = []
@@ -15,13 +46,15 @@ def convert_requests_to_dataframe(requests: list[Request], format: DataFormat) -
                 for msg in request.messages:
                     msg_dict = {
                         "role": msg.role,
-                        "content": msg.content
+                        "content": msg.content,
+                        "reasoning": msg.reasoning,
                     }
-                    if msg.reasoning is not None:
-                        msg_dict["reasoning"] = msg.reasoning
                     messages_list.append(msg_dict)
-                data.append({"messages": messages_list})
-            return Ok(pl.DataFrame(data))
+                row: dict[str, Any] = {ROW_ID_COLUMN: request.row_id, "messages": messages_list}
+                if samples:
+                    row[SAMPLE_INDEX_COLUMN] = request.sample_index
+                data.append(row)
+            return Ok(pl.DataFrame(data, schema=schema))
         
         elif format == DataFormat.PROMPT_COLUMN:
             # Extract prompts and responses
@@ -40,14 +73,11 @@ def convert_requests_to_dataframe(requests: list[Request], format: DataFormat) -
                         reasoning = msg.reasoning
                         break
                 
-                row: dict[str, Any] = {"prompt": prompt}
-                if response is not None:
-                    row["response"] = response
-                if reasoning is not None:
-                    row["reasoning"] = reasoning
-                    
+                row: dict[str, Any] = {ROW_ID_COLUMN: request.row_id, "prompt": prompt, "response": response, "reasoning": reasoning}
+                if samples:
+                    row[SAMPLE_INDEX_COLUMN] = request.sample_index
                 data.append(row)
-            return Ok(pl.DataFrame(data))
+            return Ok(pl.DataFrame(data, schema=schema))
         
         else:
             return Err(ValueError(f"Invalid output format: {format}"))
@@ -55,44 +85,293 @@ def convert_requests_to_dataframe(requests: list[Request], format: DataFormat) -
     except Exception as e:
         return Err(e)
 
-def save_dataframe(df: pl.DataFrame, path: str, type: DataType) -> Result[None]:
-    """Save a DataFrame to the specified path and format"""
-    try:
-        if type == DataType.JSONL:
-            df.write_ndjson(path)
-        elif type == DataType.PARQUET:
-            df.write_parquet(path)
-        elif type == DataType.HF:
-            # For HF, we'll save as parquet locally
-            # TODO: Could implement actual HF dataset push later
-            parquet_path = path.replace('.hf', '.parquet') if path.endswith('.hf') else f"{path}.parquet"
-            df.write_parquet(parquet_path)
-        else:
-            return Err(ValueError(f"Invalid output type: {type}"))
-        
-        return Ok(None)
-        
-    except Exception as e:
-        return Err(e)
+def hf_output_path(path: str) -> str:
+    return path.replace('.hf', '.parquet') if path.endswith('.hf') else f"{path}.parquet"
+
+def checkpoint_path(path: str) -> str:
+    """The folder the part files for the output at `path` are written to while a run goes."""
+    return f"{path}.checkpoint"
+
+def dead_letter_path(path: str) -> str:
+    return f"{path}.dead.jsonl"
 
-def save_requests(requests: list[Request], config: Config) -> Result[None]:
-    """Convert requests to DataFrame and save to file"""
+def batch_manifest_path(path: str) -> str:
+    """Where batch mode records the batches it has submitted for the output at `path`."""
+    return f"{path}.batches.json"
+
+def output_file(path: str, type: DataType) -> str:
+    """Where the merged output actually ends up, which for HF is a local parquet file."""
+    return hf_output_path(path) if type == DataType.HF else path
+
+def resolve_compression(type: DataType, compression: Compression | None) -> Compression:
+    """The configured compression, or the default for `type`: zstd for parquet, none for jsonl."""
+    if compression is None:
+        return Compression.NONE if type == DataType.JSONL else Compression.ZSTD
+    if type == DataType.JSONL and compression == Compression.ZSTD:
+        raise ValueError("jsonl output can't be zstd compressed, use gzip or parquet instead")
+    return compression
+
+def parquet_compression(compression: Compression) -> str:
+    match compression:
+        case Compression.ZSTD:
+            return "zstd"
+        case Compression.GZIP:
+            return "gzip"
+        case Compression.NONE:
+            return "uncompressed"
+        case _:
+            raise ValueError(f"Invalid compression: {compression}")
+
+def part_files(directory: str) -> list[str]:
+    """The finished part files in `directory`, in the order they were written."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith("part-") and not name.endswith(".tmp")
+    )
+
+@Result.resultify
+def sink_frame(frame: pl.LazyFrame, path: str, type: DataType, compression: Compression = Compression.ZSTD) -> str:
+    """Stream `frame` into the output file for `path`, returning where it went.
+
+    It's written to a temporary file first and renamed into place, so a
+    failed write never clobbers an earlier output.
+    """
+    target = output_file(path, type)
+    temporary = f"{target}.tmp"
+    match type:
+        case DataType.JSONL if compression == Compression.GZIP:
+            # Polars can't compress JSONL as it goes, so it's gzipped a chunk at a time afterwards
+            plain = f"{target}.plain.tmp"
+            frame.sink_ndjson(plain)
+            with open(plain, "rb") as source, gzip.open(temporary, "wb") as f:
+                shutil.copyfileobj(source, f)
+            os.remove(plain)
+        case DataType.JSONL:
+            frame.sink_ndjson(temporary)
+        case DataType.PARQUET | DataType.HF:
+            frame.sink_parquet(temporary, compression=parquet_compression(compression))
+        case _:
+            raise ValueError(f"Invalid output type: {type}")
+    os.replace(temporary, target)
+    return target
+
+def scan_output(path: str, type: DataType, schema: pl.Schema | None = None) -> list[pl.LazyFrame]:
+    """Lazily scan the merged output at `path` and any part files next to it, oldest first.
+
+    JSONL is read with `schema` (see `output_schema`) when it's given, since
+    otherwise the columns' types are guessed from the first rows alone.
+    """
+    if os.path.isfile(checkpoint_path(path)):
+        raise ValueError(f"{checkpoint_path(path)} is a file, not a folder of checkpoint parts, move it out of the way to resume")
+    frames: list[pl.LazyFrame] = []
+    match type:
+        case DataType.JSONL:
+            if os.path.isfile(path) and os.path.getsize(path) > 0:
+                frames.append(pl.scan_ndjson(path, schema=schema))
+            if parts := part_files(checkpoint_path(path)):
+                frames.append(pl.scan_ndjson(parts, schema=schema))
+        case DataType.PARQUET | DataType.HF:
+            output = output_file(path, type)
+            if os.path.isfile(output):
+                frames.append(pl.scan_parquet(output))
+            if parts := part_files(checkpoint_path(path)):
+                frames.append(pl.scan_parquet(parts))
+        case _:
+            raise ValueError(f"Invalid output type: {type}")
+    return frames
+
+@Result.resultify
+def scan_completed(config: Config) -> list[pl.LazyFrame]:
+    """Lazily scan every output and part file left behind by earlier runs."""
     if config.output is None:
-        return Err(ValueError("No output configuration provided"))
-    
-    # Use output format if specified, otherwise fall back to input format
-    output_format = config.output.format if config.output.format is not None else config.data.format
-    
-    # Convert to DataFrame
-    df_result = convert_requests_to_dataframe(requests, output_format)
-    if df_result._error is not None:
-        return Err(df_result.unwrap_err())
-    
-    df = df_result.unwrap()
-    
-    # Save DataFrame
-    save_result = save_dataframe(df, config.output.path, config.output.type)
-    if save_result._error is not None:
-        return Err(save_result.unwrap_err())
-    
-    return Ok(None) 
+        raise ValueError("No output configuration provided")
+    return scan_output(config.output.path, config.output.type, configured_schema(config))
+
+def output_keys(frame: pl.LazyFrame | pl.DataFrame) -> list[str]:
+    """The columns that identify an output row: the source row, and which sample of it if there are several."""
+    schema = frame.collect_schema()
+    return [ROW_ID_COLUMN, SAMPLE_INDEX_COLUMN] if SAMPLE_INDEX_COLUMN in schema else [ROW_ID_COLUMN]
+
+@Result.resultify
+def load_completed_row_ids(config: Config, samples_per_prompt: int = 1) -> pl.Series:
+    """Build a sorted, de-duplicated index of the row IDs earlier runs already finished.
+
+    With several samples per prompt, a row only counts once all of them are
+    done; rows that are partly done get run again in full.
+    """
+    frames = scan_completed(config).unwrap()
+    if not frames:
+        return pl.Series(ROW_ID_COLUMN, [], dtype=pl.UInt64)
+
+    for frame in frames:
+        if ROW_ID_COLUMN not in frame.collect_schema():
+            raise ValueError(f"Can't resume: existing output has no `{ROW_ID_COLUMN}` column")
+
+    if samples_per_prompt > 1:
+        for frame in frames:
+            if SAMPLE_INDEX_COLUMN not in frame.collect_schema():
+                raise ValueError(f"Can't resume: existing output has no `{SAMPLE_INDEX_COLUMN}` column")
+        return (
+            pl.concat([frame.select(pl.col(ROW_ID_COLUMN).cast(pl.UInt64), pl.col(SAMPLE_INDEX_COLUMN).cast(pl.Int64)) for frame in frames])
+            .group_by(ROW_ID_COLUMN)
+            .agg(pl.col(SAMPLE_INDEX_COLUMN).n_unique().alias("samples"))
+            .filter(pl.col("samples") >= samples_per_prompt)
+            .select(ROW_ID_COLUMN)
+            .sort(ROW_ID_COLUMN)
+            .collect()[ROW_ID_COLUMN]
+        )
+
+    return (
+        pl.concat([frame.select(pl.col(ROW_ID_COLUMN).cast(pl.UInt64)) for frame in frames])
+        .unique()
+        .sort(ROW_ID_COLUMN)
+        .collect()[ROW_ID_COLUMN]
+    )
+
+class OutputSink:
+    """Streams completed requests to disk as they come in, one part file at a time.
+
+    Each `write` turns its batch into a part file in `<output path>.checkpoint`,
+    written under a temporary name and renamed into place, so a crash never
+    leaves half a part behind and every part that's there can be resumed
+    from. Only the batch being written is ever held in memory. `merge` then
+    streams the parts (and, when resuming, the earlier output) into the one
+    output file and removes them.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        type: DataType,
+        format: DataFormat,
+        compression: Compression | None = None,
+        resume: bool = False,
+        samples: bool = False,
+    ):
+        self.path = path
+        self.type = type
+        self.format = format
+        self.resume = resume
+        self.samples = samples # whether rows are one of several samples, and so have a `sample_index`
+        self.directory = checkpoint_path(path)
+        self.rows_written = 0
+        self._parts_written = 0
+        self.compression = resolve_compression(type, compression)
+        self._prepared = False
+
+    @property
+    def extension(self) -> str:
+        if self.type != DataType.JSONL:
+            return "parquet"
+        return "jsonl.gz" if self.compression == Compression.GZIP else "jsonl"
+
+    def _prepare(self) -> None:
+        # Start from a clean folder the first time we write, unless we're
+        # resuming, in which case new parts go after the ones already there
+        if os.path.isfile(self.directory):
+            # Parts go in a folder, so whatever this file is, it isn't ours to resume from
+            if self.resume:
+                raise ValueError(f"{self.directory} is a file, not a folder of checkpoint parts, move it out of the way to resume")
+            os.remove(self.directory)
+        elif not self.resume:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+        self._parts_written = len(part_files(self.directory))
+        self._prepared = True
+
+    def write(self, requests: list[Request]) -> Result[None]:
+        """Write `requests` as the next part file. Safe to call from a worker thread."""
+        try:
+            if not self._prepared:
+                self._prepare()
+
+            df_result = convert_requests_to_dataframe(requests, self.format, self.samples)
+            if df_result._error is not None:
+                return Err(df_result.unwrap_err())
+            df = df_result.unwrap()
+
+            part = os.path.join(self.directory, f"part-{self._parts_written:05d}.{self.extension}")
+            temporary = f"{part}.tmp"
+            if self.type != DataType.JSONL:
+                df.write_parquet(temporary, compression=parquet_compression(self.compression))
+            elif self.compression == Compression.GZIP:
+                with gzip.open(temporary, "wb") as f:
+                    df.write_ndjson(f)
+            else:
+                df.write_ndjson(temporary)
+            os.replace(temporary, part)
+
+            self._parts_written += 1
+            self.rows_written += len(requests)
+            return Ok(None)
+
+        except Exception as e:
+            return Err(e)
+
+    def merge(self) -> Result[str]:
+        """Stream every part into the output file and remove them, returning the output's path.
+
+        When resuming, the earlier output is folded in too, keeping the newest
+        copy of any row that shows up twice.
+        """
+        try:
+            if not self._prepared:
+                self._prepare()
+
+            schema = output_schema(self.format, self.samples)
+            frames = scan_output(self.path, self.type, schema)
+            if not self.resume:
+                frames = frames[-1:] if part_files(self.directory) else []
+
+            if not frames:
+                # Still with every column, so a resumed run can read it back
+                merged = pl.DataFrame(schema=schema).lazy()
+            elif self.resume:
+                merged = pl.concat(frames, how="diagonal_relaxed")
+                keys = output_keys(merged)
+                merged = merged.unique(subset=keys, keep="last", maintain_order=True).sort(keys)
+            else:
+                merged = frames[0]
+
+            target = sink_frame(merged, self.path, self.type, self.compression).unwrap()
+            shutil.rmtree(self.directory, ignore_errors=True)
+            return Ok(target)
+
+        except Exception as e:
+            return Err(e)
+
+class DeadLetter(Struct, omit_defaults=True):
+    row_id: int | None
+    messages: list[Message]
+    error: str
+    attempts: int
+    sample_index: int | None = None
+    regenerations: int = 0
+
+class DeadLetterWriter:
+    """Appends requests we gave up on to a JSONL file next to the output."""
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.resume = resume
+        self.rows_written = 0
+        self._encoder = msgspec.json.Encoder()
+
+    def append(self, letters: list[DeadLetter]) -> Result[None]:
+        """Safe to call from a worker thread."""
+        try:
+            mode = "ab" if self.rows_written > 0 or self.resume else "wb"
+            with open(self.path, mode) as f:
+                for letter in letters:
+                    f.write(self._encoder.encode(letter) + b"\n")
+            self.rows_written += len(letters)
+            return Ok(None)
+
+        except Exception as e:
+            return Err(e)
@@ -1,13 +1,17 @@
-from trio import Lock
+from trio import Lock, Condition
 from result import Result
-from typing import Callable, Awaitable, Self
+from typing import AsyncIterator, Callable, Awaitable, Self
+from collections import deque
 import copy
+import heapq
+import itertools
 
 class AsyncKVStore[K,V]:
     def __init__(self, default_value: V, lock: Lock):
         self._store: dict[K, V] = {}
         self.default_value = default_value
         self.lock = lock
+        self._changed = Condition(lock)
 
     @Result.resultify_async
     async def get(self, key: K) -> V:
@@ -17,18 +21,38 @@ class AsyncKVStore[K,V]:
     async def set(self, key: K, value: V) -> None:
         async with self.lock:
             self._store[key] = value
+            self._changed.notify_all()
             return None
+
+    @Result.resultify_async
+    async def update(self, key: K, func: Callable[[V], V]) -> V:
+        """Atomically replace the value at `key` with `func(value)` and return it."""
+        async with self.lock:
+            value = func(self._store.get(key, self.default_value))
+            self._store[key] = value
+            self._changed.notify_all()
+            return value
+
+    @Result.resultify_async
+    async def wait_for(self, key: K, predicate: Callable[[V], bool]) -> V:
+        """Block until the value stored at `key` satisfies `predicate`."""
+        async with self.lock:
+            while not predicate(value := self._store.get(key, self.default_value)):
+                await self._changed.wait()
+            return value
     
     @Result.resultify_async
     async def delete(self, key: K) -> None:
         async with self.lock:
             del self._store[key]
+            self._changed.notify_all()
             return None
 
     @Result.resultify_async
     async def clear(self) -> None:
         async with self.lock:
             self._store.clear()
+            self._changed.notify_all()
             return None
 
     @Result.resultify_async
@@ -37,35 +61,162 @@ class AsyncKVStore[K,V]:
             await func(self)
             return None
 
+class QueueClosed(Exception):
+    """Raised when enqueueing to, or dequeueing from a drained, closed queue."""
+
 class AsyncQueue[T]:
-    def __init__(self, lock: Lock):
-        self._queue: list[T] = []
+    """FIFO queue where consumers block until work arrives.
+
+    Backed by a deque, so enqueue and dequeue are O(1) regardless of depth. With
+    `maxsize` set, `enqueue` blocks while the queue is full. `requeue` skips the
+    bound so consumers putting work back can never deadlock against producers.
+    Once `close` is called, consumers drain what is left and then get
+    `QueueClosed`. `on_put` is called with every item as it goes in.
+    """
+
+    def __init__(self, lock: Lock, maxsize: int | None = None, on_put: Callable[[T], None] | None = None):
+        self._queue: deque[T] = deque()
         self.lock = lock
+        self.maxsize = maxsize
+        self.on_put = on_put
+        self._closed = False
+        self._not_empty = Condition(lock)
+        self._not_full = Condition(lock)
 
     @staticmethod
-    def from_list(items: list[T], lock: Lock) -> Self:
-        queue = AsyncQueue[T](lock)
-        queue._queue = copy.deepcopy(items)
+    def from_list(items: list[T], lock: Lock, maxsize: int | None = None) -> Self:
+        queue = AsyncQueue[T](lock, maxsize)
+        queue._queue = deque(copy.deepcopy(items))
         return queue
 
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def __aiter__(self) -> Self:
+        return self
+
+    async def __anext__(self) -> T:
+        try:
+            return await self._get()
+        except QueueClosed:
+            raise StopAsyncIteration
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def _push(self, item: T) -> None:
+        self._queue.append(item)
+
+    def _pop(self) -> T:
+        return self._queue.popleft()
+
+    async def _put(self, item: T, bounded: bool) -> None:
+        async with self.lock:
+            while bounded and self.maxsize is not None and len(self) >= self.maxsize:
+                if self._closed:
+                    break
+                await self._not_full.wait()
+            if self._closed:
+                raise QueueClosed("Queue is closed")
+            if self.on_put is not None:
+                self.on_put(item)
+            self._push(item)
+            self._not_empty.notify()
+
+    async def _get(self) -> T:
+        async with self.lock:
+            while len(self) == 0:
+                if self._closed:
+                    raise QueueClosed("Queue is closed")
+                await self._not_empty.wait()
+            item = self._pop()
+            self._not_full.notify()
+            return item
+
+    async def _get_many(self, limit: int) -> list[T]:
+        async with self.lock:
+            while len(self) == 0:
+                if self._closed:
+                    raise QueueClosed("Queue is closed")
+                await self._not_empty.wait()
+            items = [self._pop() for _ in range(min(limit, len(self)))]
+            self._not_full.notify(len(items))
+            return items
+
+    async def batches(self, limit: int) -> AsyncIterator[list[T]]:
+        """Like iterating the queue, but hands out everything waiting (up to `limit` items) at once."""
+        while True:
+            try:
+                yield await self._get_many(limit)
+            except QueueClosed:
+                return
+
     @Result.resultify_async
     async def enqueue(self, item: T) -> None:
-        async with self.lock:
-            self._queue.append(item)
-            return None
+        await self._put(item, bounded=True)
+        return None
+
+    @Result.resultify_async
+    async def requeue(self, item: T) -> None:
+        await self._put(item, bounded=False)
+        return None
 
     @Result.resultify_async
     async def dequeue(self) -> T:
+        return await self._get()
+
+    @Result.resultify_async
+    async def close(self) -> None:
         async with self.lock:
-            return self._queue.pop(0)
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            return None
 
     @Result.resultify_async
     async def clear(self) -> None:
         async with self.lock:
             self._queue.clear()
+            self._not_full.notify_all()
             return None
 
     @Result.resultify_async
     async def size(self) -> int:
         async with self.lock:
-            return len(self._queue)
\ No newline at end of file
+            return len(self)
+
+class PriorityQueue[T](AsyncQueue[T]):
+    """`AsyncQueue` that hands out the item with the lowest `key` first.
+
+    Backed by a heap, so enqueue and dequeue are O(log n). Items with equal
+    keys come out in the order they went in.
+    """
+
+    def __init__(
+        self,
+        lock: Lock,
+        key: Callable[[T], float],
+        maxsize: int | None = None,
+        on_put: Callable[[T], None] | None = None,
+    ):
+        super().__init__(lock, maxsize, on_put)
+        self.key = key
+        self._heap: list[tuple[float, int, T]] = []
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def _push(self, item: T) -> None:
+        heapq.heappush(self._heap, (self.key(item), next(self._counter), item))
+
+    def _pop(self) -> T:
+        return heapq.heappop(self._heap)[2]
+
+    @Result.resultify_async
+    async def clear(self) -> None:
+        async with self.lock:
+            self._heap.clear()
+            self._not_full.notify_all()
+            return None
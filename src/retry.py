@@ -0,0 +1,70 @@
+import random
+import httpx
+from enum import Enum
+from http_client import parse_retry_after
+from messages import Request
+from config import RetryConfig
+
+class VerificationFailed(Exception):
+    """A response came back fine but didn't pass verification."""
+
+class ErrorClass(Enum):
+    RETRIABLE = "retriable"
+    TERMINAL = "terminal"
+
+def describe_error(error: BaseException) -> str:
+    """Some errors (timeouts in particular) have an empty message, so fall back to their type."""
+    return str(error) or type(error).__name__
+
+def classify_error(error: BaseException) -> ErrorClass:
+    """Timeouts, transport errors, 408/409/429 and 5xx are worth retrying. Any other 4xx won't change on a retry."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        if status in (408, 409, 429) or status >= 500:
+            return ErrorClass.RETRIABLE
+        return ErrorClass.TERMINAL
+    # Timeouts, dropped connections, malformed bodies...
+    return ErrorClass.RETRIABLE
+
+class RetryPolicy:
+    """Decides whether and when a failed request is tried again.
+
+    Retries back off exponentially with full jitter, honour `Retry-After`, stop
+    after `max_attempts` per request, and share a global budget of
+    `budget_min + budget_ratio * total_requests` retries across the run.
+    Responses that fail verification are regenerated straight away instead,
+    up to `max_regenerations` times, without touching either limit.
+    """
+
+    def __init__(self, config: RetryConfig, total_requests: int, max_regenerations: int = 3):
+        self.config = config
+        self.max_regenerations = max_regenerations
+        self.budget = config.budget_min + int(config.budget_ratio * total_requests)
+        self.retries = 0
+
+    def backoff(self, attempts: int) -> float:
+        ceiling = min(self.config.backoff_max, self.config.backoff_base * 2 ** (attempts - 1))
+        return random.uniform(0, ceiling)
+
+    def next_delay(self, request: Request, error: BaseException) -> float | None:
+        """Seconds to wait before retrying `request`, or None if it should be dead-lettered.
+
+        `request.attempts` (or `request.regenerations`, for failed verification)
+        must already count the attempt that just failed.
+        """
+        # A bad output isn't the server's fault, so there's nothing to back off from
+        if isinstance(error, VerificationFailed):
+            return 0.0 if request.regenerations <= self.max_regenerations else None
+
+        if classify_error(error) == ErrorClass.TERMINAL:
+            return None
+        if request.attempts >= self.config.max_attempts or self.retries >= self.budget:
+            return None
+
+        self.retries += 1
+        delay = self.backoff(request.attempts)
+        if isinstance(error, httpx.HTTPStatusError):
+            retry_after = parse_retry_after(error.response)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+        return delay
@@ -0,0 +1,170 @@
+import os
+import queue
+import shutil
+import multiprocessing
+import polars as pl
+import trio
+import time
+from msgspec import Struct, structs
+from typing import Any, Awaitable, Callable
+from result import Result, Ok, Err
+from logbar import LogBar
+from config import Config
+from output import resolve_compression, sink_frame, scan_output, output_file, dead_letter_path, output_keys, configured_schema
+
+class Shard(Struct, frozen=True):
+    index: int
+    count: int
+
+    def bounds(self, total: int) -> tuple[int, int]:
+        """This shard's contiguous slice of `total` rows, as [start, end)."""
+        return self.index * total // self.count, (self.index + 1) * total // self.count
+
+def shard_path(path: str, shard: Shard) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard.index:03d}-of-{shard.count:03d}{ext}"
+
+def shard_config(config: Config, shard: Shard) -> Config:
+    """The config a shard runs with: same everything, but its own output (and so its own checkpoint and dead letters), metrics and trace."""
+    if config.output is not None:
+        config = structs.replace(config, output=structs.replace(config.output, path=shard_path(config.output.path, shard)))
+    if config.metrics is not None:
+        config = structs.replace(config, metrics=structs.replace(config.metrics, path=shard_path(config.metrics.path, shard)))
+    if config.trace is not None:
+        config = structs.replace(config, trace=structs.replace(config.trace, path=shard_path(config.trace.path, shard)))
+    return config
+
+class ShardProgress:
+    """Stands in for the progress bar inside a shard, forwarding completions to the coordinator.
+
+    Completions are batched and sent at most every `interval` seconds, so a
+    fast shard doesn't spend its time talking to the coordinator.
+    """
+
+    def __init__(self, progress_queue: Any, shard: Shard, interval: float = 0.1):
+        self.queue = progress_queue
+        self.shard = shard
+        self.interval = interval
+        self._pending = 0
+        self._last_sent = 0.0
+
+    def start(self, total: int) -> None:
+        self.queue.put(("start", self.shard.index, total))
+
+    def next(self) -> None:
+        self._pending += 1
+
+    def draw(self) -> None:
+        if self._pending > 0 and time.monotonic() - self._last_sent >= self.interval:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._pending > 0:
+            self.queue.put(("progress", self.shard.index, self._pending))
+            self._pending = 0
+        self._last_sent = time.monotonic()
+
+def run_shard(
+    entrypoint: Callable[..., Awaitable[Result[None]]],
+    config_path: str,
+    shard: Shard,
+    progress_queue: Any,
+) -> None:
+    """Process target: run one shard on its own event loop (and so its own connection pool)."""
+    progress = ShardProgress(progress_queue, shard)
+    try:
+        trio.run(entrypoint, config_path, shard, progress, restrict_keyboard_interrupt_to_checkpoints=True)
+    finally:
+        progress.flush()
+
+def run_shards(
+    entrypoint: Callable[..., Awaitable[Result[None]]],
+    config_path: str,
+    config: Config,
+    count: int,
+) -> Result[None]:
+    """Run `count` shards as separate processes, show their combined progress, then merge their outputs."""
+    log = LogBar(name="coordinator")
+    context = multiprocessing.get_context("spawn")
+    progress_queue = context.Queue()
+    processes = [
+        context.Process(target=run_shard, args=(entrypoint, config_path, Shard(index, count), progress_queue))
+        for index in range(count)
+    ]
+    for process in processes:
+        process.start()
+    log.info(f"Started {count} shards")
+
+    # The bar can only be drawn once every shard has said how much work it has
+    sizes: dict[int, int] = {}
+    done = 0
+    pb = None
+    while any(process.is_alive() for process in processes) or not progress_queue.empty():
+        try:
+            kind, index, value = progress_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if kind == "start":
+            sizes[index] = value
+            if len(sizes) == count and sum(sizes.values()) > 0:
+                pb = log.pb(range(sum(sizes.values()))).subtitle("Processing requests")
+                for _ in range(done):
+                    pb.next()
+                pb.draw()
+        else:
+            done += value
+            if pb is not None:
+                for _ in range(value):
+                    pb.next()
+                pb.draw()
+
+    for process in processes:
+        process.join()
+    failed = [index for index, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        return Err(RuntimeError(f"Shard(s) {', '.join(map(str, failed))} failed, not merging"))
+
+    log.info("All shards completed!")
+    return merge_shards(config, count, log)
+
+def merge_shards(config: Config, count: int, log: LogBar) -> Result[None]:
+    """Combine every shard's output (and dead letters) into the configured output path."""
+    if config.output is None:
+        return Ok(None)
+
+    output = config.output
+    shards = [Shard(index, count) for index in range(count)]
+    schema = configured_schema(config)
+    frames: list[pl.LazyFrame] = []
+    try:
+        for shard in shards:
+            # A shard's output is its merged file, or its part files if it was told not to merge
+            shard_frames = scan_output(shard_path(output.path, shard), output.type, schema)
+            path = output_file(shard_path(output.path, shard), output.type)
+            if not shard_frames and not os.path.isfile(path):
+                return Err(FileNotFoundError(f"Missing output for shard {shard.index}: {path}"))
+            frames += shard_frames
+
+        merged = pl.DataFrame(schema=schema).lazy()
+        rows = 0
+        if frames:
+            merged = pl.concat(frames, how="diagonal_relaxed")
+            merged = merged.sort(output_keys(merged))
+            rows = merged.select(pl.len()).collect().item()
+
+        # Dead letters are plain JSONL, so they can be stitched together as-is
+        dead_letters = [dead_letter_path(shard_path(output.path, shard)) for shard in shards]
+        dead_letters = [path for path in dead_letters if os.path.isfile(path)]
+        if dead_letters:
+            with open(dead_letter_path(output.path), "wb") as f:
+                for path in dead_letters:
+                    with open(path, "rb") as dead:
+                        shutil.copyfileobj(dead, f)
+    except Exception as e:
+        return Err(e)
+
+    save_result = sink_frame(merged, output.path, output.type, resolve_compression(output.type, output.compression))
+    if save_result._error is not None:
+        return Err(save_result.unwrap_err())
+    log.info(f"Merged {rows} rows from {count} shards into {output.path}")
+    return Ok(None)
@@ -0,0 +1,100 @@
+import trio
+from msgspec import Struct, UNSET, UnsetType
+from msgspec import json as msgspec_json
+from typing import Any
+
+# What's buffered per span: kind, name, lane, start, end (trio clock) and args
+type Span = tuple[str, str, int, float, float, dict[str, Any] | None]
+
+class TraceEvent(Struct, omit_defaults=True):
+    """One event in Chrome's trace-event format. Times are in microseconds."""
+    name: str
+    ph: str # "X" for a complete span, "b"/"e" for the ends of an async one, "M" for metadata
+    ts: float
+    pid: int
+    tid: int
+    cat: str | UnsetType = UNSET
+    dur: float | UnsetType = UNSET
+    id: int | UnsetType = UNSET
+    args: dict[str, Any] | UnsetType = UNSET
+
+class Tracer:
+    """Collects a timeline of the run, for Perfetto or chrome://tracing.
+
+    Each worker task gets its own lane (`lane`) for the spans it runs
+    through, like sending a request or verifying a batch. Waits that
+    belong to a request rather than a task, like sitting in a queue or
+    an HTTP call that might be hedged, are async spans that Perfetto
+    stacks up on their own tracks.
+
+    Recording is just appending a tuple; the events only get built and
+    encoded when `flush` writes them out, from a worker thread. The file
+    is a JSON array that's only closed at the end, which trace viewers
+    are happy to load as-is, so a run that dies still leaves a usable
+    trace.
+    """
+
+    def __init__(self, path: str, pid: int = 0, process_name: str = "polymerase"):
+        self.path = path
+        self.pid = pid
+        self.start = trio.current_time()
+        self._events: list[Span] = []
+        self._lane_counts: dict[str, int] = {}
+        self._lane_names: list[str] = [process_name]
+        self._named = 0 # lanes whose names have been written out
+        self._next_id = 0
+        self._opened = False
+        self._encoder = msgspec_json.Encoder()
+
+    def lane(self, kind: str) -> int:
+        """A new lane for a task, named after what it does and how many of those there already are."""
+        count = self._lane_counts.get(kind, 0)
+        self._lane_counts[kind] = count + 1
+        self._lane_names.append(f"{kind} {count}")
+        return len(self._lane_names) - 1
+
+    def span(self, name: str, lane: int, start: float, end: float, args: dict[str, Any] | None = None) -> None:
+        """Something a task spent from `start` to `end` (trio clock) on."""
+        self._events.append(("X", name, lane, start, end, args))
+
+    def wait(self, name: str, start: float, end: float, args: dict[str, Any] | None = None) -> None:
+        """Time a request spent on something that can overlap with others, like a queue."""
+        self._events.append(("A", name, 0, start, end, args))
+
+    def take(self) -> list[Span]:
+        """Everything recorded since the last call, for `flush` to write out."""
+        events, self._events = self._events, []
+        return events
+
+    def _build(self, events: list[Span]) -> list[TraceEvent]:
+        built: list[TraceEvent] = []
+        # Name any lanes that have turned up since the last flush, the process being lane 0
+        names = self._lane_names[self._named:]
+        for lane, name in enumerate(names, start=self._named):
+            if lane == 0:
+                built.append(TraceEvent("process_name", "M", 0, self.pid, 0, args={"name": name}))
+                continue
+            built.append(TraceEvent("thread_name", "M", 0, self.pid, lane, args={"name": name}))
+            built.append(TraceEvent("thread_sort_index", "M", 0, self.pid, lane, args={"sort_index": lane}))
+        self._named += len(names)
+        for kind, name, lane, start, end, args in events:
+            ts = (start - self.start) * 1e6
+            if kind == "X":
+                built.append(TraceEvent(name, "X", ts, self.pid, lane, dur=(end - start) * 1e6, args=args or UNSET))
+            else:
+                self._next_id += 1
+                built.append(TraceEvent(name, "b", ts, self.pid, 0, cat="request", id=self._next_id, args=args or UNSET))
+                built.append(TraceEvent(name, "e", (end - self.start) * 1e6, self.pid, 0, cat="request", id=self._next_id))
+        return built
+
+    def flush(self, events: list[Span], close: bool = False) -> None:
+        """Append `events` (from `take`) to the trace file, closing the array if this is the end. Call from a worker thread."""
+        built = self._build(events)
+        with open(self.path, "ab" if self._opened else "wb") as f:
+            if built:
+                # The encoded list without its brackets, so batches can be strung together
+                data = self._encoder.encode(built)[1:-1]
+                f.write((b",\n" if self._opened else b"[\n") + data)
+                self._opened = True
+            if close:
+                f.write(b"\n]\n" if self._opened else b"[]\n")
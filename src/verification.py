@@ -1,8 +1,271 @@
-from result import Result
+import importlib
+import multiprocessing
+import os
+import re
+import threading
+import msgspec
+import polars as pl
+import trio
+from concurrent.futures import ProcessPoolExecutor
+from functools import cache
+from typing import Callable
 from messages import Request
+from config import (
+    Check,
+    CustomCheck,
+    DuplicateCheck,
+    JsonCheck,
+    LengthCheck,
+    RefusalCheck,
+    RegexCheck,
+    SubstringCheck,
+)
 
-@Result.resultify
-def verify_request(request: Request) -> bool:
-    """Placeholder verification logic for a completed request."""
-    # TODO: Implement actual verification logic
-    return True
+# A check on one finished request: returns None if the response is fine, or why it isn't.
+# Custom checks (`type = "custom"`) are plain functions of this shape.
+type Verifier = Callable[[Request], str | None]
+
+REFUSAL_PHRASES = [
+    "i'm sorry",
+    "i am sorry",
+    "i apologize",
+    "i cannot",
+    "i can't",
+    "i can not",
+    "i won't",
+    "i'm unable to",
+    "i am unable to",
+    "i'm not able to",
+    "i am not able to",
+    "as an ai",
+]
+
+CODE_FENCE = re.compile(r"^\s*```[\w-]*\s*\n(.*?)\n?\s*```\s*$", re.DOTALL)
+
+def response_text(request: Request) -> str:
+    """The assistant's reply, or an empty string if there isn't one."""
+    if request.messages and request.messages[-1].role == "assistant":
+        return request.messages[-1].content
+    return ""
+
+@cache
+def load_function(path: str) -> Verifier:
+    """Import a custom check given as "module:function"."""
+    module, _, name = path.partition(":")
+    if not module or not name:
+        raise ValueError(f'Custom checks are given as "module:function", got "{path}"')
+    function = getattr(importlib.import_module(module), name)
+    if not callable(function):
+        raise TypeError(f"{path} isn't callable")
+    return function
+
+def run_check(check: Check, request: Request) -> str | None:
+    text = response_text(request)
+    match check:
+        case LengthCheck(min_chars=min_chars, max_chars=max_chars):
+            if min_chars is not None and len(text) < min_chars:
+                return f"Response is {len(text)} characters, under the minimum of {min_chars}"
+            if max_chars is not None and len(text) > max_chars:
+                return f"Response is {len(text)} characters, over the maximum of {max_chars}"
+        case RegexCheck(pattern=pattern, must_match=must_match, ignore_case=ignore_case):
+            # `re` keeps its own cache of compiled patterns, so there's no need to hold on to them here
+            found = re.search(pattern, text, re.IGNORECASE if ignore_case else 0) is not None
+            if must_match and not found:
+                return f"Response doesn't match /{pattern}/"
+            if not must_match and found:
+                return f"Response matches /{pattern}/"
+        case SubstringCheck(substrings=substrings, ignore_case=ignore_case):
+            haystack = text.lower() if ignore_case else text
+            for substring in substrings:
+                if (substring.lower() if ignore_case else substring) not in haystack:
+                    return f'Response doesn\'t contain "{substring}"'
+        case DuplicateCheck():
+            raise ValueError("Duplicate checks need the whole run's responses, so only work with `vectorized = true`")
+        case JsonCheck(strip_fences=strip_fences):
+            if strip_fences and (fenced := CODE_FENCE.match(text)) is not None:
+                text = fenced.group(1)
+            try:
+                msgspec.json.decode(text)
+            except msgspec.DecodeError as e:
+                return f"Response isn't valid JSON: {e}"
+        case RefusalCheck(phrases=phrases, within_chars=within_chars):
+            opening = text[:within_chars].lower().replace("’", "'")
+            for phrase in phrases if phrases is not None else REFUSAL_PHRASES:
+                if phrase.lower() in opening:
+                    return f'Response looks like a refusal ("{phrase}")'
+        case CustomCheck(function=function):
+            return load_function(function)(request)
+    return None
+
+def verify_batch(checks: list[Check], requests: list[Request]) -> list[str | None]:
+    """Run every check over each request, returning the first failure for each (or None if it passed)."""
+    failures: list[str | None] = []
+    for request in requests:
+        failure = None
+        for check in checks:
+            try:
+                failure = run_check(check, request)
+            except Exception as e:
+                failure = f"{type(check).__name__} raised {type(e).__name__}: {e}"
+            if failure is not None:
+                break
+        failures.append(failure)
+    return failures
+
+def failure_expr(check: Check) -> pl.Expr | None:
+    """`check` as an expression over a frame of responses: why each row failed, or null if it passed.
+
+    None for checks that can't be expressed over a whole column, which are run row by row instead.
+    """
+    text = pl.col("response").fill_null("")
+    match check:
+        case LengthCheck(min_chars=min_chars, max_chars=max_chars):
+            length = text.str.len_chars()
+            reasons = []
+            if min_chars is not None:
+                reasons.append(pl.when(length < min_chars).then(
+                    pl.format(f"Response is {{}} characters, under the minimum of {min_chars}", length)
+                ))
+            if max_chars is not None:
+                reasons.append(pl.when(length > max_chars).then(
+                    pl.format(f"Response is {{}} characters, over the maximum of {max_chars}", length)
+                ))
+            return pl.coalesce(reasons) if reasons else pl.lit(None, dtype=pl.String)
+        case RegexCheck(pattern=pattern, must_match=must_match, ignore_case=ignore_case):
+            found = text.str.contains(f"(?i){pattern}" if ignore_case else pattern)
+            reason = f"Response doesn't match /{pattern}/" if must_match else f"Response matches /{pattern}/"
+            return pl.when(found != must_match).then(pl.lit(reason))
+        case SubstringCheck(substrings=substrings, ignore_case=ignore_case):
+            haystack = text.str.to_lowercase() if ignore_case else text
+            return pl.coalesce([
+                pl.when(~haystack.str.contains(substring.lower() if ignore_case else substring, literal=True))
+                .then(pl.lit(f'Response doesn\'t contain "{substring}"'))
+                for substring in substrings
+            ] or [pl.lit(None, dtype=pl.String)])
+        case RefusalCheck(phrases=phrases, within_chars=within_chars):
+            opening = text.str.slice(0, within_chars).str.to_lowercase().str.replace_all("’", "'", literal=True)
+            phrases = [phrase.lower() for phrase in (phrases if phrases is not None else REFUSAL_PHRASES)]
+            return pl.when(opening.str.contains_any(phrases)).then(pl.lit("Response looks like a refusal"))
+    return None
+
+def response_hash(normalize: bool) -> pl.Expr:
+    text = pl.col("response").fill_null("")
+    if normalize:
+        text = text.str.to_lowercase().str.replace_all(r"[^\w]+", " ").str.strip_chars()
+    return text.hash(seed=0)
+
+class FrameVerifier:
+    """Checks whole batches at once, as polars expressions over a frame of the responses.
+
+    Checks that have an expression (length, regex, contains, refusal) are all
+    evaluated in one pass, the rest run row by row on whatever passed those,
+    and duplicates are looked for last, among the responses that passed
+    everything else. A response is a duplicate if its hash matches one kept
+    earlier in the run, or an earlier one in the same batch.
+    """
+
+    def __init__(self, checks: list[Check]):
+        self.duplicates = [check for check in checks if isinstance(check, DuplicateCheck)]
+        self.expressions: list[pl.Expr] = []
+        self.row_checks: list[Check] = []
+        for check in checks:
+            if isinstance(check, DuplicateCheck):
+                continue
+            if (expr := failure_expr(check)) is not None:
+                self.expressions.append(expr)
+            else:
+                self.row_checks.append(check)
+        if self.expressions:
+            # Polars has its own regex syntax, so catch a pattern it can't handle now rather than on the first batch
+            pl.DataFrame(schema={"response": pl.String}).select(pl.coalesce(self.expressions))
+        self._seen = [pl.Series("hash", [], dtype=pl.UInt64) for _ in self.duplicates]
+        self._lock = threading.Lock()
+
+    def verify(self, requests: list[Request]) -> list[str | None]:
+        # The same text the per-row checks see: the last message, not the first reply in a few-shot prompt
+        df = pl.DataFrame({"response": [response_text(request) for request in requests]}, schema={"response": pl.String})
+        if self.expressions:
+            failures: list[str | None] = df.select(pl.coalesce(self.expressions)).to_series().to_list()
+        else:
+            failures = [None] * len(requests)
+
+        if self.row_checks:
+            passing = [index for index, failure in enumerate(failures) if failure is None]
+            for index, failure in zip(passing, verify_batch(self.row_checks, [requests[index] for index in passing])):
+                failures[index] = failure
+
+        if self.duplicates:
+            passed = pl.Series("passed", [failure is None for failure in failures], dtype=pl.Boolean)
+            # Batches are verified concurrently, and each needs to see what the ones before it kept
+            with self._lock:
+                for index, check in enumerate(self.duplicates):
+                    frame = df.with_columns(passed).select(
+                        key=pl.when(pl.col("passed")).then(response_hash(check.normalize))
+                    ).with_columns(
+                        duplicate=pl.col("key").is_not_null()
+                        & (pl.col("key").is_in(self._seen[index].implode()) | ~pl.col("key").is_first_distinct())
+                    )
+                    for row in frame.select(pl.arg_where(pl.col("duplicate"))).to_series().to_list():
+                        failures[row] = "Response is a duplicate of an earlier one"
+                        passed[row] = False
+                    self._seen[index].append(frame["key"].filter(passed))
+        return failures
+
+class VerificationPool:
+    """Runs the configured checks over batches of responses, off the event loop.
+
+    Checks are CPU work, so batches go to a pool of `processes` worker
+    processes (or a thread, with `processes = 0`) and the event loop only
+    waits on the result. Vectorized batches go to a `FrameVerifier` on a
+    thread instead, since polars spreads the work over every core by itself.
+    With no checks configured everything passes straight through without
+    leaving the loop.
+    """
+
+    def __init__(self, checks: list[Check], processes: int | None = None, vectorized: bool = False):
+        self.checks = checks
+        self.processes = processes if processes is not None else os.cpu_count() or 1
+        self.passed = 0
+        self.failed = 0
+        self._executor: ProcessPoolExecutor | None = None
+        self._frame = FrameVerifier(checks) if vectorized else None
+        if not vectorized and any(isinstance(check, DuplicateCheck) for check in checks):
+            raise ValueError("Duplicate checks need `vectorized = true` in [verification]")
+        # A typo in a check should stop the run now, not fail every response later
+        for check in checks:
+            if isinstance(check, CustomCheck):
+                load_function(check.function)
+            elif isinstance(check, RegexCheck) and not vectorized:
+                re.compile(check.pattern)
+
+    @property
+    def concurrency(self) -> int:
+        """How many batches can usefully be verified at once."""
+        if self._frame is not None:
+            # One batch being built while another is checked keeps polars busy
+            return 2
+        return max(1, self.processes)
+
+    async def verify(self, requests: list[Request]) -> list[str | None]:
+        if not self.checks:
+            failures: list[str | None] = [None] * len(requests)
+        elif self._frame is not None:
+            failures = await trio.to_thread.run_sync(self._frame.verify, requests)
+        elif self.processes == 0:
+            failures = await trio.to_thread.run_sync(verify_batch, self.checks, requests)
+        else:
+            if self._executor is None:
+                # Spawned rather than forked, since forking a process with threads running isn't safe
+                self._executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+            future = self._executor.submit(verify_batch, self.checks, requests)
+            failures = await trio.to_thread.run_sync(future.result)
+
+        failed = sum(failure is not None for failure in failures)
+        self.failed += failed
+        self.passed += len(failures) - failed
+        return failures
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None